@@ -0,0 +1,335 @@
+# coding: utf8
+""" benchmark pyproxy against a local origin server, no network needed
+
+usage: python bench.py --concurrency 32 --duration 10 --output out.json \
+        --proxy-args "--engine reactor"
+
+--idle-tunnels N also measures the proxy's resident memory per idle
+connection, for N established CONNECT tunnels and N keep-alive clients
+waiting between requests (linux, reads /proc).
+"""
+import os
+import sys
+import time
+import json
+import shlex
+import socket
+import argparse
+import platform
+import threading
+import subprocess
+import http.client
+import http.server
+if os.name != 'nt':
+    import resource
+
+
+CWD = os.path.dirname(os.path.abspath(__file__))
+SCENARIOS = ('get', 'get-chunked', 'post', 'post-chunked', 'connect')
+
+
+class OriginHandler(http.server.BaseHTTPRequestHandler):
+    """ GET /bytes/N and /chunked/N send N bytes, POST reads the body
+    (content-length or chunked) and returns its size.
+    """
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    chunk = b'x' * 65536
+
+    def do_GET(self):
+        kind, size = self.path.rsplit('/', 2)[-2:]
+        size = int(size)
+        self.send_response(200)
+        if kind == 'chunked':
+            self.send_header('Transfer-Encoding', 'chunked')
+            self.end_headers()
+            while size:
+                n = min(size, len(self.chunk))
+                self.wfile.write(b'%x\r\n' % n + self.chunk[:n] + b'\r\n')
+                size -= n
+            self.wfile.write(b'0\r\n\r\n')
+        else:
+            self.send_header('Content-Length', str(size))
+            self.end_headers()
+            while size:
+                n = min(size, len(self.chunk))
+                self.wfile.write(self.chunk[:n])
+                size -= n
+
+    def do_POST(self):
+        size = 0
+        if self.headers.get('Transfer-Encoding', '').lower() == 'chunked':
+            while True:
+                n = int(self.rfile.readline().split(b';')[0], 16)
+                if n == 0:
+                    while self.rfile.readline() not in (b'\r\n', b'\n', b''):
+                        pass
+                    break
+                size += len(self.rfile.read(n))
+                self.rfile.readline()
+        else:
+            size = len(self.rfile.read(int(self.headers['Content-Length'])))
+        body = str(size).encode()
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class Origin(http.server.ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+def free_port():
+    s = socket.socket()
+    s.bind(('127.0.0.1', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def wait_port(port, timeout=10):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), 1).close()
+            return
+        except socket.error:
+            time.sleep(0.1)
+    raise RuntimeError('proxy not listening on port {}'.format(port))
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+class Client(threading.Thread):
+    """ one keep-alive connection through the proxy running one scenario
+    until `deadline`.
+    """
+
+    def __init__(self, scenario, proxy_port, origin_port, size, deadline):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.scenario = scenario
+        self.proxy_port = proxy_port
+        self.origin = '127.0.0.1:{}'.format(origin_port)
+        self.size = size
+        self.deadline = deadline
+        self.latencies = []
+        self.bytes = 0
+        self.errors = 0
+        self.conn = None
+
+    def connect(self):
+        self.conn = http.client.HTTPConnection('127.0.0.1', self.proxy_port,
+                timeout=30)
+        if self.scenario == 'connect':
+            self.conn.set_tunnel(self.origin)
+
+    def request(self):
+        if self.scenario == 'connect':
+            url = '/bytes/{}'.format(self.size)
+        else:
+            url = 'http://{}'.format(self.origin)
+            url += '/chunked/{}' if self.scenario == 'get-chunked' else \
+                    '/bytes/{}'
+            url = url.format(self.size)
+        if self.scenario == 'post':
+            self.conn.request('POST', url, body=b'x' * self.size)
+            return self.size
+        if self.scenario == 'post-chunked':
+            pieces = (b'x' * 4096 for _ in range(self.size // 4096))
+            self.conn.request('POST', url, body=pieces, encode_chunked=True)
+            return self.size // 4096 * 4096
+        self.conn.request('GET', url)
+        return 0
+
+    def run(self):
+        while time.time() < self.deadline:
+            start = time.time()
+            try:
+                if self.conn is None:
+                    self.connect()
+                sent = self.request()
+                response = self.conn.getresponse()
+                received = len(response.read())
+                if response.status != 200:
+                    raise RuntimeError(response.status)
+                if response.will_close:
+                    self.conn.close()
+                    self.conn = None
+            except Exception:
+                self.errors += 1
+                if self.conn:
+                    self.conn.close()
+                self.conn = None
+                continue
+            self.latencies.append(time.time() - start)
+            self.bytes += sent + received
+        if self.conn:
+            self.conn.close()
+
+
+def rss_kb(pid):
+    with open('/proc/{}/status'.format(pid)) as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1])
+
+
+def open_idle(kind, proxy_port, origin_port):
+    s = socket.create_connection(('127.0.0.1', proxy_port), timeout=30)
+    if kind == 'connect':
+        s.sendall('CONNECT 127.0.0.1:{} HTTP/1.1\r\n\r\n'.format(
+                origin_port).encode())
+    else:
+        s.sendall('GET http://127.0.0.1:{}/bytes/1 HTTP/1.1\r\n'
+                'Host: 127.0.0.1\r\n\r\n'.format(origin_port).encode())
+    data = b''
+    # tunnel established, or the whole 1 byte response received
+    while not (data.endswith(b'\r\n\r\n') if kind == 'connect' else
+            data.endswith(b'\r\n\r\nx')):
+        chunk = s.recv(4096)
+        if not chunk:
+            raise RuntimeError('proxy closed the connection')
+        data += chunk
+    return s
+
+
+def start_proxy(extra_args):
+    port = free_port()
+    proxy = subprocess.Popen([sys.executable, os.path.join(CWD, 'pyproxy.py'),
+            '--hostname', '127.0.0.1', '--port', str(port),
+            '--log-level', 'warning', '--open-file-limit', '65536'] +
+            extra_args)
+    wait_port(port)
+    return proxy, port
+
+
+def measure_idle(kind, count, proxy_args, origin_port):
+    """KB of proxy resident memory per idle connection of `kind`, in a
+    fresh proxy so memory freed by earlier connections is not reused."""
+    proxy, proxy_port = start_proxy(
+            ['--max-tunnels', str(count + 100)] + proxy_args)
+    conns = []
+    try:
+        # warm up code paths and allocator pools first
+        open_idle(kind, proxy_port, origin_port).close()
+        time.sleep(0.5)
+        before = rss_kb(proxy.pid)
+        for _ in range(count):
+            conns.append(open_idle(kind, proxy_port, origin_port))
+        time.sleep(1)
+        after = rss_kb(proxy.pid)
+    finally:
+        for s in conns:
+            s.close()
+        proxy.terminate()
+        proxy.wait()
+    return round((after - before) / float(count), 2)
+
+
+def run_scenario(scenario, args, proxy_port, origin_port):
+    deadline = time.time() + args.duration
+    clients = [Client(scenario, proxy_port, origin_port, args.size, deadline)
+               for _ in range(args.concurrency)]
+    start = time.time()
+    for client in clients:
+        client.start()
+    for client in clients:
+        client.join()
+    elapsed = time.time() - start
+
+    latencies = [l for client in clients for l in client.latencies]
+    total_bytes = sum(client.bytes for client in clients)
+    p50, p99 = percentile(latencies, 50), percentile(latencies, 99)
+    return {
+        'requests': len(latencies),
+        'errors': sum(client.errors for client in clients),
+        'requests_per_sec': round(len(latencies) / elapsed, 1),
+        'mb_per_sec': round(total_bytes / elapsed / 1e6, 2),
+        'p50_ms': round(p50 * 1000, 2) if p50 is not None else None,
+        'p99_ms': round(p99 * 1000, 2) if p99 is not None else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--concurrency', default=16, type=int)
+    parser.add_argument('--duration', default=5, type=float,
+            help='seconds per scenario')
+    parser.add_argument('--size', default=16384, type=int,
+            help='response or request body bytes')
+    parser.add_argument('--scenarios', default=','.join(SCENARIOS),
+            help='comma separated, of ' + ', '.join(SCENARIOS))
+    parser.add_argument('--proxy-args', default='',
+            help='extra pyproxy.py arguments, like "--engine reactor"')
+    parser.add_argument('--output', default='',
+            help='write results as json to this file')
+    parser.add_argument('--idle-tunnels', default=0, type=int,
+            help='measure memory per idle tunnel with this many tunnels')
+    args = parser.parse_args()
+
+    origin = Origin(('127.0.0.1', 0), OriginHandler)
+    origin_port = origin.server_address[1]
+    threading.Thread(target=origin.serve_forever, daemon=True).start()
+
+    proxy_args = shlex.split(args.proxy_args)
+    results, idle_kb = {}, {}
+    try:
+        scenarios = [s for s in args.scenarios.split(',') if s]
+        if scenarios:
+            proxy, proxy_port = start_proxy(proxy_args)
+            try:
+                for scenario in scenarios:
+                    results[scenario] = run_scenario(scenario, args,
+                            proxy_port, origin_port)
+                    print('{:<14} {}'.format(scenario,
+                            json.dumps(results[scenario])))
+            finally:
+                proxy.terminate()
+                proxy.wait()
+        if args.idle_tunnels:
+            for kind in ('connect', 'keepalive'):
+                idle_kb[kind] = measure_idle(kind, args.idle_tunnels,
+                        proxy_args, origin_port)
+            print('idle tunnel KB {}'.format(json.dumps(idle_kb)))
+    finally:
+        origin.shutdown()
+
+    peak_rss_kb = None
+    if os.name != 'nt':
+        # proxy and its reaped workers are the only children
+        peak_rss_kb = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        if sys.platform == 'darwin':
+            peak_rss_kb //= 1024
+    print('peak rss [{}] KB'.format(peak_rss_kb))
+
+    report = {
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'proxy_args': args.proxy_args,
+        'concurrency': args.concurrency,
+        'duration': args.duration,
+        'size': args.size,
+        'peak_rss_kb': peak_rss_kb,
+        'idle_tunnels': args.idle_tunnels,
+        'idle_tunnel_kb': idle_kb,
+        'results': results,
+    }
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,310 @@
+# coding: utf8
+""" micro benchmark and split corpus for HttpParser and ChunkParser
+
+Every corpus message is fed whole, split in two at every possible
+boundary, and one byte at a time, with `keep_body` on and off. All feeds
+must give the expected method/url/code/headers/body and leftover bytes.
+
+usage: python bench_parser.py [--number 2000] [--corpus DIR] [--output out.json]
+
+Files in a corpus directory hold raw recorded streams, *.req for requests
+and *.resp for responses; their whole-message parse is the expectation.
+"""
+import os
+import sys
+import time
+import json
+import argparse
+import tracemalloc
+
+from pyproxy import HttpParser, ChunkParser
+
+
+REQUEST = HttpParser.types.REQUEST_PARSER
+RESPONSE = HttpParser.types.RESPONSE_PARSER
+STATES = dict((v, k) for k, v in HttpParser.states._asdict().items())
+
+
+def case(name, parser_type, data, fields=None, request_method=None, **expect):
+    """ `expect` holds expected results, `fields` limits which ones must
+    hold for split feeds.
+    """
+    return dict(name=name, type=parser_type, data=data, expect=expect,
+            fields=fields, request_method=request_method)
+
+
+CORPUS = [
+    case('get', REQUEST,
+        b'GET http://example.com/path/a.html?q=1&r=2 HTTP/1.1\r\n'
+        b'Host: example.com\r\n'
+        b'User-Agent: Mozilla/5.0 (X11; Linux x86_64)\r\n'
+        b'Accept: text/html,application/xhtml+xml;q=0.9,*/*;q=0.8\r\n'
+        b'Accept-Encoding: gzip, deflate\r\n'
+        b'Proxy-Connection: keep-alive\r\n\r\n',
+        state='COMPLETE', method=b'GET',
+        url=b'http://example.com/path/a.html?q=1&r=2',
+        headers={b'host': b'example.com',
+                 b'user-agent': b'Mozilla/5.0 (X11; Linux x86_64)',
+                 b'accept': b'text/html,application/xhtml+xml;q=0.9,*/*;q=0.8',
+                 b'accept-encoding': b'gzip, deflate',
+                 b'proxy-connection': b'keep-alive'},
+        body=None, rest=b''),
+    case('post-content-length', REQUEST,
+        b'POST http://example.com/form HTTP/1.1\r\n'
+        b'Host: example.com\r\n'
+        b'Content-Type: application/x-www-form-urlencoded\r\n'
+        b'Content-Length: 27\r\n\r\n'
+        b'name=pyproxy&value=a%3Ab%3A',
+        state='COMPLETE', method=b'POST', url=b'http://example.com/form',
+        headers={b'host': b'example.com',
+                 b'content-type': b'application/x-www-form-urlencoded',
+                 b'content-length': b'27'},
+        body=b'name=pyproxy&value=a%3Ab%3A', rest=b''),
+    case('post-chunked', REQUEST,
+        b'POST http://example.com/upload HTTP/1.1\r\n'
+        b'Host: example.com\r\n'
+        b'Transfer-Encoding: chunked\r\n\r\n'
+        b'5;name=value\r\nhello\r\n'
+        b'6\r\n world\r\n'
+        b'0\r\nX-Checksum: 1234\r\n\r\n',
+        state='COMPLETE', method=b'POST', url=b'http://example.com/upload',
+        headers={b'host': b'example.com', b'transfer-encoding': b'chunked'},
+        body=b'hello world', rest=b''),
+    case('pipelined', REQUEST,
+        b'GET http://example.com/1 HTTP/1.1\r\nHost: example.com\r\n\r\n'
+        b'GET http://example.com/2 HTTP/1.1\r\nHost: example.com\r\n\r\n',
+        state='COMPLETE', method=b'GET', url=b'http://example.com/1',
+        headers={b'host': b'example.com'}, body=None,
+        rest=b'GET http://example.com/2 HTTP/1.1\r\nHost: example.com\r\n\r\n'),
+    # the 2-packet CONNECT hack in parse_head ends the header block at any
+    # packet ending in CRLF, later header lines and the final CRLF are
+    # then not part of the message
+    case('connect', REQUEST,
+        b'CONNECT example.com:443 HTTP/1.1\r\n'
+        b'Host: example.com:443\r\n'
+        b'User-Agent: curl/7.58.0\r\n\r\n',
+        fields=('method', 'url'),
+        state='COMPLETE', method=b'CONNECT', url=b'example.com:443',
+        headers={b'host': b'example.com:443',
+                 b'user-agent': b'curl/7.58.0'},
+        body=None, rest=b''),
+    case('connect-no-headers', REQUEST,
+        b'CONNECT example.com:443 HTTP/1.1\r\n\r\n',
+        fields=('state', 'method', 'url', 'headers', 'body'),
+        state='COMPLETE', method=b'CONNECT', url=b'example.com:443',
+        headers={}, body=None, rest=b''),
+    case('response-content-length', RESPONSE,
+        b'HTTP/1.1 200 OK\r\n'
+        b'Date: Sun, 18 Oct 2026 10:00:00 GMT\r\n'
+        b'Content-Type: text/html; charset=utf-8\r\n'
+        b'Content-Length: 26\r\n\r\n'
+        b'<html><b>hello</b></html>\n',
+        state='COMPLETE', code=b'200',
+        headers={b'date': b'Sun, 18 Oct 2026 10:00:00 GMT',
+                 b'content-type': b'text/html; charset=utf-8',
+                 b'content-length': b'26'},
+        body=b'<html><b>hello</b></html>\n', rest=b''),
+    case('response-chunked', RESPONSE,
+        b'HTTP/1.1 200 OK\r\n'
+        b'Transfer-Encoding: chunked\r\n\r\n'
+        b'1a\r\nabcdefghijklmnopqrstuvwxyz\r\n'
+        b'A\r\n0123456789\r\n'
+        b'0\r\n\r\n',
+        state='COMPLETE', code=b'200',
+        headers={b'transfer-encoding': b'chunked'},
+        body=b'abcdefghijklmnopqrstuvwxyz0123456789', rest=b''),
+    case('response-head', RESPONSE,
+        b'HTTP/1.1 200 OK\r\nContent-Length: 1234\r\n\r\n',
+        request_method=b'HEAD',
+        state='COMPLETE', code=b'200',
+        headers={b'content-length': b'1234'}, body=None, rest=b''),
+    case('response-204', RESPONSE,
+        b'HTTP/1.1 204 No Content\r\n\r\n',
+        state='COMPLETE', code=b'204', headers={}, body=None, rest=b''),
+    case('response-304', RESPONSE,
+        b'HTTP/1.1 304 Not Modified\r\nETag: "abc"\r\n\r\n',
+        state='COMPLETE', code=b'304', headers={b'etag': b'"abc"'},
+        body=None, rest=b''),
+    case('response-until-close', RESPONSE,
+        b'HTTP/1.0 200 OK\r\nContent-Type: text/plain\r\n\r\n'
+        b'body lasts until the server closes',
+        state='RCVING_BODY', code=b'200',
+        headers={b'content-type': b'text/plain'},
+        body=b'body lasts until the server closes', rest=b''),
+    case('response-many-headers', RESPONSE,
+        b'HTTP/1.1 200 OK\r\n' +
+        b''.join(b'X-Header-%d: value-%d\r\n' % (i, i) for i in range(40)) +
+        b'Content-Length: 2\r\n\r\nok',
+        state='COMPLETE', code=b'200',
+        headers=dict([(b'x-header-%d' % i, b'value-%d' % i)
+                for i in range(40)] + [(b'content-length', b'2')]),
+        body=b'ok', rest=b''),
+    case('response-large-body', RESPONSE,
+        b'HTTP/1.1 200 OK\r\nContent-Length: 65536\r\n\r\n' +
+        b'x' * 65536,
+        state='COMPLETE', code=b'200', headers={b'content-length': b'65536'},
+        body=b'x' * 65536, rest=b''),
+]
+
+
+def load_corpus(path):
+    cases = []
+    for name in sorted(os.listdir(path)):
+        ext = os.path.splitext(name)[1]
+        if ext not in ('.req', '.resp'):
+            continue
+        with open(os.path.join(path, name), 'rb') as f:
+            data = f.read()
+        parser_type = REQUEST if ext == '.req' else RESPONSE
+        c = case(name, parser_type, data)
+        c['expect'] = result(c, True, *feed(c, [data]))
+        cases.append(c)
+    return cases
+
+
+def feed(c, pieces, keep_body=True):
+    """ returns the parser and the body bytes it exposed, wire format. """
+    parser = HttpParser(c['type'], keep_body=keep_body)
+    parser.request_method = c['request_method']
+    wire = []
+    for piece in pieces:
+        parser.parse(piece)
+        wire.extend(parser.body_pieces)
+    return parser, b''.join(wire)
+
+
+def result(c, keep_body, parser, wire_body):
+    """ results comparable with a corpus case expectation. """
+    url = parser.url.geturl() if parser.url else None
+    body = parser.body
+    if body is None and parser.body_parts:     # body lasting until close
+        body = b''.join(parser.body_parts)
+    if not keep_body:
+        # the wire body is forwarded as is, decode it for comparison
+        if wire_body and parser.chunk_parser:
+            decoder = ChunkParser()
+            decoder.parse(wire_body)
+            body = decoder.body
+        else:
+            body = wire_body or None
+    return {
+        'state': STATES[parser.state],
+        'method': parser.method,
+        'url': url,
+        'code': parser.code,
+        'headers': dict((k, v[1]) for k, v in parser.headers.items()),
+        'body': body,
+        'rest': parser.buffer if parser.state == HttpParser.states.COMPLETE
+                else b'',
+    }
+
+
+def splits(data):
+    yield 'whole', [data]
+    for i in range(1, len(data)):
+        yield 'split@{}'.format(i), [data[:i], data[i:]]
+    yield 'bytewise', [data[i:i + 1] for i in range(len(data))]
+
+
+def check(c):
+    """ returns a list of mismatches. """
+    errors = []
+    for keep_body in (True, False):
+        for how, pieces in splits(c['data']):
+            fields = c['fields'] if how != 'whole' and c['fields'] else \
+                    list(c['expect'])
+            try:
+                got = result(c, keep_body, *feed(c, pieces, keep_body))
+            except Exception as e:
+                errors.append('{} keep_body={} raised {!r}'.format(
+                        how, keep_body, e))
+                continue
+            for field in fields:
+                if got[field] != c['expect'][field]:
+                    errors.append('{} keep_body={} {}: {!r} != {!r}'.format(
+                            how, keep_body, field, got[field],
+                            c['expect'][field]))
+    return errors
+
+
+def measure(c, number):
+    data = c['data']
+    start = time.perf_counter()
+    for _ in range(number):
+        feed(c, [data], False)
+    whole = (time.perf_counter() - start) / number / len(data) * 1e9
+
+    # every 2-split once, and byte at a time, on fewer rounds
+    rounds = max(1, number // 100)
+    pieces = [p for _, p in splits(data)][1:-1] or [[data]]
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for p in pieces:
+            feed(c, p, False)
+    split = (time.perf_counter() - start) / rounds / len(pieces) / \
+            len(data) * 1e9
+
+    bytewise = [data[i:i + 1] for i in range(len(data))]
+    start = time.perf_counter()
+    for _ in range(rounds):
+        feed(c, bytewise, False)
+    onebyte = (time.perf_counter() - start) / rounds / len(data) * 1e9
+
+    # allocations of one whole-message parse, and what the parser keeps
+    tracemalloc.start()
+    before_blocks = sys.getallocatedblocks()
+    before, _ = tracemalloc.get_traced_memory()
+    parser, _ = feed(c, [data], False)
+    after, peak = tracemalloc.get_traced_memory()
+    retained_blocks = sys.getallocatedblocks() - before_blocks
+    tracemalloc.stop()
+    del parser
+
+    return {
+        'bytes': len(data),
+        'ns_per_byte_whole': round(whole, 2),
+        'ns_per_byte_split': round(split, 2),
+        'ns_per_byte_bytewise': round(onebyte, 2),
+        'peak_alloc_bytes': peak - before,
+        'retained_bytes': after - before,
+        'retained_blocks': retained_blocks,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--number', default=2000, type=int,
+            help='whole message parses per case')
+    parser.add_argument('--corpus', default='',
+            help='directory of recorded *.req and *.resp streams')
+    parser.add_argument('--output', default='',
+            help='write results as json to this file')
+    parser.add_argument('--check-only', action='store_true')
+    args = parser.parse_args()
+
+    cases = CORPUS + (load_corpus(args.corpus) if args.corpus else [])
+    results, failed = {}, 0
+    for c in cases:
+        errors = check(c)
+        failed += bool(errors)
+        results[c['name']] = {'errors': errors}
+        if not args.check_only:
+            results[c['name']].update(measure(c, args.number))
+        line = ' '.join('{}={}'.format(k, v) for k, v in
+                sorted(results[c['name']].items()) if k != 'errors')
+        print('{:<26} {:<4} {}'.format(c['name'],
+                'FAIL' if errors else 'ok', line))
+        for error in errors[:5]:
+            print('    ' + error)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+                       'python': sys.version.split()[0],
+                       'number': args.number,
+                       'results': results}, f, indent=2, sort_keys=True)
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
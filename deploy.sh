@@ -16,6 +16,12 @@ wget "${GITHOME}/heartbeat.py" -O heartbeat.py
 wget "${GITHOME}/pyproxy.py" -O pyproxy.py
 wget "${GITHOME}/dog.py" -O dog.py
 wget "${GITHOME}/bohao.sh" -O bohao.sh
+wget "${GITHOME}/redial.py" -O redial.py
 wget "${GITHOME}/.version" -O .version
 
+if [ -f log/pyproxy.pid ] && kill -0 $(cat log/pyproxy.pid) 2>/dev/null;then
+    echo "平滑重启代理" 
+    kill -HUP $(cat log/pyproxy.pid)
+fi
+
 echo "部署成功"
@@ -1,47 +1,113 @@
-# coding: utf8 
+# coding: utf8
+""" report this vps and its proxy load to the admin server
+
+one keep-alive session posts a heartbeat every --interval seconds, and at
+once when the public address changes. Address changes are noticed through
+netlink on linux, by polling the default route interface elsewhere.
+
+try against a local stand-in admin, any http server accepting POST:
+    python heartbeat.py --admin http://127.0.0.1:8888/_add_proxy \
+            --interval 1 --log-file ''
+"""
 import os
-import logging
-import logging.handlers
 import time
-import socket
 import json
+import socket
+import struct
+import select
+import logging
+import logging.handlers
+import argparse
+try:
+    import fcntl
+except ImportError:     # windows, no lock file nor interface ioctl
+    fcntl = None
 import requests
+from requests.adapters import HTTPAdapter
 
 
 CWD = os.path.dirname(os.path.abspath(__file__))
 LOG_PATH = '{}/log/heartbeat.log'.format(CWD)
 RUN_PATH = '{}/.runtime'.format(CWD)
+NAME_PATH = '{}/.name'.format(CWD)
 ADMIN_HOST = 'http://114.55.31.211:8888/_add_proxy'
 PROXY_PORT = 8899
+METRICS_PORT = 8898     # pyproxy --admin-port
+
+# linux/rtnetlink.h multicast groups, linux/sockios.h
+RTMGRP_LINK = 0x1
+RTMGRP_IPV4_IFADDR = 0x10
+RTMGRP_IPV4_ROUTE = 0x40
+SIOCGIFADDR = 0x8915
+RTF_UP = 0x1
 
 
 log = logging.getLogger('heartbeat')
-if LOG_PATH:
-    handler = logging.handlers.RotatingFileHandler(
-            LOG_PATH, maxBytes=1024*1024*500, backupCount=10)
-else:
-    handler = logging.StreamHandler()
-handler.setFormatter(logging.Formatter(
-        '[%(name)-18s %(threadName)-10s %(levelname)-8s '
-        '%(asctime)s] %(message)s'))
-log.addHandler(handler)
-log.setLevel(logging.INFO)
+
+
+def setup_log(path):
+    if path:
+        handler = logging.handlers.RotatingFileHandler(
+                path, maxBytes=1024*1024*500, backupCount=10)
+    else:
+        handler = logging.StreamHandler()
+    handler.setFormatter(logging.Formatter(
+            '[%(name)-18s %(threadName)-10s %(levelname)-8s '
+            '%(asctime)s] %(message)s'))
+    log.addHandler(handler)
+    log.setLevel(logging.INFO)
 
 
 def read_file(path):
     return open(path).read().strip() if os.path.isfile(path) else ''
 
 
-def get_name():
-    return read_file('{}/.name'.format(CWD))
+def acquire_lock(path):
+    """Returns the locked file kept open while running, None if another
+    heartbeat holds it."""
+    f = open(path, 'a+')
+    if fcntl:
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            f.close()
+            return None
+    f.seek(0)
+    f.truncate()
+    f.write(str(os.getpid()))
+    f.flush()
+    return f
 
 
-def is_running():
-    c = read_file(RUN_PATH)
-    return c and c.isdigit() and int(c) + 1 > int(time.time())
+def default_route_interface():
+    """Interface of the default route with the lowest metric."""
+    best = None
+    with open('/proc/net/route') as f:
+        for line in f.readlines()[1:]:
+            fields = line.split()
+            if len(fields) < 8 or fields[1] != '00000000' or \
+                    fields[7] != '00000000' or not int(fields[3], 16) & RTF_UP:
+                continue
+            metric = int(fields[6])
+            if best is None or metric < best[0]:
+                best = (metric, fields[0])
+    return best[1] if best else None
 
 
-def get_ip():
+def interface_ip(ifname):
+    s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        packed = fcntl.ioctl(s.fileno(), SIOCGIFADDR,
+                struct.pack('256s', ifname[:15].encode()))
+        return socket.inet_ntoa(packed[20:24])
+    except (IOError, OSError):
+        return None     # interface has no address (yet)
+    finally:
+        s.close()
+
+
+def probe_ip():
+    """Address of the interface routing to the internet, nothing is sent."""
     try:
         s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         s.connect(('8.8.8.8', 53))
@@ -53,30 +119,192 @@ def get_ip():
         return None
 
 
-def run():
-    if is_running():
-        log.info('program already running, exit..')
-        return
+def get_ip():
+    if fcntl and os.path.isfile('/proc/net/route'):
+        ifname = default_route_interface()
+        return interface_ip(ifname) if ifname else None
+    return probe_ip()
+
+
+class AddressWatcher(object):
+    """Cached public ip, re-read when netlink reports an address, link or
+    route change, or on every `wait` where netlink is not available."""
+
+    def __init__(self):
+        self.sock = None
+        if hasattr(socket, 'AF_NETLINK'):
+            try:
+                self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW,
+                        socket.NETLINK_ROUTE)
+                self.sock.bind((0, RTMGRP_LINK | RTMGRP_IPV4_IFADDR |
+                        RTMGRP_IPV4_ROUTE))
+                self.sock.setblocking(False)
+            except socket.error as e:
+                log.warning('netlink unavailable [%s], polling', e)
+                self.sock = None
+        self.ip = get_ip()
 
-    while True:
-        time.sleep(0.1)
-        open(RUN_PATH, 'wb').write(str(int(time.time())))
 
+    def wait(self, timeout):
+        """Sleep up to `timeout` seconds, returns True if the ip changed."""
+        if self.sock is None:
+            time.sleep(timeout)
+        elif not select.select([self.sock], [], [], timeout)[0]:
+            return False
+        else:
+            # one dial-up raises a burst of messages, read them all
+            while True:
+                try:
+                    self.sock.recv(65536)
+                except socket.error:
+                    break
         ip = get_ip()
-        log.info('current ip is [{}]'.format(ip))
-        if not ip:
-            return
+        if ip == self.ip:
+            return False
+        log.info('ip changed from [%s] to [%s]', self.ip, ip)
+        self.ip = ip
+        return True
 
-        b = {'type': 'vps', 'name': get_name(), 'schemes': ['HTTP', 'HTTPS'], 
-                'ip': get_ip(), 'port': PROXY_PORT }
-        log.info('send heartbeat to admin')
+
+class CachedFile(object):
+    """File content re-read only when its mtime changes."""
+
+    def __init__(self, path):
+        self.path = path
+        self.mtime = None
+        self.content = ''
+
+
+    def read(self):
         try:
-            r = requests.post(ADMIN_HOST, 
-                    data=json.dumps(b), timeout=2)
+            mtime = os.stat(self.path).st_mtime
+        except OSError:
+            return ''
+        if mtime != self.mtime:
+            self.mtime = mtime
+            self.content = read_file(self.path)
+        return self.content
+
+
+class LoadReader(object):
+    """Proxy load from the /metrics endpoints of pyproxy workers, rates
+    are computed between two reads."""
+
+    def __init__(self, session, port, workers=1):
+        self.session = session
+        self.urls = ['http://127.0.0.1:{}/metrics'.format(port + i)
+                for i in range(workers)]
+        self.last = None    # (time, bytes, accepted)
+
+
+    def read(self):
+        totals = {'active_tunnels': 0, 'bytes': 0, 'accepted': 0}
+        for url in self.urls:
+            try:
+                r = self.session.get(url, timeout=1)
+                r.raise_for_status()
+            except Exception as e:
+                log.warning('read proxy metrics [%s] failed: %s', url, e)
+                return None
+            for line in r.text.splitlines():
+                if line.startswith('pyproxy_active_tunnels '):
+                    totals['active_tunnels'] += int(float(line.split()[-1]))
+                elif line.startswith('pyproxy_bytes_relayed_total'):
+                    totals['bytes'] += int(float(line.split()[-1]))
+                elif line.startswith('pyproxy_connections_accepted_total '):
+                    totals['accepted'] += int(float(line.split()[-1]))
+
+        now = time.time()
+        load = {'active_tunnels': totals['active_tunnels'],
+                'bytes_per_sec': 0, 'connections_per_sec': 0}
+        if self.last:
+            elapsed = max(now - self.last[0], 0.001)
+            # counters restart with a worker, never report negative rates
+            load['bytes_per_sec'] = int(max(0,
+                    totals['bytes'] - self.last[1]) / elapsed)
+            load['connections_per_sec'] = round(max(0,
+                    totals['accepted'] - self.last[2]) / elapsed, 2)
+        self.last = (now, totals['bytes'], totals['accepted'])
+        return load
+
+
+class Heartbeat(object):
+    def __init__(self, admin=ADMIN_HOST, interval=5, proxy_port=PROXY_PORT,
+            metrics_port=METRICS_PORT, metrics_workers=1, watcher=None):
+        self.admin = admin
+        self.interval = interval
+        self.proxy_port = proxy_port
+        self.session = requests.Session()
+        # one connection per host, kept alive between heartbeats
+        adapter = HTTPAdapter(pool_connections=2, pool_maxsize=1,
+                max_retries=1)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.name = CachedFile(NAME_PATH)
+        self.watcher = watcher or AddressWatcher()
+        self.load = None
+        if metrics_port:
+            self.load = LoadReader(self.session, metrics_port,
+                    metrics_workers)
+
+
+    def payload(self):
+        b = {'type': 'vps', 'name': self.name.read(),
+                'schemes': ['HTTP', 'HTTPS'], 'ip': self.watcher.ip,
+                'port': self.proxy_port}
+        load = self.load.read() if self.load else None
+        if load:
+            b['load'] = load
+        return b
+
+
+    def send(self):
+        b = self.payload()
+        log.info('send heartbeat to admin %s', b)
+        try:
+            r = self.session.post(self.admin, data=json.dumps(b), timeout=2)
             log.info(r.status_code)
         except Exception as e:
             log.exception(e)
 
 
-run()
+    def run(self):
+        next_beat = 0
+        while True:
+            if self.watcher.wait(max(0, next_beat - time.time())):
+                next_beat = 0
+            if time.time() < next_beat:
+                continue
+            next_beat = time.time() + self.interval
+            if self.watcher.ip:
+                self.send()
+            else:
+                log.info('no ip, waiting for the network')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--admin', default=ADMIN_HOST,
+            help='url heartbeats are posted to')
+    parser.add_argument('--interval', default='5', type=float,
+            help='seconds between heartbeats when the ip does not change')
+    parser.add_argument('--proxy-port', default=PROXY_PORT, type=int)
+    parser.add_argument('--metrics-port', default=METRICS_PORT, type=int,
+            help='pyproxy --admin-port to read load from, 0 disables')
+    parser.add_argument('--metrics-workers', default='1', type=int,
+            help='pyproxy --workers, worker N serves metrics on port + N')
+    parser.add_argument('--log-file', default=LOG_PATH)
+    args = parser.parse_args()
+
+    setup_log(args.log_file)
+    lock = acquire_lock(RUN_PATH)
+    if lock is None:
+        log.info('program already running, exit..')
+        return
+    Heartbeat(admin=args.admin, interval=args.interval,
+            proxy_port=args.proxy_port, metrics_port=args.metrics_port,
+            metrics_workers=args.metrics_workers).run()
+
 
+if __name__ == '__main__':
+    main()
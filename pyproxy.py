@@ -11,20 +11,116 @@ import argparse
 import threading
 import socket
 import select
-from collections import namedtuple
+import errno
+import signal
+import math
+import bisect
+import atexit
+import base64
+import hmac
+import mmap
+import hashlib
+import subprocess
+import zlib
+import email.utils
+from collections import namedtuple, deque, OrderedDict
 if os.name != 'nt':
     import resource
+try:
+    import selectors
+except ImportError:     # python 2, reactor engine not available
+    selectors = None
 
 
 PY3 = sys.version_info[0] == 3
 if PY3: 
     from urllib import parse as urlparse
+    import queue
 else:
     import urlparse
+    import Queue as queue
 
 
 CRLF, COLON, SPACE = b'\r\n', b':', b' '
 
+WOULDBLOCK_ERRNOS = (errno.EAGAIN, errno.EWOULDBLOCK)
+CONNECTING_ERRNOS = (errno.EINPROGRESS, errno.EWOULDBLOCK, 
+        getattr(errno, 'WSAEWOULDBLOCK', errno.EWOULDBLOCK))
+
+ENGINES = ('thread', 'reactor')
+
+# accept errors of one connection aborted or refused before it was 
+# accepted, the next one is accepted at once
+ACCEPT_SKIP_ERRNOS = (errno.ECONNABORTED, errno.EPROTO, errno.EPERM)
+# accepting pauses this long after other accept errors, like running out
+# of file descriptors, instead of failing again right away
+ACCEPT_BACKOFF = 1
+
+# hot restart, the new process inherits the listening socket through the
+# first and tells the old one it listens by writing to the second
+LISTEN_FD_ENV = 'PYPROXY_LISTEN_FD'
+READY_FD_ENV = 'PYPROXY_READY_FD'
+# a proxy paused through the admin endpoint resumes by itself after this, 
+# in case whoever paused it never comes back
+MAX_PAUSE = 600
+# a tunnel waiting for another one to fetch the same response into the 
+# cache fetches it itself after this, unless a read timeout is set
+CACHE_WAIT_TIMEOUT = 60
+
+RESTART_SIGNALS = tuple(name for name in ('SIGHUP', 'SIGUSR2') 
+        if hasattr(signal, name))
+
+# how a parent proxy is chosen for each upstream connection
+PARENT_STRATEGIES = ('round-robin', 'least-conn')
+# how a local source address is chosen for each upstream connection
+EGRESS_STRATEGIES = ('round-robin', 'sticky', 'least-used')
+
+# relay modes for established CONNECT tunnels
+RELAYS = ('auto', 'copy', 'off')
+SPLICE_SIZE = 65536     # default pipe capacity on linux
+# drained splice pipes kept for the next relay with data to move
+SPARE_PIPES = 16
+
+# open files kept out of the tunnel budget for listening and admin 
+# sockets, logs, cache files and spare pipes
+RESERVED_FILES = 64
+
+# header block and chunk size line limits
+MAX_HEADER_SIZE = 65536
+MAX_LINE_SIZE = 4096
+
+# bytes queued for one peer before reads from the other peer pause
+BUFFER_HIGH_WATER = 1024 * 1024
+# small queued chunks are joined up to this size before a send
+BUFFER_SEND_SIZE = 65536
+# bytes a tunnel relays between checks of its user's byte quota
+QUOTA_CHECK_SIZE = 256 * 1024
+
+# linux/tcp.h, linux/in.h and asm/socket.h, not exported by the socket 
+# module of every python version
+TCP_FASTOPEN_CONNECT = getattr(socket, 'TCP_FASTOPEN_CONNECT', 
+        30 if sys.platform.startswith('linux') else None)
+IP_BIND_ADDRESS_NO_PORT = getattr(socket, 'IP_BIND_ADDRESS_NO_PORT', 
+        24 if sys.platform.startswith('linux') else None)
+SO_BINDTODEVICE = getattr(socket, 'SO_BINDTODEVICE', 
+        25 if sys.platform.startswith('linux') else None)
+
+# smallest token bucket burst, reads of a throttled tunnel are not made
+# smaller than this
+MIN_BURST = 4096
+
+# upper bounds in seconds of latency histogram buckets
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# status codes of responses the cache may store
+CACHEABLE_CODES = (b'200', b'203', b'300', b'301', b'404', b'410')
+# headers of one connection, not stored with cached responses
+HOP_BY_HOP_HEADERS = (b'connection', b'keep-alive', b'proxy-connection', 
+        b'proxy-authenticate', b'te', b'trailer', b'upgrade')
+
+IDEMPOTENT_METHODS = (b'GET', b'HEAD', b'OPTIONS', b'PUT', b'DELETE', 
+        b'TRACE')
+
 PROXY_TUNNEL_ESTABLISHED_RESPONSE_PKT = CRLF.join([
     b'HTTP/1.1 200 Connection established',
     CRLF
@@ -37,86 +133,232 @@ BAD_GATEWAY_RESPONSE_PKT = CRLF.join([
     CRLF
 ]) + b'Bad Gateway'
 
+GATEWAY_TIMEOUT_RESPONSE_PKT = CRLF.join([
+    b'HTTP/1.1 504 Gateway Timeout',
+    b'Content-Length: 15',
+    b'Connection: close',
+    CRLF
+]) + b'Gateway Timeout'
+
 PROXY_AUTHENTICATION_REQUIRED_RESPONSE_PKT = CRLF.join([
     b'HTTP/1.1 407 Proxy Authentication Required',
+    b'Proxy-Authenticate: Basic realm="pyproxy"',
     b'Content-Length: 29',
     b'Connection: close',
     CRLF
 ]) + b'Proxy Authentication Required'
 
+TOO_MANY_REQUESTS_RESPONSE_PKT = CRLF.join([
+    b'HTTP/1.1 429 Too Many Requests',
+    b'Content-Length: 17',
+    b'Connection: close',
+    CRLF
+]) + b'Too Many Requests'
+
+SERVICE_UNAVAILABLE_RESPONSE_PKT = CRLF.join([
+    b'HTTP/1.1 503 Service Unavailable',
+    b'Content-Length: 19',
+    b'Connection: close',
+    CRLF
+]) + b'Service Unavailable'
+
+
+class AsyncLogHandler(logging.Handler):
+    """Hand records to a writer thread owning the real handler.
+
+    Callers never block on the handler lock or on disk: records are
+    formatted by the writer, and dropped (then reported) when the queue
+    is full. The writer is started lazily in every process, so handlers
+    created before forking workers keep working in the children.
+    """
+
+    def __init__(self, target, maxsize=10000):
+        logging.Handler.__init__(self)
+        self.target = target
+        self.maxsize = maxsize
+        self.records = None
+        self.dropped = 0
+        self.pid = None
+        atexit.register(self.drain)
+
+
+    def emit(self, record):
+        if self.pid != os.getpid():
+            self._start_writer()
+        try:
+            self.records.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+    def _start_writer(self):
+        with self.lock:
+            if self.pid == os.getpid():
+                return
+            # a queue inherited through fork may have its lock held
+            self.records = queue.Queue(self.maxsize)
+            self.pid = os.getpid()
+            writer = threading.Thread(target=self._write, name='LogWriter')
+            writer.daemon = True
+            writer.start()
+
+
+    def _write(self):
+        while True:
+            record = self.records.get()
+            try:
+                if record is not None:
+                    self.target.handle(record)
+                if self.dropped:
+                    dropped, self.dropped = self.dropped, 0
+                    self.target.handle(logging.makeLogRecord({
+                            'name': 'AsyncLogHandler', 
+                            'levelno': logging.WARNING, 
+                            'levelname': 'WARNING', 
+                            'msg': 'dropped [%d] log records', 
+                            'args': (dropped,)}))
+            except Exception:
+                self.handleError(record)
+            finally:
+                self.records.task_done()
+
+
+    def drain(self):
+        """Wait until queued records are written, called at exit."""
+        if self.pid == os.getpid():
+            self.records.put(None)
+            self.records.join()
+
+
+_log_handlers = {}  # log file -> handler shared by all loggers
+
+
+def get_log_handler(log_file):
+    if log_file not in _log_handlers:
+        if log_file:
+            target = logging.handlers.RotatingFileHandler(
+                    log_file, maxBytes=1024*1024*500, backupCount=10)
+        else:
+            target = logging.StreamHandler()
+        target.setFormatter(logging.Formatter(
+                '[%(name)-18s %(threadName)-10s %(levelname)-8s '
+                '%(asctime)s] %(message)s'))
+        _log_handlers[log_file] = AsyncLogHandler(target)
+    return _log_handlers[log_file]
+
+
+_loggers = {}   # class name -> logger shared by all its objects
+
+
+def get_logger(name, log_file=None):
+    """Logger set up once per class, not once per connection: setLevel()
+    clears the cache of every logger."""
+    if name not in _loggers:
+        log = logging.getLogger(name)
+        if not log.handlers:
+            log.addHandler(get_log_handler(log_file))
+        log.setLevel(LogObject.default_level)
+        _loggers[name] = log
+    return _loggers[name]
+
 
 class LogObject(object):
-    def __init__(self, log_file=None, log_level=logging.INFO):
+    # per-chunk and per-wakeup events are logged at DEBUG, per-connection
+    # events at INFO; main() sets the level of all loggers
+    default_level = logging.INFO
+
+    __slots__ = ('log', 'log_file')
+
+    def __init__(self, log_file=None):
         self.log_file = log_file
-        self.log_level = log_level
-        self.log = logging.getLogger(self.__class__.__name__)
-        if not self.log.handlers:
-            if log_file:
-                handler = logging.handlers.RotatingFileHandler(
-                        log_file, maxBytes=1024*1024*500, backupCount=10)
-            else:
-                handler = logging.StreamHandler()
-            handler.setFormatter(logging.Formatter(
-                    '[%(name)-18s %(threadName)-10s %(levelname)-8s '
-                    '%(asctime)s] %(message)s'))
-            self.log.addHandler(handler)
-        self.log.setLevel(log_level)
+        self.log = get_logger(self.__class__.__name__, log_file)
 
 
 class ChunkParser(object):
-    """HTTP chunked encoding response parser."""
+    """HTTP chunked encoding parser.
+
+    Works on offsets into the received data, only a partial size or 
+    trailer line is kept between calls. Decoded chunks are kept in `body` 
+    unless `keep_body` is False.
+    """
 
     states = namedtuple('ChunkParserStates', (
         'WAITING_FOR_SIZE',
         'WAITING_FOR_DATA',
+        'WAITING_FOR_CRLF',
+        'WAITING_FOR_TRAILER',
         'COMPLETE'
-    ))(1, 2, 3)
+    ))(1, 2, 3, 4, 5)
 
-    def __init__(self):
+    __slots__ = ('state', 'keep_body', 'body', 'chunk', 'size', 'parts')
+
+    def __init__(self, keep_body=True):
         self.state = ChunkParser.states.WAITING_FOR_SIZE
+        self.keep_body = keep_body
         self.body = b''     # Parsed chunks
-        self.chunk = b''    # Partial chunk received
-        self.size = None    # Expected size of next following chunk
+        self.chunk = b''    # Partial size or trailer line received
+        self.size = None    # Bytes left of the current chunk
+        self.parts = []
 
 
     def parse(self, data):
-        more = True if len(data) > 0 else False
-        while more:
-            more, data = self.process(data)
-
-
-    def process(self, data):
-        if self.state == ChunkParser.states.WAITING_FOR_SIZE:
-            # Consume prior chunk in buffer
-            # in case chunk size without CRLF was received
-            data = self.chunk + data
-            self.chunk = b''
-            # Extract following chunk data size
-            line, data = HttpParser.split(data)
-            if not line:    # CRLF not received
-                self.chunk = data
-                data = b''
-            else:
-                self.size = int(line, 16)
-                self.state = ChunkParser.states.WAITING_FOR_DATA
-        elif self.state == ChunkParser.states.WAITING_FOR_DATA:
-            remaining = self.size - len(self.chunk)
-            self.chunk += data[:remaining]
-            data = data[remaining:]
-            if len(self.chunk) == self.size:
-                data = data[len(CRLF):]
-                self.body += self.chunk
+        """Returns data following the last chunk, if any."""
+        pos, end = 0, len(data)
+        while pos < end and self.state != ChunkParser.states.COMPLETE:
+            if self.state == ChunkParser.states.WAITING_FOR_DATA:
+                n = min(self.size, end - pos)
+                if self.keep_body:
+                    self.parts.append(data[pos:pos + n])
+                pos += n
+                self.size -= n
+                if self.size == 0:
+                    self.state = ChunkParser.states.WAITING_FOR_CRLF
+                continue
+
+            line, pos = self.read_line(data, pos)
+            if line is None:
+                break
+            if self.state == ChunkParser.states.WAITING_FOR_SIZE:
+                self.size = int(line.split(b';')[0], 16)
                 if self.size == 0:
-                    self.state = ChunkParser.states.COMPLETE
+                    self.state = ChunkParser.states.WAITING_FOR_TRAILER
                 else:
-                    self.state = ChunkParser.states.WAITING_FOR_SIZE
-                self.chunk = b''
+                    self.state = ChunkParser.states.WAITING_FOR_DATA
+            elif self.state == ChunkParser.states.WAITING_FOR_CRLF:
+                self.state = ChunkParser.states.WAITING_FOR_SIZE
+            elif not line:  # empty line ends the trailer
+                self.state = ChunkParser.states.COMPLETE
                 self.size = None
-        return len(data) > 0, data
+                if self.keep_body:
+                    self.body = b''.join(self.parts)
+                self.parts = []
+        return data[pos:] if pos else data
+
+
+    def read_line(self, data, pos):
+        """Returns (line without CRLF, new pos), line is None if the line 
+        is not complete yet."""
+        i = data.find(b'\n', pos)
+        if i == -1:
+            self.chunk += data[pos:]
+            if len(self.chunk) > MAX_LINE_SIZE:
+                raise ProxyError('chunk line too long')
+            return None, len(data)
+        line = data[pos:i]
+        if self.chunk:
+            line, self.chunk = self.chunk + line, b''
+        return line.rstrip(b'\r'), i + 1
 
 
 class HttpParser(LogObject):
-    """HTTP request/response parser."""
+    """HTTP request/response parser.
+
+    The header block is located with one scan and only header bytes are 
+    kept in `raw`. The body is tracked with counters: it is kept in `body`
+    if `keep_body` is True, otherwise every parse() call exposes the body 
+    bytes it received, in wire format, in `body_pieces` so the caller can
+    forward them. Bytes following a complete message are left in `buffer`.
+    """
 
     states = namedtuple('HttpParserStates', (
         'INITIALIZED',
@@ -131,104 +373,188 @@ class HttpParser(LogObject):
         'RESPONSE_PARSER'
     ))(1, 2)
 
-    def __init__(self, parser_type, log_file=''):
+    __slots__ = ('type', 'state', 'keep_body', 'raw', 'buffer', 'headers', 
+            'body', 'body_parts', 'body_pieces', 'body_size', 
+            'body_remaining', 'method', 'url', 'code', 'reason', 'version', 
+            'request_method', 'chunk_parser')
+
+    def __init__(self, parser_type, log_file='', keep_body=True):
         LogObject.__init__(self, log_file)
         assert parser_type in (HttpParser.types.REQUEST_PARSER, 
                 HttpParser.types.RESPONSE_PARSER)
         self.type = parser_type
         self.state = HttpParser.states.INITIALIZED
+        self.keep_body = keep_body
 
-        self.raw = b''
-        self.buffer = b''
+        self.raw = b''      # header block
+        self.buffer = b''   # partial header block, or bytes after message
 
         self.headers = dict()
         self.body = None
+        # parse() replaces body_pieces with a new list, body_parts is 
+        # only used when the body is kept
+        self.body_parts = [] if keep_body else None
+        self.body_pieces = ()
+        self.body_size = 0          # body bytes received, wire format
+        self.body_remaining = None  # content-length bytes still expected
 
         self.method = None
         self.url = None
         self.code = None
         self.reason = None
         self.version = None
+        # method of the request a response parser answers, HEAD 
+        # responses carry no body
+        self.request_method = None
 
         self.chunk_parser = None
 
 
     def is_chunked_encoded_response(self):
         return (self.type == HttpParser.types.RESPONSE_PARSER and 
-            b'transfer-encoding' in self.headers and 
+            self.is_chunked_encoded())
+
+
+    def is_chunked_encoded(self):
+        return (b'transfer-encoding' in self.headers and 
             self.headers[b'transfer-encoding'][1].lower() == b'chunked')
 
+
+    def expects_body(self):
+        if self.type == HttpParser.types.RESPONSE_PARSER:
+            return not self.is_bodiless_response()
+        return ((b'content-length' in self.headers and 
+                 int(self.headers[b'content-length'][1]) > 0) or 
+                self.is_chunked_encoded())
+
+
+    def is_bodiless_response(self):
+        return (self.type == HttpParser.types.RESPONSE_PARSER and 
+            (self.request_method == b'HEAD' or 
+             self.code.startswith(b'1') or 
+             self.code in (b'204', b'304') or 
+             (b'content-length' in self.headers and 
+              int(self.headers[b'content-length'][1]) == 0)))
+
+
+    def is_interim_response(self):
+        """A complete 1xx response like 100 Continue, the final response
+        follows on the same connection. 101 switches protocols instead."""
+        return (self.type == HttpParser.types.RESPONSE_PARSER and 
+            self.state == HttpParser.states.COMPLETE and 
+            self.code.startswith(b'1') and self.code != b'101')
+
+
+    def is_keep_alive(self):
+        options = [self.headers[k][1].lower() 
+                for k in (b'connection', b'proxy-connection') 
+                if k in self.headers]
+        if b'close' in options:
+            return False
+        return self.version == b'HTTP/1.1' or b'keep-alive' in options
+
         
     def parse(self, data):
-        self.raw += data
-        data = self.buffer + data
-        self.buffer = b''
-
-        more = True if len(data) > 0 else False
-        while more:
-            more, data = self.process(data)
-        self.buffer = data
-
-
-    def process(self, data):
-        self.log.debug('process [{}]'.format(self.state))
-        if (self.state in (HttpParser.states.HEADERS_COMPLETE,
-                          HttpParser.states.RCVING_BODY,
-                          HttpParser.states.COMPLETE) and 
-                (self.method == b'POST' or 
-                        self.type == HttpParser.types.RESPONSE_PARSER)):
-            if not self.body:
-                self.body = b''
+        if not self.keep_body:
+            self.body_pieces = []
+        if self.state == HttpParser.states.COMPLETE:
+            self.buffer += data
+            return
 
-            if b'content-length' in self.headers:
-                self.state = HttpParser.states.RCVING_BODY
-                self.body += data
-                if len(self.body) >= int(self.headers[b'content-length'][1]):
-                    self.state = HttpParser.states.COMPLETE
-            elif self.is_chunked_encoded_response():
-                if not self.chunk_parser:
-                    self.chunk_parser = ChunkParser()
-                self.chunk_parser.parse(data)
-                if self.chunk_parser.state == ChunkParser.states.COMPLETE:
-                    self.body = self.chunk_parser.body
-                    self.state = HttpParser.states.COMPLETE
-            return False, b''
-
-        line, remain = HttpParser.split(data)
-        if line is False:
-            return line, remain
+        if self.state < HttpParser.states.HEADERS_COMPLETE:
+            data = self.parse_head(data)
+            if data is None:
+                return
+        self.parse_body(data)
+
+
+    def parse_head(self, data):
+        """Returns bytes after the header block, None if it is incomplete."""
+        start = max(0, len(self.buffer) - 3)
+        self.buffer += data
 
         if self.state == HttpParser.states.INITIALIZED:
-            self.process_line(line)
-        elif self.state in (HttpParser.states.LINE_RCVD, 
-                HttpParser.states.RCVING_HEADERS):
+            pos = self.buffer.find(CRLF)
+            if pos == -1:
+                self.check_head_size()
+                return None
+            self.process_line(self.buffer[:pos])
+
+        end = self.buffer.find(CRLF * 2, start)
+        if end == -1:
+            # fixed bug: when client send CONNECT with 2 pkg, the header 
+            # lines may come without the final empty line
+            if (self.type == HttpParser.types.REQUEST_PARSER and 
+                    self.method == b'CONNECT' and 
+                    self.buffer.endswith(CRLF) and 
+                    self.buffer.count(CRLF) > 1):
+                end = len(self.buffer) - len(CRLF)
+                self.buffer += CRLF
+            else:
+                self.check_head_size()
+                self.state = HttpParser.states.RCVING_HEADERS
+                return None
+
+        end += len(CRLF) * 2
+        self.raw, data, self.buffer = self.buffer[:end], self.buffer[end:], b''
+        for line in self.raw.split(CRLF)[1:]:
             self.process_header(line)
+            if self.state == HttpParser.states.HEADERS_COMPLETE:
+                break
+        return data
+
+
+    def check_head_size(self):
+        if len(self.buffer) > MAX_HEADER_SIZE:
+            raise ProxyError('header block too large')
 
-        # fixed bug: when client send CONNECT with 2 pkg 
-        if (self.state == HttpParser.states.RCVING_HEADERS and 
-                self.type == HttpParser.types.REQUEST_PARSER and 
-                self.method == b'CONNECT' and 
-                not remain):
-            self.state = HttpParser.states.COMPLETE
-        elif (self.state == HttpParser.states.LINE_RCVD and 
-                self.type == HttpParser.types.REQUEST_PARSER and 
-                self.method == b'CONNECT' and 
-                remain == CRLF):
-            self.state = HttpParser.states.COMPLETE
-        elif (self.state == HttpParser.states.HEADERS_COMPLETE and 
-                self.type == HttpParser.types.REQUEST_PARSER and 
-                self.method != b'POST' and 
-                self.raw.endswith(CRLF * 2)):
-            self.state = HttpParser.states.COMPLETE
-        elif (self.state == HttpParser.states.HEADERS_COMPLETE and 
-                self.type == HttpParser.types.REQUEST_PARSER and 
-                self.method == b'POST' and 
-                (b'content-length' not in self.headers or
-                 (b'content-length' in self.headers and
-                  int(self.headers[b'content-length'][1]) == 0)) and 
-                self.raw.endswith(CRLF * 2)):
-            self.state = HttpParser.states.COMPLETE
-        return len(remain) > 0, remain
+
+    def parse_body(self, data):
+        if self.state == HttpParser.states.HEADERS_COMPLETE:
+            if not self.expects_body():
+                self.complete(data)
+                return
+            self.state = HttpParser.states.RCVING_BODY
+            if b'content-length' in self.headers:
+                self.body_remaining = int(self.headers[b'content-length'][1])
+            elif self.is_chunked_encoded():
+                self.chunk_parser = ChunkParser(self.keep_body)
+            # otherwise a response body lasts until the server closes
+
+        if not data:
+            return
+        if self.chunk_parser:
+            used = len(data) - len(self.chunk_parser.parse(data))
+        elif self.body_remaining is not None:
+            used = min(len(data), self.body_remaining)
+            self.body_remaining -= used
+        else:
+            used = len(data)
+
+        piece = data if used == len(data) else data[:used]
+        self.body_size += used
+        if not self.keep_body:
+            self.body_pieces.append(piece)
+        elif not self.chunk_parser:
+            self.body_parts.append(piece)
+
+        if ((self.chunk_parser and 
+                self.chunk_parser.state == ChunkParser.states.COMPLETE) or
+                self.body_remaining == 0):
+            self.complete(data[used:])
+
+
+    def complete(self, rest):
+        self.state = HttpParser.states.COMPLETE
+        # bytes beyond the message (a pipelined request, or garbage after
+        # a response) are left in `buffer`
+        self.buffer = rest
+        if self.keep_body and self.body_size:
+            if self.chunk_parser:
+                self.body = self.chunk_parser.body
+            else:
+                self.body = b''.join(self.body_parts)
+            self.body_parts = []
 
 
     def process_line(self, data):
@@ -238,8 +564,8 @@ class HttpParser(LogObject):
             self.method = line[0].upper()
             self.url = urlparse.urlsplit(line[1])
             self.version = line[2]
-            self.log.debug('[{}][{}][{}]'.format(self.method, self.url, 
-                    self.version))
+            self.log.debug('[%s][%s][%s]', self.method, self.url, 
+                    self.version)
         else:
             self.version = line[0]
             self.code = line[1]
@@ -248,12 +574,9 @@ class HttpParser(LogObject):
 
 
     def process_header(self, data):
-        self.log.debug('process_header [{}]'.format(data))
         if len(data) == 0:
-            if self.state == HttpParser.states.RCVING_HEADERS:
-                self.state = HttpParser.states.HEADERS_COMPLETE
-            elif self.state == HttpParser.states.LINE_RCVD:
-                self.state = HttpParser.states.RCVING_HEADERS
+            # message without any header ends right after its first line
+            self.state = HttpParser.states.HEADERS_COMPLETE
         else:
             self.state = HttpParser.states.RCVING_HEADERS
             parts = data.split(COLON)
@@ -276,23 +599,24 @@ class HttpParser(LogObject):
         return url
 
 
-    def build(self, del_headers=None, add_headers=None):
-        req = b' '.join([self.method, self.build_url(), self.version])
-        req += CRLF
+    def build(self, del_headers=None, add_headers=None, absolute_url=False):
+        """Absolute urls are kept for requests sent to a parent proxy."""
+        url = self.url.geturl() if absolute_url else self.build_url()
+        lines = [b' '.join([self.method, url, self.version])]
 
         if not del_headers:
             del_headers = []
         for k in self.headers:
             if k not in del_headers:
-                req += self.build_header(self.headers[k][0], 
-                        self.headers[k][1]) + CRLF
+                lines.append(self.build_header(self.headers[k][0], 
+                        self.headers[k][1]))
 
         if not add_headers:
             add_headers = []
         for k in add_headers:
-            req += self.build_header(k[0], k[1]) + CRLF
+            lines.append(self.build_header(k[0], k[1]))
 
-        req += CRLF
+        req = CRLF.join(lines) + CRLF * 2
         if self.body:
             req += self.body
 
@@ -314,30 +638,186 @@ class HttpParser(LogObject):
         return line, data
 
 
+class Buffer(object):
+    """Outgoing bytes kept as a queue of chunks.
+
+    Appending does not copy queued data and sent bytes are consumed 
+    through memoryview slices, so cost does not grow with buffer size.
+    The queue only exists while data is queued, most connections are 
+    idle with an empty buffer.
+    """
+
+    __slots__ = ('chunks', 'offset', 'size')
+
+    def __init__(self):
+        self.chunks = None
+        self.offset = 0     # bytes of first chunk already consumed
+        self.size = 0
+
+
+    def __len__(self):
+        return self.size
+
+
+    def append(self, data):
+        if data:
+            if self.chunks is None:
+                self.chunks = deque()
+            self.chunks.append(data)
+            self.size += len(data)
+
+
+    def peek(self):
+        """Returns the next bytes to send, at most BUFFER_SEND_SIZE unless
+        the first chunk alone is larger."""
+        first = self.chunks[0]
+        if (len(self.chunks) > 1 and 
+                len(first) - self.offset < BUFFER_SEND_SIZE):
+            # join small chunks so one send() moves more data
+            parts, size = [first[self.offset:]], len(first) - self.offset
+            self.chunks.popleft()
+            while (self.chunks and 
+                    size + len(self.chunks[0]) <= BUFFER_SEND_SIZE):
+                chunk = self.chunks.popleft()
+                parts.append(chunk)
+                size += len(chunk)
+            first = b''.join(parts)
+            self.chunks.appendleft(first)
+            self.offset = 0
+        return memoryview(first)[self.offset:]
+
+
+    def consume(self, n):
+        self.size -= n
+        while n:
+            left = len(self.chunks[0]) - self.offset
+            if n < left:
+                self.offset += n
+                return
+            n -= left
+            self.chunks.popleft()
+            self.offset = 0
+        if not self.size:
+            self.chunks = None
+
+
+class SocketOptions(LogObject):
+    """Socket options profile of client, upstream and listening sockets.
+
+    Options the platform lacks are left out with a warning. Failing to set
+    an option is logged and never fails the connection.
+    """
+
+    def __init__(self, nodelay=True, keepalive=0, keepalive_interval=10, 
+            keepalive_count=3, rcvbuf=0, sndbuf=0, fastopen=0, 
+            fastopen_connect=False, defer_accept=0, log_file=''):
+        LogObject.__init__(self, log_file)
+        # (level, name, value) set on every connected socket
+        self.options = []
+        if nodelay:
+            self._add(self.options, 'IPPROTO_TCP', 'TCP_NODELAY', 1)
+        if keepalive:
+            self._add(self.options, 'SOL_SOCKET', 'SO_KEEPALIVE', 1)
+            # TCP_KEEPALIVE is the idle time on macos
+            self._add(self.options, 'IPPROTO_TCP', 'TCP_KEEPIDLE' 
+                    if hasattr(socket, 'TCP_KEEPIDLE') else 'TCP_KEEPALIVE', 
+                    keepalive)
+            self._add(self.options, 'IPPROTO_TCP', 'TCP_KEEPINTVL', 
+                    keepalive_interval)
+            self._add(self.options, 'IPPROTO_TCP', 'TCP_KEEPCNT', 
+                    keepalive_count)
+        # buffer sizes must be set before the handshake to size the window
+        # scale, accepted sockets inherit them from the listening socket
+        self.buffers = []
+        if rcvbuf:
+            self._add(self.buffers, 'SOL_SOCKET', 'SO_RCVBUF', rcvbuf)
+        if sndbuf:
+            self._add(self.buffers, 'SOL_SOCKET', 'SO_SNDBUF', sndbuf)
+        self.listen_options = list(self.buffers)
+        if fastopen:
+            self._add(self.listen_options, 'IPPROTO_TCP', 'TCP_FASTOPEN', 
+                    fastopen)
+        if defer_accept:
+            self._add(self.listen_options, 'IPPROTO_TCP', 'TCP_DEFER_ACCEPT',
+                    defer_accept)
+        self.fastopen_connect = None
+        if fastopen_connect:
+            if TCP_FASTOPEN_CONNECT is None:
+                self.log.warning('TCP_FASTOPEN_CONNECT not supported')
+            else:
+                self.fastopen_connect = (socket.IPPROTO_TCP, 
+                        TCP_FASTOPEN_CONNECT, 1)
+
+
+    def _add(self, options, level, name, value):
+        if not hasattr(socket, name):
+            self.log.warning('%s not supported', name)
+            return
+        options.append((getattr(socket, level), getattr(socket, name), value))
+
+
+    def _set(self, sock, options):
+        for level, name, value in options:
+            try:
+                sock.setsockopt(level, name, value)
+            except socket.error as e:
+                self.log.warning('setsockopt [%d] [%d] failed: %s', 
+                        level, name, e)
+
+
+    def apply_listen(self, sock):
+        self._set(sock, self.listen_options)
+
+
+    def apply_accepted(self, sock):
+        self._set(sock, self.options)
+
+
+    def apply_connect(self, sock, fastopen=False):
+        """Before connect. With `fastopen` the first send carries the SYN
+        and the request, connect() then returns before the handshake."""
+        self._set(sock, self.buffers + self.options)
+        if fastopen and self.fastopen_connect:
+            self._set(sock, [self.fastopen_connect])
+
+
 class Connection(LogObject):
     """TCP server/client connection abstraction."""
 
+    __slots__ = ('conn', 'buffer', 'high_water', 'closed', 'what')
+
     def __init__(self, what, log_file=''):
         LogObject.__init__(self, log_file)
         self.conn = None
-        self.buffer = b''
+        self.buffer = Buffer()
+        self.high_water = BUFFER_HIGH_WATER
         self.closed = False
         self.what = what  # server or client
 
 
     def send(self, data):
         # TODO: Gracefully handle BrokenPipeError exceptions
-        return self.conn.send(data)
+        try:
+            return self.conn.send(data)
+        except socket.error as e:
+            if e.args[0] in WOULDBLOCK_ERRNOS:
+                return 0
+            raise
 
 
     def recv(self, bufsiz=8192):
+        """Returns None if peer closed, b'' if no data available yet."""
         try:
             data = self.conn.recv(bufsiz)
-            self.log.info('rcvd [{}] bytes from [{}]'.format(
-                    len(data), self.what))
+            self.log.debug('rcvd [%d] bytes from [%s]', len(data), self.what)
             if len(data) == 0:
                 return None
             return data
+        except socket.error as e:
+            if e.args[0] in WOULDBLOCK_ERRNOS:
+                return b''
+            self.log.exception(e)
+            return None
         except Exception as e:
             self.log.exception(e)
             return None
@@ -356,268 +836,3632 @@ class Connection(LogObject):
         return self.buffer_size() > 0
 
 
+    def is_full(self):
+        """Peer feeding this buffer must not be read until it drains."""
+        return self.buffer_size() >= self.high_water
+
+
     def queue(self, data):
-        self.buffer += data
+        self.buffer.append(data)
 
 
     def flush(self):
-        sent = self.send(self.buffer)
-        self.buffer = self.buffer[sent:]
+        if not self.buffer:
+            return
+        sent = self.send(self.buffer.peek())
+        self.buffer.consume(sent)
 
 
 class Server(Connection):
+    __slots__ = ('addr', 'connecting', 'addrinfos', 'attempts', 'parallel', 
+            'health', 'connect_started', 'error', 'sockopts', 'fastopen', 
+            'source')
+
     def __init__(self, host, port, log_file=''):
         super(Server, self).__init__('server', log_file)
         self.addr = (host, int(port))
+        self.connecting = False
+        self.addrinfos = []
+        self.attempts = {}  # socket being connected -> sockaddr
+        self.parallel = 1
+        self.health = None
+        self.connect_started = None
+        self.error = None
+        self.sockopts = None
+        self.fastopen = False
+        self.source = None  # Egress connections are made from
 
     def __del__(self):
-        if self.conn:
+        if self.conn or self.attempts:
             self.close()
 
-    def connect(self):
-        self.conn = socket.create_connection((self.addr[0], self.addr[1]))
+    def close(self):
+        for conn in self.attempts:
+            conn.close()
+        self.attempts = {}
+        if self.conn:
+            self.conn.close()
+        self.closed = True
 
+    def connect(self, addrinfos=None, parallel=1, health=None, 
+            sockopts=None, fastopen=False, source=None):
+        """Start non-blocking connects to resolved addresses.
+
+        Addresses are resolved inline unless `addrinfos` are given. Up to
+        `parallel` attempts run at once, alternating address families, and
+        a failed attempt is replaced by the next address. The first
+        attempt to succeed becomes `conn`, `connecting` stays True until
+        then. `sockopts` are set on every attempt, with `fastopen` data
+        queued before the connect completes goes out with the SYN. 
+        Attempts are made from the `source` Egress if given.
+        """
+        if addrinfos is None:
+            addrinfos = socket.getaddrinfo(self.addr[0], self.addr[1], 
+                    0, socket.SOCK_STREAM)
+        if source:
+            addrinfos = source.filter(addrinfos)
+        if health:
+            addrinfos = health.order(addrinfos)
+        self.addrinfos = interleave_families(addrinfos)
+        self.parallel = max(1, parallel)
+        self.health = health
+        self.sockopts = sockopts
+        self.fastopen = fastopen
+        self.source = source
+        self.connect_started = time.time()
+        self.connecting = True
+        self._start_attempts()
+
+    def finish_connect(self, ready):
+        """Check attempts reported writable, raises if all failed."""
+        for conn in ready:
+            sa = self.attempts.pop(conn, None)
+            if sa is None:
+                continue
+            err = conn.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err == 0:
+                self._connected(conn, sa)
+                return
+            conn.close()
+            self._failed(sa, socket.error(err, os.strerror(err)))
+        self._start_attempts()
+
+    def connect_expired(self, timeout):
+        if not (self.connecting and timeout and 
+                time.time() - self.connect_started > timeout):
+            return False
+        for sa in self.attempts.values():
+            self._failed(sa, socket.error(errno.ETIMEDOUT, 'connect timeout'))
+        return True
+
+    def _start_attempts(self):
+        while self.connecting and len(self.attempts) < self.parallel and \
+                self.addrinfos:
+            af, socktype, proto, _, sa = self.addrinfos.pop(0)
+            conn = socket.socket(af, socktype, proto)
+            conn.setblocking(False)
+            if self.sockopts:
+                self.sockopts.apply_connect(conn, self.fastopen)
+            if self.source:
+                try:
+                    self.source.bind(conn)
+                except socket.error as e:
+                    conn.close()
+                    self._failed(sa, e)
+                    continue
+            err = conn.connect_ex(sa)
+            if err == 0:
+                self._connected(conn, sa)
+            elif err in CONNECTING_ERRNOS:
+                self.attempts[conn] = sa
+            else:
+                conn.close()
+                self._failed(sa, socket.error(err, os.strerror(err)))
+        if self.connecting and not self.attempts:
+            raise self.error or socket.error('no address to connect')
 
-class Client(Connection):
-    def __init__(self, conn, addr, log_file=''):
-        super(Client, self).__init__('client', log_file)
+    def _connected(self, conn, sa):
         self.conn = conn
-        self.addr = addr
-
+        self.connecting = False
+        for other in self.attempts:
+            other.close()
+        self.attempts = {}
+        self.addrinfos = []
+        if self.health:
+            self.health.success(sa)
+
+    def _failed(self, sa, error):
+        self.error = error
+        if self.health:
+            self.health.failure(sa)
+
+
+def interleave_families(addrinfos):
+    """Alternate IPv6 and IPv4 addresses, starting with the family of the 
+    first one (RFC 8305)."""
+    v6 = [ai for ai in addrinfos if ai[0] == getattr(socket, 'AF_INET6', None)]
+    v4 = [ai for ai in addrinfos if ai[0] != getattr(socket, 'AF_INET6', None)]
+    if not v6 or not v4:
+        return list(addrinfos)
+    first, second = (v6, v4) if addrinfos[0] in v6 else (v4, v6)
+    result = []
+    for i in range(max(len(first), len(second))):
+        result.extend(first[i:i + 1] + second[i:i + 1])
+    return result
+
+
+class AddressHealth(object):
+    """Connect failures per destination address.
+
+    An address failing `threshold` times in a row is skipped for `backoff`
+    seconds, doubled on every further failure up to `max_backoff`. Skipped
+    addresses are still tried when no other address is left.
+    """
 
-class ProxyError(Exception):
-    pass
+    def __init__(self, threshold=3, backoff=10, max_backoff=300, 
+            max_entries=10000):
+        self.threshold = threshold
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.stats = OrderedDict()  # sockaddr -> [failures, skip until]
 
 
-class ProxyConnectionFailed(ProxyError):
-    def __init__(self, host, port, reason):
-        self.host = host
-        self.port = port
-        self.reason = reason
+    def failure(self, sa):
+        with self.lock:
+            stat = self.stats.pop(sa, None) or [0, 0]
+            stat[0] += 1
+            if stat[0] >= self.threshold:
+                backoff = self.backoff * 2 ** (stat[0] - self.threshold)
+                stat[1] = time.time() + min(backoff, self.max_backoff)
+            self.stats[sa] = stat
+            while len(self.stats) > self.max_entries:
+                self.stats.popitem(last=False)
 
-    def __str__(self):
-        return '<ProxyConnectionFailed - {}:{} - {}>'.format(self.host, 
-                self.port, self.reason)
 
+    def success(self, sa):
+        with self.lock:
+            self.stats.pop(sa, None)
 
-class ProxyAuthenticationFailed(ProxyError):
-    pass
 
+    def is_skipped(self, sa):
+        stat = self.stats.get(sa)
+        return bool(stat and stat[1] > time.time())
 
-def get_response_pkt_by_exception(e):
-    if e.__class__.__name__ == 'ProxyAuthenticationFailed':
-        return PROXY_AUTHENTICATION_REQUIRED_RESPONSE_PKT
-    if e.__class__.__name__ == 'ProxyConnectionFailed':
-        return BAD_GATEWAY_RESPONSE_PKT
 
+    def order(self, addrinfos):
+        healthy = [ai for ai in addrinfos if not self.is_skipped(ai[4])]
+        return healthy or list(addrinfos)
 
-class Tunnel(threading.Thread, LogObject):
-    """ act as a tunnel between client and server.
-    """
 
-    def __init__(self, client, server_recvbuf_size=8192, 
-            client_recvbuf_size=8192, log_file=''):
-        LogObject.__init__(self, log_file=log_file)
-        threading.Thread.__init__(self)
-        self.daemon = True
+class Lookup(object):
+    """Pending or finished name resolution, or response cache fill."""
 
-        self.start_time = time.time()
-        self.last_activity = self.start_time
-        self.client = client
-        self.client_recvbuf_size = client_recvbuf_size
-        self.server = None
-        self.server_recvbuf_size = server_recvbuf_size
+    def __init__(self, key):
+        self.key = key
+        self.result = None
+        self.error = None
+        self.event = threading.Event()
+        self.lock = threading.Lock()
+        self.callbacks = []
 
-        self.request = HttpParser(HttpParser.types.REQUEST_PARSER, self.log_file)
-        self.response = HttpParser(HttpParser.types.RESPONSE_PARSER, self.log_file)
 
+    def done(self):
+        return self.event.is_set()
 
-    def _is_inactive(self):
-        return (time.time() - self.last_activity) > 30
 
+    def wait(self, timeout=None):
+        """Returns addrinfos, raises the resolution error or socket.timeout
+        if not done within `timeout` seconds."""
+        if not self.event.wait(timeout):
+            raise socket.timeout('lookup [{}] timed out'.format(self.key))
+        if self.error:
+            raise self.error
+        return self.result
 
-    def run(self):
-        try:
-            self._process()
-        except Exception as e:
-            self.log.exception(e)
-        finally:
-            self.log.info('close client connection')
-            self.client.close()
-    
-    
-    def _process(self):
-        while True:
-            self.log.debug('_process')
-            rlist, wlist, xlist = self._get_waitable_lists()
-            r, w, x = select.select(rlist, wlist, xlist, 1)
 
-            self._process_wlist(w)
-            if self._process_rlist(r):
-                break
+    def add_done_callback(self, callback):
+        """Callback runs in the resolver thread, or now if done."""
+        with self.lock:
+            if not self.done():
+                self.callbacks.append(callback)
+                return
+        callback(self)
 
-            if self.client.buffer_size() == 0:
-                if self.response.state == HttpParser.states.COMPLETE:
-                    self.log.info('client buffer empty and response complete')
-                    break
 
-                if self._is_inactive():
-                    self.log.info('client buffer empty and inactivity')
-                    break
+    def set(self, result, error):
+        with self.lock:
+            self.result, self.error = result, error
+            self.event.set()
+            callbacks, self.callbacks = self.callbacks, []
+        for callback in callbacks:
+            callback(self)
 
 
-    def _get_waitable_lists(self):
-        rlist, wlist, xlist = [self.client.conn], [], []
-        if self.client.has_buffer():
-            wlist.append(self.client.conn)
-        if self.server and not self.server.closed:
-            rlist.append(self.server.conn)
-        if self.server and not self.server.closed and self.server.has_buffer():
-            wlist.append(self.server.conn)
-        return rlist, wlist, xlist
+class Resolver(LogObject):
+    """getaddrinfo on a pool of threads with an LRU cache.
 
+    Successful lookups are cached for `ttl` seconds and failures for 
+    `negative_ttl` seconds (getaddrinfo does not expose record TTLs). 
+    Concurrent lookups of the same name share one getaddrinfo call.
+    """
 
-    def _process_wlist(self, w):
-        if self.client.conn in w:
-            self.log.info('client is ready for writes, flushing client buffer')
-            self.client.flush()
+    def __init__(self, workers=4, ttl=60, negative_ttl=10, cache_size=1024, 
+            log_file=''):
+        LogObject.__init__(self, log_file=log_file)
+        self.workers = workers
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.cache_size = cache_size
+        self.cache = OrderedDict()  # key -> (expires, addrinfos, error)
+        self.pending = {}   # key -> Lookup
+        self.lock = threading.Lock()
+        self.jobs = queue.Queue()
+        self.pid = None     # workers are started lazily, after any fork
+
+
+    def resolve(self, host, port):
+        key = (host, int(port))
+        with self.lock:
+            entry = self.cache.pop(key, None)
+            if entry and entry[0] > time.time():
+                self.cache[key] = entry     # most recently used last
+                lookup = Lookup(key)
+                lookup.set(entry[1], entry[2])
+                return lookup
+
+            lookup = self.pending.get(key)
+            if lookup:
+                return lookup
+            lookup = self.pending[key] = Lookup(key)
+            self._start_workers()
+        self.jobs.put(key)
+        return lookup
+
+
+    def _start_workers(self):
+        if self.pid == os.getpid():
+            return
+        self.pid = os.getpid()
+        for i in range(self.workers):
+            worker = threading.Thread(target=self._work, 
+                    name='Resolver-{}'.format(i))
+            worker.daemon = True
+            worker.start()
 
-        if self.server and not self.server.closed and self.server.conn in w:
-            self.log.info('server is ready for writes, flushing server buffer')
-            self.server.flush()
-    
-    
-    def _process_rlist(self, r):
-        """Returns True if connection to client must be closed."""
-        if self.client.conn in r:
-            self.log.info('client is ready for reads')
-            self.last_activity = time.time()
-            data = self.client.recv(self.client_recvbuf_size)
-            if not data:
-                self.log.info('client closed connection')
-                return True
 
+    def _work(self):
+        while True:
+            key = self.jobs.get()
             try:
-                self._process_request(data)
-            except (ProxyAuthenticationFailed, ProxyConnectionFailed) as e:
-                self.log.exception(e)
-                self.client.queue(get_response_pkt_by_exception(e))
-                self.client.flush()
-                return True
+                result, error = socket.getaddrinfo(key[0], key[1], 0, 
+                        socket.SOCK_STREAM), None
+                ttl = self.ttl
+            except Exception as e:
+                result, error = None, e
+                ttl = self.negative_ttl
+
+            with self.lock:
+                self.cache[key] = (time.time() + ttl, result, error)
+                while len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+                lookup = self.pending.pop(key)
+            lookup.set(result, error)
+
+
+class UpstreamPool(LogObject):
+    """Idle keep-alive connections to origin servers, keyed by (host, port)
+    and the egress they were made from.
+
+    At most `max_per_host` idle connections are kept for one origin and 
+    `max_idle` for all of them. Connections idle for more than 
+    `idle_timeout` seconds are closed.
+    """
 
-        if self.server and not self.server.closed and self.server.conn in r:
-            self.log.info('server is ready for reads')
-            self.last_activity = time.time()
-            data = self.server.recv(self.server_recvbuf_size)
-            if not data:
-                self.log.info('server closed connection')
-                self.server.close()
-            else:
-                self._process_response(data)
-        return False
+    def __init__(self, max_idle=100, max_per_host=8, idle_timeout=30, 
+            log_file=''):
+        LogObject.__init__(self, log_file=log_file)
+        self.max_idle = max_idle
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self.lock = threading.Lock()
+        self.idle = {}  # (host, port, egress) -> [(server, released time)]
+        self.size = 0
+        self.last_evict = time.time()
 
 
-    def _process_request(self, data):
-        self.log.debug('_process_request [{}]'.format(self.request.state))
-        # redirect data to server once connected
-        if self.server and not self.server.closed:
-            self.server.queue(data)
+    @staticmethod
+    def key(host, port, source=None):
+        return (host.lower(), int(port), source)
+
+
+    def acquire(self, host, port, source=None):
+        """Returns an idle connected Server, or None."""
+        key = UpstreamPool.key(host, port, source)
+        with self.lock:
+            self._evict(time.time())
+            servers = self.idle.get(key)
+            while servers:
+                server, _ = servers.pop()
+                self.size -= 1
+                if UpstreamPool.is_alive(server):
+                    return server
+                server.close()
+        return None
+
+
+    def release(self, server):
+        """Keep server for reuse. Returns False if it was closed instead."""
+        if server.closed or server.connecting or server.has_buffer():
+            server.close()
+            return False
+
+        key = UpstreamPool.key(server.addr[0], server.addr[1], server.source)
+        now = time.time()
+        with self.lock:
+            self._evict(now)
+            servers = self.idle.setdefault(key, [])
+            if (len(servers) >= self.max_per_host or 
+                    self.size >= self.max_idle):
+                server.close()
+                return False
+            servers.append((server, now))
+            self.size += 1
+        return True
+
+
+    def _evict(self, now):
+        if now - self.last_evict < 1:
             return
+        self.last_evict = now
+        for key in list(self.idle):
+            servers = self.idle[key]
+            while servers and now - servers[0][1] > self.idle_timeout:
+                servers.pop(0)[0].close()
+                self.size -= 1
+            if not servers:
+                del self.idle[key]
 
-        # parse http request
-        self.request.parse(data)
 
-        if self.request.state == HttpParser.states.COMPLETE:
-            self.log.info('request parser is in state complete')
-            if self.request.method == b'CONNECT':
-                host, port = self.request.url.path.split(COLON)
-            elif self.request.url:
-                host = self.request.url.hostname
-                port = self.request.url.port if self.request.url.port else 80
-            else:
-                raise Exception('Invalid request\n%s' % self.request.raw)
+    @staticmethod
+    def is_alive(server):
+        """An idle connection must have nothing to read: no EOF, no data."""
+        try:
+            server.conn.recv(1, socket.MSG_PEEK)
+        except socket.error as e:
+            return e.args[0] in WOULDBLOCK_ERRNOS
+        return False
 
-            self.server = Server(host, port, self.log_file)
-            try:
-                self.log.info('connecting server [{}]:[{}]'.format(host, port))
-                self.server.connect()
-            except Exception as e:  # TimeoutError, socket.gaierror
-                self.log.exception(e)
-                self.server.closed = True
-                raise ProxyConnectionFailed(host, port, repr(e))
 
-            if self.request.method == b'CONNECT':
-                self.client.queue(PROXY_TUNNEL_ESTABLISHED_RESPONSE_PKT)
-            else:
-                self.server.queue(self.request.build(
-                    del_headers=[b'proxy-authorization', b'proxy-connection', 
-                            b'connection', b'keep-alive'],
-                    add_headers=[(b'Connection', b'Close')]
-                ))
+class CacheEntry(object):
+    """Stored response, `body` is in wire format and may be a mmap."""
 
+    def __init__(self, head, body, ttl, etag=None, last_modified=None):
+        self.head = head    # status line and headers, ends with CRLF CRLF
+        self.body = body
+        self.ttl = ttl
+        self.stored = time.time()
+        self.expires = self.stored + ttl
+        self.etag = etag
+        self.last_modified = last_modified
+        self.path = None    # file of the disk tier
 
-    def _process_response(self, data):
-        if not self.request.method == b'CONNECT':
-            self.response.parse(data)
-        self.client.queue(data)
 
-    
-class TCPServer(LogObject):
-    def __init__(self, hostname='0.0.0.0', port=8899, backlog=100, log_file=''):
+    def size(self):
+        return len(self.head) + len(self.body)
+
+
+    def is_fresh(self):
+        return time.time() < self.expires
+
+
+    def has_validators(self):
+        return bool(self.etag or self.last_modified)
+
+
+class ResponseCache(LogObject):
+    """Shared cache of plain HTTP GET responses.
+
+    Responses are keyed by Host and request path, stored when 
+    Cache-Control/Expires make them fresh for some time (no heuristic 
+    freshness) and revalidated with ETag/Last-Modified once stale. Entries
+    live in a memory LRU of `max_size` bytes; with `cache_dir`, entries 
+    evicted from memory move to files mapped with mmap, in an LRU of
+    `disk_size` bytes. Only one tunnel fetches a missing response, others
+    asking for it meanwhile wait for its result.
+    """
+
+    def __init__(self, max_size=64 * 1024 * 1024, max_entry_size=1024 * 1024,
+            cache_dir='', disk_size=1024 * 1024 * 1024, log_file=''):
         LogObject.__init__(self, log_file=log_file)
-        self.hostname = hostname
-        self.port = port
-        self.backlog = backlog
-        self.socket = None
+        self.max_size = max_size
+        self.max_entry_size = max_entry_size
+        self.cache_dir = cache_dir
+        self.disk_size = disk_size
+        self.lock = threading.Lock()
+        self.memory = OrderedDict()     # key -> CacheEntry
+        self.memory_used = 0
+        self.disk = OrderedDict()       # key -> CacheEntry with mmap body
+        self.disk_used = 0
+        self.pending = {}               # key -> Lookup of the fetching tunnel
+        if cache_dir:
+            if not os.path.isdir(cache_dir):
+                os.makedirs(cache_dir)
+            for name in os.listdir(cache_dir):  # left by a previous run
+                if name.endswith('.cache'):
+                    os.unlink(os.path.join(cache_dir, name))
 
 
-    def handle(self, client):
-        raise NotImplementedError()
+    @staticmethod
+    def key(request):
+        host = request.headers.get(b'host', (None, request.url.netloc))[1]
+        return (host.lower(), request.build_url())
 
 
-    def run(self):
-        try:
-            self.log.info('Starting server on port %d' % self.port)
-            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            self.socket.bind((self.hostname, self.port))
-            self.socket.listen(self.backlog)
-            while True:
-                conn, addr = self.socket.accept()
-                client = Client(conn, addr, self.log_file)
-                self.handle(client)
-        except Exception as e:
-            self.log.exception(e)
-        finally:
-            self.log.info('closing server socket')
-            self.socket.close()
+    @staticmethod
+    def cache_control(parser):
+        directives = {}
+        value = parser.headers.get(b'cache-control', (None, b''))[1]
+        for directive in value.lower().split(b','):
+            name, _, arg = directive.strip().partition(b'=')
+            if name:
+                directives[name] = arg.strip(b'"')
+        return directives
 
 
-class PyProxy(TCPServer):
-    def __init__(self, hostname='0.0.0.0', port=8899, backlog=100,
-                 server_recvbuf_size=8192, client_recvbuf_size=8192, 
-                 log_file=''):
-        TCPServer.__init__(self, hostname, port, backlog, log_file)
-        self.client_recvbuf_size = client_recvbuf_size
-        self.server_recvbuf_size = server_recvbuf_size
+    @staticmethod
+    def is_cacheable_request(request):
+        return (request.method == b'GET' and 
+                not request.expects_body() and 
+                b'authorization' not in request.headers and 
+                b'no-store' not in ResponseCache.cache_control(request))
 
 
-    def handle(self, client):
-        self.log.info('handle request from [{}]'.format(client.addr))
-        tunnel = Tunnel(client,
-                      server_recvbuf_size=self.server_recvbuf_size,
-                      client_recvbuf_size=self.client_recvbuf_size, 
-                      log_file=self.log_file)
-        tunnel.start()
+    @staticmethod
+    def forces_refresh(request):
+        pragma = request.headers.get(b'pragma', (None, b''))[1].lower()
+        return (b'no-cache' in ResponseCache.cache_control(request) or 
+                pragma == b'no-cache')
 
 
-def set_open_file_limit(limit):
-    if os.name != 'nt':  # resource module not available on Windows OS
-        soft_limit, hard_limit = resource.getrlimit(resource.RLIMIT_NOFILE)
-        if soft_limit < limit < hard_limit:
+    @staticmethod
+    def freshness(response):
+        """Seconds the response stays fresh, None if it must not be stored."""
+        directives = ResponseCache.cache_control(response)
+        if b'no-store' in directives or b'private' in directives:
+            return None
+        if b'no-cache' in directives:
+            return 0
+        for name in (b's-maxage', b'max-age'):
+            if name in directives:
+                try:
+                    return max(0, int(directives[name]))
+                except ValueError:
+                    return 0
+        if b'expires' in response.headers:
+            expires = parse_http_date(response.headers[b'expires'][1])
+            date = parse_http_date(
+                    response.headers.get(b'date', (None, b''))[1])
+            if expires is None:
+                return 0
+            return max(0, expires - (date or time.time()))
+        return None
+
+
+    @staticmethod
+    def is_storable(response):
+        if (response.code not in CACHEABLE_CODES or 
+                b'set-cookie' in response.headers or 
+                b'vary' in response.headers):
+            return False
+        ttl = ResponseCache.freshness(response)
+        return ttl is not None and (ttl > 0 or 
+                b'etag' in response.headers or 
+                b'last-modified' in response.headers)
+
+
+    def acquire(self, key):
+        """Returns (entry, pending).
+
+        A fresh entry is served. Otherwise either another tunnel fetches
+        the response and `pending` is set once it is done, or the caller
+        fetches it and must `store` or `abandon` it; a stale entry is 
+        returned to revalidate.
+        """
+        with self.lock:
+            entry = self._get(key)
+            if entry and entry.is_fresh():
+                return entry, None
+            pending = self.pending.get(key)
+            if pending is None:
+                self.pending[key] = Lookup(key)
+            return entry, pending
+
+
+    def store(self, key, response, body):
+        ttl = ResponseCache.freshness(response) or 0
+        lines = [b' '.join([response.version, response.code, response.reason])]
+        for k, (name, value) in response.headers.items():
+            if k not in HOP_BY_HOP_HEADERS and k != b'age':
+                lines.append(name + b': ' + value)
+        entry = CacheEntry(CRLF.join(lines) + CRLF * 2, body, ttl, 
+                response.headers.get(b'etag', (None, None))[1],
+                response.headers.get(b'last-modified', (None, None))[1])
+        demoted = ()
+        with self.lock:
+            self._remove(key)
+            if entry.size() <= self.max_entry_size:
+                demoted = self._put(key, entry)
+        # files are written out of the lock, other tunnels go on meanwhile
+        for old_key, old in demoted:
+            self._write(old_key, old)
+        self._done(key, entry)
+
+
+    def refresh(self, key, entry, response):
+        """Stale entry was revalidated with a 304 response."""
+        ttl = ResponseCache.freshness(response)
+        if ttl is not None:
+            entry.ttl = ttl
+        entry.stored = time.time()
+        entry.expires = entry.stored + entry.ttl
+        self._done(key, entry)
+
+
+    def abandon(self, key):
+        """Fetching tunnel gave up, waiting tunnels fetch themselves."""
+        self._done(key, None)
+
+
+    def render(self, entry, request):
+        """Returns head and body to send for a request answered from 
+        cache, a 304 if the client already has it."""
+        age = b'Age: ' + str(int(time.time() - entry.stored)).encode() + CRLF
+        etag = request.headers.get(b'if-none-match', (None, None))[1]
+        if etag and entry.etag and etag in (entry.etag, b'*'):
+            head = CRLF.join([b'HTTP/1.1 304 Not Modified', 
+                    b'ETag: ' + entry.etag, b'Content-Length: 0'])
+            return head + CRLF + age + CRLF, b''
+        return entry.head[:-len(CRLF)] + age + CRLF, entry.body
+
+
+    def _done(self, key, entry):
+        with self.lock:
+            pending = self.pending.pop(key, None)
+        if pending:
+            pending.set(entry, None)
+
+
+    def _get(self, key):
+        for tier in (self.memory, self.disk):
+            if key in tier:
+                tier[key] = entry = tier.pop(key)   # most recently used
+                return entry
+        return None
+
+
+    def _put(self, key, entry):
+        """Returns the entries moved to the disk tier whose body must be 
+        written with `_write`."""
+        demoted = []
+        self.memory[key] = entry
+        self.memory_used += entry.size()
+        while self.memory_used > self.max_size:
+            old_key, old = self.memory.popitem(last=False)
+            self.memory_used -= old.size()
+            if self._demote(old_key, old):
+                demoted.append((old_key, old))
+        return demoted
+
+
+    def _remove(self, key):
+        entry = self.memory.pop(key, None)
+        if entry:
+            self.memory_used -= entry.size()
+        entry = self.disk.pop(key, None)
+        if entry:
+            self.disk_used -= entry.size()
+            self._unlink(entry)
+
+
+    def _demote(self, key, entry):
+        """Moves an entry evicted from memory to the disk tier, its body
+        stays in memory until written. Returns True if it must be."""
+        if not self.cache_dir:
+            return False
+        self.disk[key] = entry
+        self.disk_used += entry.size()
+        while self.disk_used > self.disk_size:
+            _, old = self.disk.popitem(last=False)
+            self.disk_used -= old.size()
+            self._unlink(old)
+        return bool(entry.body) and self.disk.get(key) is entry
+
+
+    def _write(self, key, entry):
+        """Writes the body of a demoted entry to a file and maps it, 
+        called without the lock."""
+        # a key stored again meanwhile is written to a file of its own
+        digest = hashlib.sha1(repr(key).encode('utf8')).hexdigest()
+        path = os.path.join(self.cache_dir, '{}-{}-{:x}.cache'.format(
+                os.getpid(), digest, id(entry)))
+        try:
+            with open(path, 'w+b') as f:
+                f.write(entry.body)
+                f.flush()
+                body = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (IOError, OSError) as e:
+            self.log.warning('cache write [%s] failed: %s', path, e)
+            body = None
+        with self.lock:
+            if self.disk.get(key) is not entry:
+                # evicted or replaced while written
+                body = None
+            elif body is None:
+                del self.disk[key]
+                self.disk_used -= entry.size()
+            else:
+                entry.body, entry.path = body, path
+        if body is None:
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+
+
+    def _unlink(self, entry):
+        # a mapped body stays readable by tunnels still sending it
+        if entry.path:
+            try:
+                os.unlink(entry.path)
+            except OSError:
+                pass
+            entry.path = None
+
+
+def parse_http_date(value):
+    """Returns seconds since epoch, None if invalid."""
+    if not value:
+        return None
+    if not isinstance(value, str):
+        value = value.decode('latin-1')
+    parsed = email.utils.parsedate_tz(value)
+    return email.utils.mktime_tz(parsed) if parsed else None
+
+
+class Parent(object):
+    """One upstream proxy of a ParentPool."""
+
+    def __init__(self, host, port, weight=1):
+        self.host = host
+        self.port = int(port)
+        self.weight = weight
+        self.current_weight = 0 # smooth weighted round-robin state
+        self.active = 0         # upstream connections in use
+        self.failures = 0       # consecutive connect or check failures
+        self.ejected_until = 0
+
+
+    def __repr__(self):
+        return '{}:{}'.format(self.host, self.port)
+
+
+    @staticmethod
+    def parse(spec):
+        """host:port[:weight]"""
+        parts = spec.rsplit(':', 2) if spec.count(':') >= 2 else \
+                spec.split(':')
+        if len(parts) < 2:
+            raise ValueError('parent [{}] is not host:port[:weight]'.format(
+                    spec))
+        weight = int(parts[2]) if len(parts) > 2 else 1
+        return Parent(parts[0], parts[1], weight)
+
+
+class ParentPool(LogObject):
+    """Parent proxies that upstream connections go through.
+
+    A parent is chosen per connection with smooth weighted round-robin, 
+    or by the fewest connections in use relative to weight. Parents 
+    failing `max_failures` connects or health checks in a row are ejected
+    for `eject_time` seconds, or until a health check succeeds. When all
+    parents are ejected they are all used again.
+    """
+
+    def __init__(self, parents, strategy='round-robin', max_failures=3, 
+            eject_time=30, check_interval=10, check_timeout=3, log_file=''):
+        LogObject.__init__(self, log_file=log_file)
+        assert parents and strategy in PARENT_STRATEGIES
+        self.parents = parents
+        self.strategy = strategy
+        self.max_failures = max_failures
+        self.eject_time = eject_time
+        self.check_interval = check_interval
+        self.check_timeout = check_timeout
+        self.lock = threading.Lock()
+
+
+    def select(self):
+        with self.lock:
+            now = time.time()
+            candidates = [p for p in self.parents if p.ejected_until <= now]
+            candidates = candidates or self.parents
+            if self.strategy == 'least-conn':
+                parent = min(candidates, 
+                        key=lambda p: float(p.active) / p.weight)
+            else:
+                total = 0
+                for p in candidates:
+                    p.current_weight += p.weight
+                    total += p.weight
+                parent = max(candidates, key=lambda p: p.current_weight)
+                parent.current_weight -= total
+            parent.active += 1
+            return parent
+
+
+    def done(self, parent):
+        with self.lock:
+            parent.active -= 1
+
+
+    def failure(self, parent):
+        with self.lock:
+            parent.failures += 1
+            if (parent.failures >= self.max_failures and 
+                    parent.ejected_until <= time.time()):
+                parent.ejected_until = time.time() + self.eject_time
+                self.log.warning('eject parent [%s] after [%d] failures', 
+                        parent, parent.failures)
+
+
+    def success(self, parent):
+        with self.lock:
+            if parent.ejected_until:
+                self.log.info('parent [%s] is back', parent)
+            parent.failures = 0
+            parent.ejected_until = 0
+
+
+    def start_checks(self):
+        if not self.check_interval:
+            return
+        checker = threading.Thread(target=self._check, name='ParentCheck')
+        checker.daemon = True
+        checker.start()
+
+
+    def _check(self):
+        while True:
+            time.sleep(self.check_interval)
+            for parent in self.parents:
+                try:
+                    socket.create_connection((parent.host, parent.port), 
+                            self.check_timeout).close()
+                except socket.error as e:
+                    self.log.warning('parent [%s] check failed: %s', 
+                            parent, e)
+                    self.failure(parent)
+                else:
+                    self.success(parent)
+
+
+class Egress(object):
+    """One local source of upstream connections of an EgressPool: an 
+    address connections are bound to, or an interface like ppp0 they are
+    bound to with SO_BINDTODEVICE (root), which keeps working when a 
+    redial changes the interface address."""
+
+    def __init__(self, spec):
+        self.spec = spec
+        self.address = None
+        self.interface = None
+        self.family = None      # of the address, None for an interface
+        for family in (socket.AF_INET, getattr(socket, 'AF_INET6', None)):
+            try:
+                socket.inet_pton(family, spec)
+            except (socket.error, TypeError, ValueError):
+                continue
+            self.address, self.family = spec, family
+            break
+        else:
+            if SO_BINDTODEVICE is None:
+                raise ValueError('egress [{}] is not an address, and binding'
+                        ' to an interface is not supported'.format(spec))
+            self.interface = spec
+        self.active = 0         # upstream connections in use
+        self.connections = 0    # upstream connections made or reused
+        self.failures = 0       # consecutive connect failures
+        self.failures_total = 0
+        self.ejected_until = 0
+
+
+    def __repr__(self):
+        return self.spec
+
+
+    def filter(self, addrinfos):
+        """Destination addresses reachable from an address egress."""
+        if self.family is None:
+            return addrinfos
+        return [ai for ai in addrinfos if ai[0] == self.family]
+
+
+    def bind(self, sock):
+        """Before connect, raises socket.error if the egress is gone."""
+        if self.interface:
+            sock.setsockopt(socket.SOL_SOCKET, SO_BINDTODEVICE, 
+                    self.interface.encode())
+            return
+        if IP_BIND_ADDRESS_NO_PORT is not None:
+            # the port is picked by connect, so ports are shared between 
+            # destinations rather than one per connection of the egress
+            try:
+                sock.setsockopt(socket.IPPROTO_IP, IP_BIND_ADDRESS_NO_PORT, 1)
+            except socket.error:
+                pass
+        sock.bind((self.address, 0))
+
+
+class EgressPool(LogObject):
+    """Local sources that upstream connections are spread across, so that
+    origins see several addresses.
+
+    An egress is chosen per connection in turn (round-robin), by the 
+    client address so a client keeps its egress (sticky), or by the 
+    fewest connections in use to the destination host (least-used). Like
+    parents, an egress failing `max_failures` connects in a row is 
+    ejected for `eject_time` seconds, all are used when all are ejected.
+    """
+
+    def __init__(self, egresses, strategy='round-robin', max_failures=3, 
+            eject_time=30, log_file=''):
+        LogObject.__init__(self, log_file=log_file)
+        assert egresses and strategy in EGRESS_STRATEGIES
+        self.egresses = egresses
+        self.strategy = strategy
+        self.max_failures = max_failures
+        self.eject_time = eject_time
+        self.next = 0
+        self.host_active = {}   # host -> {egress: connections in use}
+        self.lock = threading.Lock()
+
+
+    def select(self, client_ip, host):
+        with self.lock:
+            now = time.time()
+            candidates = [e for e in self.egresses if e.ejected_until <= now]
+            candidates = candidates or self.egresses
+            if self.strategy == 'sticky':
+                # crc32 rather than hash(), stable across workers and 
+                # restarts
+                i = zlib.crc32(client_ip.encode()) & 0xffffffff
+                egress = candidates[i % len(candidates)]
+            else:
+                # ties go round-robin, min() keeps the first of them
+                i = self.next % len(candidates)
+                self.next += 1
+                candidates = candidates[i:] + candidates[:i]
+                egress = candidates[0]
+                if self.strategy == 'least-used':
+                    active = self.host_active.get(host, {})
+                    egress = min(candidates, 
+                            key=lambda e: (active.get(e, 0), e.active))
+            egress.active += 1
+            egress.connections += 1
+            active = self.host_active.setdefault(host, {})
+            active[egress] = active.get(egress, 0) + 1
+            return egress
+
+
+    def done(self, egress, host):
+        with self.lock:
+            egress.active -= 1
+            active = self.host_active.get(host)
+            if active and egress in active:
+                active[egress] -= 1
+                if not active[egress]:
+                    del active[egress]
+                if not active:
+                    del self.host_active[host]
+
+
+    def failure(self, egress):
+        with self.lock:
+            egress.failures += 1
+            egress.failures_total += 1
+            if (egress.failures >= self.max_failures and 
+                    egress.ejected_until <= time.time()):
+                egress.ejected_until = time.time() + self.eject_time
+                self.log.warning('eject egress [%s] after [%d] failures', 
+                        egress, egress.failures)
+
+
+    def success(self, egress):
+        with self.lock:
+            if egress.ejected_until:
+                self.log.info('egress [%s] is back', egress)
+            egress.failures = 0
+            egress.ejected_until = 0
+
+
+class ProxyUser(object):
+    def __init__(self, name, password, max_connections=0, max_bytes=0):
+        self.name = name
+        self.password = password    # plain, or {SHA256}hexdigest
+        self.max_connections = max_connections  # 0 means no limit
+        self.max_bytes = max_bytes  # per quota period, 0 means no limit
+        self.active = 0
+        self.used = 0
+        self.period_start = time.time()
+
+
+    def check_password(self, password):
+        expected = self.password
+        if expected.startswith(b'{SHA256}'):
+            expected = expected[len(b'{SHA256}'):].lower()
+            password = hashlib.sha256(password).hexdigest().encode()
+        return hmac.compare_digest(expected, password)
+
+
+class Authenticator(LogObject):
+    """Basic proxy authentication against a credentials file.
+
+    One user per line, `user:password[:max_connections[:max_mb]]`,
+    password either plain or `{SHA256}hexdigest`, `#` starts a comment.
+    The file is reloaded when it changes, checked at most once a second.
+    Verified Proxy-Authorization values are cached, so only the first
+    request with a value decodes and compares it. Users get at most
+    `max_connections` client connections at once and `max_bytes`
+    relayed per `quota_period` seconds, counted per process.
+    """
+
+    def __init__(self, path, max_connections=0, max_bytes=0,
+            quota_period=86400, log_file=''):
+        LogObject.__init__(self, log_file=log_file)
+        self.path = path
+        self.max_connections = max_connections
+        self.max_bytes = max_bytes
+        self.quota_period = quota_period
+        self.lock = threading.Lock()
+        self.users = {}     # name -> ProxyUser
+        self.verified = {}  # Proxy-Authorization value -> ProxyUser
+        self.mtime = None
+        self.last_check = 0
+        self._reload()
+
+
+    def authenticate(self, value):
+        """Returns the ProxyUser of a Proxy-Authorization header value."""
+        self._reload_if_changed()
+        user = self.verified.get(value)
+        if user:
+            return user
+        user = self._verify(value)
+        if user is None:
+            raise ProxyAuthenticationFailed()
+        if len(self.verified) >= 10000:
+            self.verified = {}
+        self.verified[value] = user
+        return user
+
+
+    def acquire(self, user):
+        """A client connection starts using `user`."""
+        with self.lock:
+            if user.max_connections and user.active >= user.max_connections:
+                raise ProxyQuotaExceeded('[{}] connection limit'.format(
+                        user.name))
+            user.active += 1
+
+
+    def release(self, user, nbytes):
+        with self.lock:
+            user.active -= 1
+        self.account(user, nbytes)
+
+
+    def account(self, user, nbytes):
+        """Adds relayed bytes, raises if the byte quota is used up."""
+        with self.lock:
+            if time.time() - user.period_start > self.quota_period:
+                user.period_start, user.used = time.time(), 0
+            user.used += nbytes
+            if user.max_bytes and user.used >= user.max_bytes:
+                raise ProxyQuotaExceeded('[{}] byte quota'.format(user.name))
+
+
+    def _verify(self, value):
+        if not value:
+            return None
+        scheme, _, credentials = value.strip().partition(b' ')
+        if scheme.lower() != b'basic':
+            return None
+        try:
+            name, _, password = base64.b64decode(
+                    credentials.strip()).partition(b':')
+        except (TypeError, ValueError):
+            return None
+        user = self.users.get(name)
+        if user and user.check_password(password):
+            return user
+        return None
+
+
+    def _reload_if_changed(self):
+        now = time.time()
+        if now - self.last_check < 1:
+            return
+        self.last_check = now
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError as e:
+            self.log.warning('credentials file [%s]: %s', self.path, e)
+            return
+        if mtime != self.mtime:
+            try:
+                self._reload()
+            except (IOError, OSError) as e:
+                # users of the last good load stay, retried next second
+                self.log.warning('reload credentials file [%s] failed: %s',
+                        self.path, e)
+
+
+    def _reload(self):
+        """Bad lines are skipped, an unreadable file raises."""
+        users = {}
+        mtime = os.stat(self.path).st_mtime
+        with open(self.path, 'rb') as f:
+            for line in f:
+                line = line.split(b'#')[0].strip()
+                if not line:
+                    continue
+                fields = line.split(b':')
+                try:
+                    if len(fields) < 2:
+                        raise ValueError('expected user:password')
+                    limits = [int(f or 0) for f in fields[2:4]] + [0, 0]
+                    if limits[0] < 0 or limits[1] < 0:
+                        raise ValueError('negative limit')
+                except ValueError as e:
+                    self.log.warning('invalid credentials line [%s]: %s', 
+                            line, e)
+                    continue
+                users[fields[0]] = ProxyUser(fields[0], fields[1],
+                        limits[0] or self.max_connections,
+                        limits[1] * 1024 * 1024 or self.max_bytes)
+        with self.lock:
+            # running connections and used bytes survive a reload
+            for name, user in users.items():
+                old = self.users.get(name)
+                if old:
+                    user.active, user.used = old.active, old.used
+                    user.period_start = old.period_start
+            self.users = users
+            self.verified = {}
+            self.mtime = mtime
+        self.log.info('loaded [%d] users from [%s]', len(users), self.path)
+
+
+class TokenBucket(object):
+    """Allows `rate` bytes per second on average and `burst` at once.
+
+    Tokens may go below zero when concurrent readers take the same 
+    tokens, the debt is then paid back before the next read.
+    """
+
+    def __init__(self, rate, burst=0):
+        self.lock = threading.Lock()
+        self.rate = rate
+        self.burst = burst or max(rate, MIN_BURST)
+        self.tokens = self.burst
+        self.last = time.time()
+
+
+    def set_rate(self, rate, burst=0):
+        with self.lock:
+            self._refill()
+            self.rate = rate
+            self.burst = burst or max(rate, MIN_BURST)
+            self.tokens = min(self.tokens, self.burst)
+
+
+    def available(self):
+        with self.lock:
+            self._refill()
+            return self.tokens
+
+
+    def delay(self):
+        """Seconds until a read of MIN_BURST bytes is allowed, so that a
+        throttled tunnel does not wake up for every few bytes."""
+        need = min(MIN_BURST, self.burst) - self.available()
+        if need <= 0:
+            return 0
+        return need / float(self.rate)
+
+
+    def consume(self, n):
+        with self.lock:
+            self._refill()
+            self.tokens -= n
+
+
+    def is_full(self):
+        return self.available() >= self.burst
+
+
+    def _refill(self):
+        now = time.time()
+        self.tokens = min(self.burst, 
+                self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+
+class Shaper(LogObject):
+    """Token bucket bandwidth limits, global, per client ip and per user.
+
+    Bytes relayed in both directions count against every bucket a tunnel
+    falls under; a tunnel stops reading while one of them is empty, so 
+    throttled data stays in the peers' socket buffers. Rates are bytes 
+    per second, 0 means no limit.
+
+    Limits can be changed at runtime in `path`, checked at most once a 
+    second, with lines of KB/s like
+
+        global 10240
+        client 512
+        client 10.0.0.7 64
+        user 256
+        user alice 2048
+
+    where a line without a name sets the default of its kind.
+    """
+
+    kinds = ('global', 'client', 'user')
+
+    def __init__(self, rate=0, client_rate=0, user_rate=0, path='', 
+            log_file=''):
+        LogObject.__init__(self, log_file=log_file)
+        self.path = path
+        self.lock = threading.Lock()
+        self.flags = {'global': rate, 'client': client_rate, 
+                'user': user_rate}
+        self.defaults = dict(self.flags)
+        self.overrides = {}     # (kind, name) -> rate
+        self.buckets = {}       # (kind, name) -> TokenBucket
+        self.mtime = None
+        self.last_check = 0
+        self.last_sweep = time.time()
+        if path:
+            self._reload()
+
+
+    def lookup(self, client_ip, user=None):
+        """Returns the limited buckets a tunnel's traffic counts against."""
+        self._reload_if_changed()
+        keys = [('global', None), ('client', client_ip)]
+        if user is not None:
+            keys.append(('user', user))
+        buckets = []
+        for key in keys:
+            rate = self._rate(key)
+            if rate:
+                buckets.append(self._bucket(key, rate))
+        return buckets
+
+
+    def _rate(self, key):
+        return self.overrides.get(key, self.defaults[key[0]])
+
+
+    def _bucket(self, key, rate):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            with self.lock:
+                bucket = self.buckets.setdefault(key, TokenBucket(rate))
+        return bucket
+
+
+    def _reload_if_changed(self):
+        now = time.time()
+        if now - self.last_check < 1:
+            return
+        self.last_check = now
+        if now - self.last_sweep > 60:
+            self._sweep(now)
+        if not self.path:
+            return
+        try:
+            mtime = os.stat(self.path).st_mtime
+        except OSError as e:
+            self.log.warning('limits file [%s]: %s', self.path, e)
+            return
+        if mtime != self.mtime:
+            try:
+                self._reload()
+            except (IOError, OSError) as e:
+                # rates of the last good load stay, retried next second
+                self.log.warning('reload limits file [%s] failed: %s', 
+                        self.path, e)
+
+
+    def _reload(self):
+        """Bad lines are skipped, an unreadable file raises."""
+        defaults, overrides = dict(self.flags), {}
+        mtime = os.stat(self.path).st_mtime
+        with open(self.path, 'rb') as f:
+            for line in f:
+                fields = line.split(b'#')[0].split()
+                if not fields:
+                    continue
+                kind = fields[0].decode('ascii', 'replace')
+                try:
+                    if kind not in self.kinds or len(fields) > 3:
+                        raise ValueError('expected kind [name] KB/s')
+                    if len(fields) == 3 and kind == 'global':
+                        raise ValueError('global takes no name')
+                    rate = int(fields[-1]) * 1024
+                    if rate < 0:
+                        raise ValueError('negative rate')
+                    if len(fields) == 2:
+                        key = None
+                    elif kind == 'client':
+                        key = (kind, fields[1].decode())
+                    else:
+                        key = (kind, fields[1])
+                except ValueError as e:
+                    self.log.warning('invalid limits line [%s]: %s', 
+                            line, e)
+                    continue
+                if key is None:
+                    defaults[kind] = rate
+                else:
+                    overrides[key] = rate
+        self.defaults, self.overrides = defaults, overrides
+        self.mtime = mtime
+        # running tunnels keep their buckets, only rates change
+        for key, bucket in list(self.buckets.items()):
+            if self._rate(key):
+                bucket.set_rate(self._rate(key))
+        self.log.info('loaded rate limits from [%s]', self.path)
+
+
+    def _sweep(self, now):
+        """Forget buckets of clients and users that went quiet."""
+        self.last_sweep = now
+        with self.lock:
+            for key, bucket in list(self.buckets.items()):
+                if key[0] != 'global' and bucket.is_full():
+                    del self.buckets[key]
+
+
+class Admission(LogObject):
+    """Admission control for accepted client connections.
+
+    At most `max_tunnels` tunnels run at once, and at most `max_per_ip` 
+    connections per client address (0 means no limit). Connections over
+    the total limit wait in a FIFO of `queue_size` for up to 
+    `queue_timeout` seconds. Everything else gets a 503 and is closed.
+    """
+
+    def __init__(self, max_tunnels=500, max_per_ip=0, queue_size=1000, 
+            queue_timeout=5, metrics=None, log_file=''):
+        LogObject.__init__(self, log_file=log_file)
+        self.max_tunnels = max_tunnels
+        self.max_per_ip = max_per_ip
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.metrics = metrics
+        self.lock = threading.Lock()
+        self.active = 0
+        self.per_ip = {}        # client ip -> connections running or queued
+        self.pending = deque()  # (client, deadline)
+
+
+    def admit(self, client):
+        """Returns True if a tunnel may start now, else client is queued or
+        rejected."""
+        ip = client.addr[0]
+        with self.lock:
+            if self.max_per_ip and self.per_ip.get(ip, 0) >= self.max_per_ip:
+                reason = 'per ip limit'
+            elif self.active < self.max_tunnels:
+                self.active += 1
+                self.per_ip[ip] = self.per_ip.get(ip, 0) + 1
+                return True
+            elif len(self.pending) < self.queue_size:
+                self.pending.append((client, time.time() + self.queue_timeout))
+                self.per_ip[ip] = self.per_ip.get(ip, 0) + 1
+                return False
+            else:
+                reason = 'accept queue full'
+        self.reject(client, reason)
+        return False
+
+
+    def release(self, client):
+        """Tunnel of client ended, returns the next client to start."""
+        with self.lock:
+            self.active -= 1
+            self._forget(client)
+        return self.next()
+
+
+    def next(self):
+        """Returns a queued client if a tunnel may start, after rejecting 
+        clients waiting past their deadline."""
+        expired, client = [], None
+        now = time.time()
+        with self.lock:
+            while self.pending:
+                candidate, deadline = self.pending[0]
+                if deadline < now:
+                    self.pending.popleft()
+                    self._forget(candidate)
+                    expired.append(candidate)
+                elif self.active < self.max_tunnels:
+                    self.pending.popleft()
+                    self.active += 1
+                    client = candidate
+                    break
+                else:
+                    break
+        for candidate in expired:
+            self.reject(candidate, 'accept queue timeout')
+        return client
+
+
+    def reject(self, client, reason):
+        self.log.warning('reject [%s]: %s', client.addr, reason)
+        if self.metrics:
+            self.metrics.error('AdmissionRejected')
+        try:
+            client.conn.setblocking(False)
+            client.conn.send(SERVICE_UNAVAILABLE_RESPONSE_PKT)
+        except socket.error:
+            pass
+        client.close()
+
+
+    def _forget(self, client):
+        ip = client.addr[0]
+        count = self.per_ip.get(ip, 0) - 1
+        if count > 0:
+            self.per_ip[ip] = count
+        else:
+            self.per_ip.pop(ip, None)
+
+
+class WorkerPool(LogObject):
+    """Threads reused across tasks, started on demand.
+
+    Callers bound the number of concurrent tasks, so every task either 
+    gets an idle worker or a new one. Workers idle for `idle_timeout` 
+    seconds exit.
+    """
+
+    def __init__(self, name='Worker', idle_timeout=60, log_file=''):
+        LogObject.__init__(self, log_file=log_file)
+        self.name = name
+        self.idle_timeout = idle_timeout
+        self.tasks = queue.Queue()
+        self.lock = threading.Lock()
+        self.idle = 0
+        self.count = 0
+
+
+    def submit(self, fn, *args):
+        with self.lock:
+            if self.idle:
+                self.idle -= 1  # reserved for this task
+            else:
+                self.count += 1
+                worker = threading.Thread(target=self._work, 
+                        name='{}-{}'.format(self.name, self.count))
+                worker.daemon = True
+                worker.start()
+        self.tasks.put((fn, args))
+
+
+    def _work(self):
+        while True:
+            try:
+                fn, args = self.tasks.get(timeout=self.idle_timeout)
+            except queue.Empty:
+                with self.lock:
+                    if self.idle:   # not reserved by a task being queued
+                        self.idle -= 1
+                        return
+                continue
+            try:
+                fn(*args)
+            except Exception:
+                self.log.exception('task failed')
+            with self.lock:
+                self.idle += 1
+
+
+class Client(Connection):
+    __slots__ = ('addr',)
+
+    def __init__(self, conn, addr, log_file=''):
+        super(Client, self).__init__('client', log_file)
+        self.conn = conn
+        self.addr = addr
+
+
+class Relay(object):
+    """One direction of an established tunnel, moving bytes from `src` to
+    `dst` connection without parsing or queueing them.
+
+    Data already queued in `dst` buffer is flushed first. A relay reads 
+    only when everything previously read has been written, so a slow 
+    reader pauses its writer. Subclasses move the bytes: `_recv(size)` 
+    reads at most `size` bytes from `src` and `_send(size)` writes at most
+    `size` of the bytes read to `dst`, both return the number of bytes 
+    moved and raise socket or OS errors.
+    """
+
+    __slots__ = ('src', 'dst', 'size', 'pending', 'bytes', 'eof', 'broken')
+
+    def __init__(self, src, dst, size):
+        self.src = src
+        self.dst = dst
+        self.size = size    # most bytes read at once
+        self.pending = 0    # bytes read but not yet written
+        self.bytes = 0      # bytes relayed
+        self.eof = False    # src closed
+        self.broken = False # dst failed
+
+
+    def has_pending(self):
+        return self.pending > 0 or self.dst.has_buffer()
+
+
+    def wants_read(self):
+        return not self.has_pending() and not self.eof and not self.broken
+
+
+    def wants_write(self):
+        return self.has_pending() and not self.broken
+
+
+    def is_done(self):
+        return self.broken or (self.eof and not self.has_pending())
+
+
+    def on_readable(self, bufsiz=0):
+        """Reads at most `bufsiz` bytes, 0 means the relay's own size, 
+        and starts writing them. Returns the number of bytes read."""
+        try:
+            n = self._recv(min(bufsiz, self.size) if bufsiz else self.size)
+        except (IOError, OSError) as e:
+            if e.args[0] in WOULDBLOCK_ERRNOS:
+                return 0
+            n = 0
+        if n == 0:
+            self.eof = True
+            return 0
+        self.pending = n
+        self.write_pending()
+        return n
+
+
+    def on_writable(self):
+        if self.dst.has_buffer():
+            try:
+                self.dst.flush()
+            except socket.error:
+                self.broken = True
+                return
+        if not self.dst.has_buffer():
+            self.write_pending()
+
+
+    def write_pending(self):
+        while self.pending:
+            try:
+                n = self._send(self.pending)
+            except (IOError, OSError) as e:
+                if e.args[0] not in WOULDBLOCK_ERRNOS:
+                    self.broken = True
+                return
+            self.pending -= n
+            self.bytes += n
+
+
+    def close(self):
+        pass
+
+
+class CopyRelay(Relay):
+    """Relay through one preallocated buffer with recv_into."""
+
+    __slots__ = ('buf', 'view', 'start')
+
+    def __init__(self, src, dst, bufsiz=8192):
+        super(CopyRelay, self).__init__(src, dst, bufsiz)
+        self.buf = bytearray(bufsiz)
+        self.view = memoryview(self.buf)
+        self.start = 0
+
+
+    def _recv(self, size):
+        self.start = 0
+        return self.src.conn.recv_into(self.buf, size)
+
+
+    def _send(self, size):
+        n = self.dst.conn.send(self.view[self.start:self.start + size])
+        self.start += n
+        return n
+
+
+class SpliceRelay(Relay):
+    """Relay inside the kernel, splicing src -> pipe -> dst (linux).
+
+    A relay holds a pipe only while spliced bytes wait in it, drained 
+    pipes are shared through `spare_pipes` so idle tunnels hold none.
+    """
+
+    flags = getattr(os, 'SPLICE_F_MOVE', 0) | getattr(os, 'SPLICE_F_NONBLOCK', 0)
+    spare_pipes = deque()   # (read fd, write fd) of empty pipes
+
+    __slots__ = ('pipe',)
+
+    def __init__(self, src, dst):
+        super(SpliceRelay, self).__init__(src, dst, SPLICE_SIZE)
+        self.pipe = None
+
+
+    @staticmethod
+    def is_available():
+        return hasattr(os, 'splice')
+
+
+    def _recv(self, size):
+        if self.pipe is None:
+            try:
+                self.pipe = SpliceRelay.spare_pipes.pop()
+            except IndexError:
+                self.pipe = os.pipe()
+        try:
+            n = os.splice(self.src.conn.fileno(), self.pipe[1], size, 
+                    flags=SpliceRelay.flags)
+        except OSError:
+            self._release_pipe()
+            raise
+        if n == 0:
+            self._release_pipe()
+        return n
+
+
+    def _send(self, size):
+        n = os.splice(self.pipe[0], self.dst.conn.fileno(), size, 
+                flags=SpliceRelay.flags)
+        if n == size:
+            self._release_pipe()
+        return n
+
+
+    def _release_pipe(self):
+        if len(SpliceRelay.spare_pipes) < SPARE_PIPES:
+            SpliceRelay.spare_pipes.append(self.pipe)
+        else:
+            self._close_pipe()
+        self.pipe = None
+
+
+    def _close_pipe(self):
+        for fd in self.pipe:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+        self.pipe = None
+
+
+    def close(self):
+        if self.pipe is None:
+            return
+        if self.pending:    # bytes left in it
+            self._close_pipe()
+        else:
+            self._release_pipe()
+
+
+def make_relay(src, dst, mode, bufsiz=8192):
+    if mode == 'auto' and SpliceRelay.is_available():
+        return SpliceRelay(src, dst)
+    return CopyRelay(src, dst, bufsiz)
+
+
+class Histogram(object):
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)     # last one is +Inf
+        self.sum = 0.0
+
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class Metrics(object):
+    """Counters, gauges and histograms of one proxy process.
+
+    Updates are plain integer arithmetic without locks so that they cost
+    next to nothing on the hot path; with the thread engine a concurrent
+    update may rarely be lost, which is fine for monitoring. Bytes of 
+    CONNECT relays are added up when scraped, from the relays of open 
+    tunnels, and moved to the totals once the tunnel closes.
+    """
+
+    def __init__(self):
+        self.started = time.time()
+        self.accepted = 0
+        self.active_tunnels = 0
+        self.bytes_upstream = 0     # client -> server
+        self.bytes_downstream = 0   # server -> client
+        self.relays = set()         # (upstream, downstream) Relay pairs
+        self.lock = threading.Lock()    # moving relay bytes vs scrapes
+        self.errors = {}            # exception class name -> count
+        self.accept_errors = {}     # errno name -> count
+        self.connect_latency = Histogram()
+        self.time_to_first_byte = Histogram()
+        self.cache = {'hit': 0, 'miss': 0, 'coalesced': 0, 'revalidated': 0}
+        self.throttled = 0          # reads paused by a rate limit
+        self.accepting = 1          # 0 while paused or draining
+        self.egresses = []          # Egress of the egress pool, if any
+
+
+    def error(self, e):
+        name = e if isinstance(e, str) else e.__class__.__name__
+        self.errors[name] = self.errors.get(name, 0) + 1
+
+
+    def close_relays(self, relays):
+        """Moves the bytes of a closing tunnel's relays to the totals."""
+        upstream, downstream = relays
+        with self.lock:
+            self.relays.discard(relays)
+            self.bytes_upstream += upstream.bytes
+            self.bytes_downstream += downstream.bytes
+
+
+    def render(self):
+        """Prometheus text exposition format."""
+        lines = []
+        with self.lock:
+            bytes_upstream = self.bytes_upstream
+            bytes_downstream = self.bytes_downstream
+            for upstream, downstream in list(self.relays):
+                bytes_upstream += upstream.bytes
+                bytes_downstream += downstream.bytes
+        def metric(name, kind, help, samples):
+            lines.append('# HELP pyproxy_{} {}'.format(name, help))
+            lines.append('# TYPE pyproxy_{} {}'.format(name, kind))
+            for suffix, labels, value in samples:
+                lines.append('pyproxy_{}{}{} {}'.format(name, suffix, 
+                        labels, value))
+
+        metric('start_time_seconds', 'gauge', 'Start time of the process.',
+                [('', '', self.started)])
+        metric('connections_accepted_total', 'counter', 
+                'Client connections accepted.', [('', '', self.accepted)])
+        metric('active_tunnels', 'gauge', 'Client connections being served.',
+                [('', '', self.active_tunnels)])
+        metric('accepting', 'gauge', 
+                '1 while new client connections are accepted.', 
+                [('', '', self.accepting)])
+        metric('bytes_relayed_total', 'counter', 'Bytes relayed.', [
+                ('', '{direction="upstream"}', bytes_upstream),
+                ('', '{direction="downstream"}', bytes_downstream)])
+        metric('cache_requests_total', 'counter', 
+                'Cacheable requests by result.', 
+                [('', '{{result="{}"}}'.format(result), count) 
+                 for result, count in sorted(self.cache.items())])
+        metric('throttled_total', 'counter', 
+                'Times a tunnel paused reading for a rate limit.', 
+                [('', '', self.throttled)])
+        if self.egresses:
+            for name, kind, help, attr in (
+                    ('egress_connections_total', 'counter', 
+                     'Upstream connections made or reused per egress.', 
+                     'connections'),
+                    ('egress_active', 'gauge', 
+                     'Upstream connections in use per egress.', 'active'),
+                    ('egress_failures_total', 'counter', 
+                     'Upstream connect failures per egress.', 
+                     'failures_total')):
+                metric(name, kind, help, 
+                        [('', '{{egress="{}"}}'.format(e), getattr(e, attr))
+                         for e in self.egresses])
+        metric('accept_errors_total', 'counter', 
+                'Failed accepts of client connections by errno.', 
+                [('', '{{errno="{}"}}'.format(name), count) 
+                 for name, count in sorted(self.accept_errors.items())])
+        metric('errors_total', 'counter', 'Errors by type.', 
+                [('', '{{type="{}"}}'.format(name), count) 
+                 for name, count in sorted(self.errors.items())])
+        for name, help, histogram in (
+                ('upstream_connect_seconds', 'Upstream connect latency.', 
+                 self.connect_latency),
+                ('time_to_first_byte_seconds', 
+                 'Request sent to first response byte.', 
+                 self.time_to_first_byte)):
+            samples, total = [], 0
+            bounds = [repr(float(b)) for b in histogram.buckets] + ['+Inf']
+            for bound, count in zip(bounds, histogram.counts):
+                total += count
+                samples.append(('_bucket', '{{le="{}"}}'.format(bound), total))
+            samples.append(('_sum', '', histogram.sum))
+            samples.append(('_count', '', total))
+            metric(name, 'histogram', help, samples)
+        return '\n'.join(lines) + '\n'
+
+
+class ProxyError(Exception):
+    pass
+
+
+class ProxyConnectionFailed(ProxyError):
+    def __init__(self, host, port, reason):
+        self.host = host
+        self.port = port
+        self.reason = reason
+
+    def __str__(self):
+        return '<ProxyConnectionFailed - {}:{} - {}>'.format(self.host, 
+                self.port, self.reason)
+
+
+class ProxyAuthenticationFailed(ProxyError):
+    pass
+
+
+class ProxyQuotaExceeded(ProxyError):
+    pass
+
+
+def get_response_pkt_by_exception(e):
+    if e.__class__.__name__ == 'ProxyAuthenticationFailed':
+        return PROXY_AUTHENTICATION_REQUIRED_RESPONSE_PKT
+    if e.__class__.__name__ == 'ProxyConnectionFailed':
+        return BAD_GATEWAY_RESPONSE_PKT
+    if e.__class__.__name__ == 'ProxyQuotaExceeded':
+        return TOO_MANY_REQUESTS_RESPONSE_PKT
+
+
+class Tunnel(LogObject):
+    """ act as a tunnel between client and server.
+
+    One tunnel lives as long as its client connection, so its state is 
+    kept in slots and the response parser is only created once a request
+    is sent, never for CONNECT tunnels.
+    """
+
+    __slots__ = ('start_time', 'last_activity', 'client', 
+            'client_recvbuf_size', 'buffer_high_water', 'server', 
+            'server_recvbuf_size', 'upstream_pool', 'server_reused', 
+            'keepalive_timeout', 'exchanges', 'pipeline', 'relay', 'relays', 
+            'resolver', 'reactor', 'connect_timeout', 'read_timeout', 
+            'connect_parallel', 'address_health', 'server_activity', 
+            'request_sent', 'metrics', 'on_close', 'idle_timeout', 
+            'max_lifetime', 'timer', 'parents', 'parent', 'cache', 
+            'cache_key', 'cache_capture', 'cache_entry', 'cache_held', 'auth',
+            'user', 'user_bytes', 'shaper', 'throttled_until', 'sockopts', 
+            'egresses', 'egress', 'egress_host', 'request', 'response')
+
+    def __init__(self, client, server_recvbuf_size=8192, 
+            client_recvbuf_size=8192, log_file='', upstream_pool=None, 
+            keepalive_timeout=15, relay='auto', 
+            buffer_high_water=BUFFER_HIGH_WATER, resolver=None, 
+            connect_timeout=10, read_timeout=60, connect_parallel=2, 
+            address_health=None, metrics=None, on_close=None, 
+            idle_timeout=30, max_lifetime=0, parents=None, cache=None,
+            auth=None, shaper=None, sockopts=None, egresses=None):
+        LogObject.__init__(self, log_file=log_file)
+
+        self.start_time = time.time()
+        self.last_activity = self.start_time
+        self.client = client
+        self.client.high_water = buffer_high_water
+        self.client_recvbuf_size = client_recvbuf_size
+        self.buffer_high_water = buffer_high_water
+        self.server = None
+        self.server_recvbuf_size = server_recvbuf_size
+        self.upstream_pool = upstream_pool
+        self.server_reused = False
+        # client keep-alive: idle seconds allowed between requests, 0 means
+        # one request per client connection
+        self.keepalive_timeout = keepalive_timeout
+        self.exchanges = 0
+        self.pipeline = b''     # client data received ahead of its turn
+        self.relay = relay
+        self.relays = None      # established CONNECT tunnel fast path
+        self.resolver = resolver
+        self.reactor = None     # set by the reactor driving this tunnel
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.connect_parallel = connect_parallel
+        self.address_health = address_health
+        self.server_activity = None     # last time server made progress
+        self.request_sent = None        # when current request was queued
+        self.metrics = metrics or Metrics()
+        self.metrics.active_tunnels += 1
+        self.on_close = on_close    # called with the tunnel once closed
+        self.idle_timeout = idle_timeout
+        self.max_lifetime = max_lifetime    # 0 means no limit
+        self.timer = None   # reactor timer wheel entry
+        self.parents = parents
+        self.parent = None  # parent proxy the server connection goes to
+        self.cache = cache
+        self.cache_key = None       # response this tunnel fetches for cache
+        self.cache_capture = None   # response chunks to store
+        self.cache_entry = None     # stale entry being revalidated
+        self.cache_held = None      # response data held while revalidating
+        self.auth = auth
+        self.user = None        # authenticated ProxyUser
+        self.user_bytes = 0     # bytes relayed not yet accounted to user
+        self.shaper = shaper
+        self.throttled_until = None     # reads paused until this time
+        self.sockopts = sockopts
+        self.egresses = egresses
+        self.egress = None      # source the server connection is made from
+        self.egress_host = None
+
+        self.request = HttpParser(HttpParser.types.REQUEST_PARSER, 
+                self.log_file, keep_body=False)
+        self.response = None    # created by _expect_response()
+
+        # all io is driven by select/selectors, both in the thread engine
+        # and in the reactor engine
+        self.client.conn.setblocking(False)
+
+
+    def _inactivity_timeout(self):
+        if self.exchanges and self.request.state == HttpParser.states.INITIALIZED:
+            return self.keepalive_timeout
+        return self.idle_timeout
+
+
+    def _is_inactive(self):
+        return (time.time() - self.last_activity) > self._inactivity_timeout()
+
+
+    def _is_expired(self):
+        return bool(self.max_lifetime and 
+                time.time() - self.start_time > self.max_lifetime)
+
+
+    def _next_deadline(self):
+        """Earliest time one of the timeouts may expire.
+
+        Activity only moves deadlines later, so callers wait until this
+        time and recompute it rather than tracking every activity. New
+        deadlines appear when a connect or a request starts.
+        """
+        deadline = self.last_activity + self._inactivity_timeout()
+        if self.max_lifetime:
+            deadline = min(deadline, self.start_time + self.max_lifetime)
+        if self.server and not self.server.closed:
+            if self.server.connecting and self.connect_timeout:
+                deadline = min(deadline, 
+                        self.server.connect_started + self.connect_timeout)
+            elif self._awaits_response() and self.read_timeout:
+                deadline = min(deadline, 
+                        self.server_activity + self.read_timeout)
+        return deadline
+
+
+    def _buckets(self):
+        return self.shaper.lookup(self.client.addr[0], 
+                self.user.name if self.user else None)
+
+
+    def _read_allowance(self, bufsiz):
+        """Bytes a read may take, 0 while a rate limit pauses reads."""
+        if not self.shaper:
+            return bufsiz
+        buckets = self._buckets()
+        if not buckets:
+            return bufsiz
+        now = time.time()
+        if self.throttled_until and now < self.throttled_until:
+            return 0
+        delay = max(bucket.delay() for bucket in buckets)
+        if delay:
+            self.metrics.throttled += 1
+            self.throttled_until = now + delay
+            return 0
+        self.throttled_until = None
+        tokens = min(bucket.available() for bucket in buckets)
+        return max(1, min(bufsiz, int(tokens)))
+
+
+    def _shape(self, nbytes):
+        if self.shaper and nbytes:
+            for bucket in self._buckets():
+                bucket.consume(nbytes)
+
+
+    def run(self):
+        try:
+            self._process()
+        except Exception as e:
+            self.log.exception(e)
+            self.metrics.error(e)
+        finally:
+            self.close()
+
+
+    def close(self):
+        self.log.info('close client connection [%s] after [%d] exchanges', 
+                self.client.addr, self.exchanges + 1)
+        self.client.close()
+        if self.server and not self.server.closed:
+            self.server.close()
+        if self.relays:
+            self.metrics.close_relays(self.relays)
+        for relay in self.relays or ():
+            relay.close()
+        self._release_user()
+        self._release_parent()
+        self._release_egress()
+        self._abandon_cache()
+        self.metrics.active_tunnels -= 1
+        if self.on_close:
+            self.on_close(self)
+    
+    
+    def _process(self):
+        while True:
+            self.log.debug('_process')
+            rlist, wlist, xlist = self._get_waitable_lists()
+            # wake up for events or when the next timeout is due, then
+            # poll once a second while a due timeout does not apply yet
+            deadline = self._next_deadline()
+            if self.throttled_until:
+                deadline = min(deadline, self.throttled_until)
+            timeout = deadline - time.time()
+            timeout = timeout + 0.01 if timeout > 0 else 1
+            r, w, x = select.select(rlist, wlist, xlist, timeout)
+            if self._process_events(r, w):
+                break
+
+
+    def _process_events(self, r, w):
+        """Handle one round of ready sockets.
+
+        Returns True if connection to client must be closed.
+        """
+        if self.relays:
+            return self._process_relays(r, w)
+
+        try:
+            self._process_wlist(w)
+            if self._process_rlist(r):
+                return True
+            if self._can_keep_alive():
+                self._next_exchange()
+        except (ProxyAuthenticationFailed, ProxyConnectionFailed,
+                ProxyQuotaExceeded) as e:
+            return self._fail(e)
+        if self._can_relay():
+            self._start_relays()
+        return self._is_finished()
+
+
+    def _process_callback(self, callback, *args):
+        """Run a callback scheduled by the reactor, like _process_events."""
+        try:
+            callback(*args)
+        except (ProxyAuthenticationFailed, ProxyConnectionFailed,
+                ProxyQuotaExceeded) as e:
+            return self._fail(e)
+        if self._can_relay():
+            self._start_relays()
+        return self._is_finished()
+
+
+    def _fail(self, e):
+        if isinstance(e, (ProxyAuthenticationFailed, ProxyQuotaExceeded)):
+            # expected answers, port scans must not flood the log
+            self.log.warning('refuse [%s]: %s', self.client.addr, 
+                    str(e) or e.__class__.__name__)
+        else:
+            self.log.exception(e)
+        self.metrics.error(e)
+        if self.parent and isinstance(e, ProxyConnectionFailed):
+            self.parents.failure(self.parent)
+        if self.egress and isinstance(e, ProxyConnectionFailed):
+            self.egresses.failure(self.egress)
+        return self._send_error(get_response_pkt_by_exception(e))
+
+
+    def _send_error(self, pkt):
+        self.client.queue(pkt)
+        self.client.flush()
+        return True
+
+
+    def _check_timeouts(self):
+        """Returns True if connection to client must be closed."""
+        if self._is_expired():
+            self.log.info('tunnel reached its maximum lifetime')
+            return True
+        if self.server is None or self.server.closed:
+            return False
+        if self.server.connect_expired(self.connect_timeout):
+            self.log.warning('connect [%s] timeout', self.server.addr)
+            self.metrics.error('ConnectTimeout')
+            if self.parent:
+                self.parents.failure(self.parent)
+            if self.egress:
+                self.egresses.failure(self.egress)
+            self.server.close()
+            return self._send_error(BAD_GATEWAY_RESPONSE_PKT)
+
+        # origin accepted the whole request but answers too slowly
+        if (self.read_timeout and self._awaits_response() and 
+                time.time() - self.server_activity > self.read_timeout):
+            self.log.warning('read [%s] timeout', self.server.addr)
+            self.metrics.error('ReadTimeout')
+            self.server.close()
+            if self._response_state() == HttpParser.states.INITIALIZED:
+                return self._send_error(GATEWAY_TIMEOUT_RESPONSE_PKT)
+            return True
+        return False
+
+
+    def _awaits_response(self):
+        return bool(self.server_activity and 
+                self.request.method != b'CONNECT' and 
+                self.request.state == HttpParser.states.COMPLETE and 
+                self._response_state() != HttpParser.states.COMPLETE)
+
+
+    def _response_state(self):
+        if self.response is None:
+            return HttpParser.states.INITIALIZED
+        return self.response.state
+
+
+    def _expect_response(self, request_method):
+        """Response parser for the request being sent."""
+        self.response = HttpParser(HttpParser.types.RESPONSE_PARSER, 
+                self.log_file, keep_body=False)
+        self.response.request_method = request_method
+        return self.response
+
+
+    def _can_relay(self):
+        """CONNECT tunnel is up, relays drain what is left in buffers."""
+        return (self.relay != 'off' and 
+                self.request.method == b'CONNECT' and 
+                self._server_is_open() and 
+                not self.server.connecting)
+
+
+    def _start_relays(self):
+        self.log.info('tunnel established, start relaying')
+        self.relays = (
+            make_relay(self.client, self.server, self.relay, 
+                    self.client_recvbuf_size),
+            make_relay(self.server, self.client, self.relay, 
+                    self.server_recvbuf_size))
+        self.metrics.relays.add(self.relays)
+
+
+    def _process_relays(self, r, w):
+        for relay in self.relays:
+            if relay.dst.conn in w:
+                relay.on_writable()
+            bufsiz = self._read_allowance(SPLICE_SIZE)
+            if relay.src.conn in r and bufsiz:
+                self.last_activity = time.time()
+                nbytes = relay.on_readable(bufsiz)
+                self._shape(nbytes)
+                if self._account(nbytes):
+                    return True
+
+        upstream, downstream = self.relays
+        if upstream.is_done() or downstream.is_done():
+            self.log.info('tunnel closed, relayed [%d] up [%d] down', 
+                    upstream.bytes, downstream.bytes)
+            return True
+        if self._is_expired():
+            self.log.info('tunnel reached its maximum lifetime')
+            return True
+        return self._is_inactive()
+
+
+    def _is_finished(self):
+        if self._check_timeouts():
+            return True
+        if self.client.buffer_size() == 0:
+            if self._response_state() == HttpParser.states.COMPLETE:
+                self.log.info('client buffer empty and response complete')
+                return True
+
+            if self.server is not None and self.server.closed:
+                self.log.info('client buffer empty and server closed')
+                return True
+
+            if self._is_inactive():
+                self.log.info('client buffer empty and inactivity')
+                return True
+        return False
+
+
+    def _can_keep_alive(self):
+        # an origin may answer before the whole request body was sent
+        return (self.keepalive_timeout > 0 and 
+                self.request.state == HttpParser.states.COMPLETE and 
+                self._response_state() == HttpParser.states.COMPLETE and 
+                self.client.buffer_size() == 0 and 
+                self.request.method != b'CONNECT' and 
+                self.request.is_keep_alive() and 
+                self.response.is_keep_alive())
+
+
+    def _next_exchange(self):
+        """Reset parsers to serve the next request on the same client."""
+        self.log.info('exchange complete, keep client connection alive')
+        if self.server is not None:     # not handed back to the pool
+            if not self.server.closed:
+                self.server.close()
+            self.server = None
+        self._release_parent()
+        self._release_egress()
+        self._abandon_cache()
+        self.exchanges += 1
+        self.last_activity = time.time()
+        self.request = HttpParser(HttpParser.types.REQUEST_PARSER, 
+                self.log_file, keep_body=False)
+        self.response = None
+        data, self.pipeline = self.pipeline, b''
+        if data:
+            self._process_request(data)
+
+
+    def _server_is_open(self):
+        return bool(self.server and not self.server.closed and 
+                (self.server.conn or self.server.connecting))
+
+
+    def _get_waitable_lists(self):
+        rlist, wlist, xlist = [], [], []
+        # reads stay paused until the rate limit refills
+        throttled = not self._read_allowance(1)
+        if self.relays:
+            for relay in self.relays:
+                if relay.wants_read() and not throttled:
+                    rlist.append(relay.src.conn)
+                if relay.wants_write():
+                    wlist.append(relay.dst.conn)
+            return rlist, wlist, xlist
+
+        # stop reading pipelined requests until current exchange ends, 
+        # and stop reading a peer while the other one's buffer is full
+        if (len(self.pipeline) < self.client_recvbuf_size and not throttled 
+                and not (self.server and self.server.is_full())):
+            rlist.append(self.client.conn)
+        if self.client.has_buffer():
+            wlist.append(self.client.conn)
+        if self._server_is_open():
+            if self.server.connecting:
+                wlist.extend(self.server.attempts)
+            else:
+                if not self.client.is_full() and not throttled:
+                    rlist.append(self.server.conn)
+                if self.server.has_buffer():
+                    wlist.append(self.server.conn)
+        return rlist, wlist, xlist
+
+
+    def _process_wlist(self, w):
+        if self.client.conn in w:
+            self.log.debug('client is ready for writes, flushing client buffer')
+            self.client.flush()
+
+        if self._server_is_open() and self.server.connecting:
+            ready = [conn for conn in self.server.attempts if conn in w]
+            if ready:
+                self._finish_connect(ready)
+        elif self._server_is_open() and self.server.conn in w:
+            self.log.debug('server is ready for writes, flushing server buffer')
+            self.server.flush()
+    
+    
+    def _process_rlist(self, r):
+        """Returns True if connection to client must be closed."""
+        bufsiz = self._read_allowance(self.client_recvbuf_size)
+        if self.client.conn in r and bufsiz:
+            self.log.debug('client is ready for reads')
+            self.last_activity = time.time()
+            data = self.client.recv(bufsiz)
+            if data is None:
+                self.log.info('client closed connection')
+                return True
+            if data:
+                self.metrics.bytes_upstream += len(data)
+                self._shape(len(data))
+                if self._account(len(data)):
+                    return True
+                self._process_request(data)
+
+        bufsiz = self._read_allowance(self.server_recvbuf_size)
+        if (self._server_is_open() and not self.server.connecting and 
+                self.server.conn in r and bufsiz):
+            self.log.debug('server is ready for reads')
+            self.last_activity = self.server_activity = time.time()
+            data = self.server.recv(bufsiz)
+            if data is None:
+                self.log.info('server closed connection')
+                self.server.close()
+                if self._should_retry():
+                    self.log.info('pooled connection was stale, retry')
+                    self._connect_server(self.server.addr[0], 
+                            self.server.addr[1], pooled=False)
+            elif data:
+                self.metrics.bytes_downstream += len(data)
+                self._shape(len(data))
+                if self._account(len(data)):
+                    return True
+                self._process_response(data)
+        return False
+
+
+    def _process_request(self, data):
+        self.log.debug('_process_request [%d]', self.request.state)
+        if self.request.state == HttpParser.states.COMPLETE:
+            if self.request.method != b'CONNECT':
+                # next pipelined request, served once this exchange ends
+                self.pipeline += data
+            elif self.server and not self.server.closed:
+                # redirect data to server once connected
+                self.server.queue(data)
+            return
+
+        # parse http request, its body is streamed to server as it comes
+        self.request.parse(data)
+        if self.request.state < HttpParser.states.HEADERS_COMPLETE:
+            return
+
+        if self.server is None and self.auth:
+            self._authenticate()
+
+        if self.server is None and not self._use_cache():
+            self.log.info('request headers complete')
+            self._connect_server(*self._request_target())
+
+        if self.server and not self.server.closed:
+            for piece in self.request.body_pieces:
+                self.server.queue(piece)
+
+        if self.request.state == HttpParser.states.COMPLETE:
+            self.log.info('request parser is in state complete')
+            data, self.request.buffer = self.request.buffer, b''
+            if data:
+                self._process_request(data)
+
+
+    def _authenticate(self):
+        """Checks credentials and quotas of every request."""
+        value = self.request.headers.get(b'proxy-authorization', (None, None))
+        user = self.auth.authenticate(value[1])
+        if user is not self.user:
+            self._release_user()
+            self.auth.acquire(user)
+            self.user = user
+        nbytes, self.user_bytes = self.user_bytes, 0
+        self.auth.account(user, nbytes)
+
+
+    def _account(self, nbytes):
+        """Returns True if the tunnel must close, its user's byte quota 
+        being used up in the middle of a transfer."""
+        self.user_bytes += nbytes
+        if not self.user or self.user_bytes < QUOTA_CHECK_SIZE:
+            return False
+        nbytes, self.user_bytes = self.user_bytes, 0
+        try:
+            self.auth.account(self.user, nbytes)
+        except ProxyQuotaExceeded as e:
+            self.log.warning('close tunnel of [%s]: %s', self.client.addr, e)
+            self.metrics.error(e)
+            return True
+        return False
+
+
+    def _release_user(self):
+        if self.user:
+            user, self.user = self.user, None
+            try:
+                self.auth.release(user, self.user_bytes)
+            except ProxyQuotaExceeded:
+                pass    # enforced on the next request
+        self.user_bytes = 0
+
+
+    def _request_target(self):
+        if self.request.method == b'CONNECT':
+            host, port = self.request.url.path.split(COLON)
+        elif self.request.url:
+            host = self.request.url.hostname
+            port = self.request.url.port if self.request.url.port else 80
+        else:
+            raise Exception('Invalid request\n%s' % self.request.raw)
+        return host, port
+
+
+    def _use_cache(self):
+        """Returns True if the request is answered from cache, now or once
+        another tunnel fetching the same response is done."""
+        if (not self.cache or not self.request.url or 
+                not ResponseCache.is_cacheable_request(self.request)):
+            return False
+        key = ResponseCache.key(self.request)
+        if ResponseCache.forces_refresh(self.request):
+            self.cache_key, self.cache_capture = key, Buffer()
+            return False
+
+        entry, pending = self.cache.acquire(key)
+        if entry and entry.is_fresh():
+            self.metrics.cache['hit'] += 1
+            self._serve_cached(entry)
+            return True
+        if pending:
+            self.metrics.cache['coalesced'] += 1
+            if self.reactor and not pending.done():
+                pending.add_done_callback(
+                    lambda pending: self.reactor.call_soon_threadsafe(
+                        self, self._on_cache_filled, pending))
+                return True
+            try:
+                pending.wait(self.read_timeout or CACHE_WAIT_TIMEOUT)
+            except socket.timeout:
+                # not stored either, the fetching tunnel still does
+                self.log.warning('cache fill [%s] timed out, fetching', 
+                        self.request.url.geturl())
+                return False
+            self._on_cache_filled(pending)
+            return True
+
+        # this tunnel fetches the response, a stale entry is revalidated 
+        # unless the client sent its own conditions
+        self.metrics.cache['miss'] += 1
+        self.cache_key, self.cache_capture = key, Buffer()
+        if (entry and entry.has_validators() and 
+                b'if-none-match' not in self.request.headers and 
+                b'if-modified-since' not in self.request.headers):
+            self.cache_entry = entry
+            self.cache_held = []
+        return False
+
+
+    def _on_cache_filled(self, pending):
+        entry = pending.result
+        if entry and entry.is_fresh():
+            self._serve_cached(entry)
+        else:
+            self._connect_server(*self._request_target())
+
+
+    def _serve_cached(self, entry):
+        self.log.info('cache hit [%s]', self.request.url.geturl())
+        head, body = self.cache.render(entry, self.request)
+        # only the head is parsed, the stored body is sent as is
+        self._expect_response(b'HEAD').parse(head)
+        self.client.queue(head)
+        self.client.queue(body)
+
+
+    def _cache_response(self, data):
+        """Capture response data for the cache.
+
+        Returns True if data must not be queued to client, because it 
+        was already or is held while a stale entry is revalidated.
+        """
+        handled = False
+        if self.cache_entry:
+            self.cache_held.append(data)
+            if self.response.state < HttpParser.states.HEADERS_COMPLETE:
+                return True
+            entry, self.cache_entry = self.cache_entry, None
+            data, self.cache_held = b''.join(self.cache_held), None
+            if self.response.code == b'304':
+                self.metrics.cache['revalidated'] += 1
+                self.cache.refresh(self.cache_key, entry, self.response)
+                self.cache_key = self.cache_capture = None
+                for part in self.cache.render(entry, self.request):
+                    self.client.queue(part)
+                return True
+            self.client.queue(data)
+            handled = True
+
+        if self.cache_capture is not None:
+            self.cache_capture.append(data)
+            if ((self.response.state >= HttpParser.states.HEADERS_COMPLETE and
+                    not ResponseCache.is_storable(self.response)) or 
+                    len(self.cache_capture) > self.cache.max_entry_size):
+                self._abandon_cache()
+            elif self.response.state == HttpParser.states.COMPLETE:
+                wire = b''.join(self.cache_capture.chunks or ())
+                body = wire[len(self.response.raw):
+                        len(wire) - len(self.response.buffer)]
+                self.cache.store(self.cache_key, self.response, body)
+                self.cache_key = self.cache_capture = None
+        return handled
+
+
+    def _abandon_cache(self):
+        if self.cache_key:
+            self.cache.abandon(self.cache_key)
+        self.cache_key = self.cache_capture = self.cache_entry = None
+        self.cache_held = None
+
+
+    def _connect_server(self, host, port, pooled=True):
+        if self.parents:
+            # every origin is reached through a parent, connections to 
+            # parents are pooled like connections to origins
+            self._release_parent()
+            self.parent = self.parents.select()
+            host, port = self.parent.host, self.parent.port
+        if self.egresses:
+            self._release_egress()
+            self.egress = self.egresses.select(self.client.addr[0], host)
+            self.egress_host = host
+
+        if (pooled and self.upstream_pool and 
+                self.request.method != b'CONNECT'):
+            server = self.upstream_pool.acquire(host, port, self.egress)
+            if server:
+                self.log.info('reuse connection [%s]:[%s]', host, port)
+                self.server = server
+                self.server.high_water = self.buffer_high_water
+                self.server_reused = True
+                self._queue_request()
+                self._on_server_connected()
+                return
+
+        self.server_reused = False
+        self.server = Server(host, port, self.log_file)
+        self.server.high_water = self.buffer_high_water
+        # queued data is flushed once connected
+        self._queue_request()
+
+        lookup = None
+        if self.resolver:
+            lookup = self.resolver.resolve(host, port)
+            if self.reactor and not lookup.done():
+                # the loop must not wait, continue once resolved
+                lookup.add_done_callback(
+                    lambda lookup: self.reactor.call_soon_threadsafe(
+                        self, self._on_resolved, lookup))
+                return
+        # thread engine waits in its own thread
+        self._on_resolved(lookup)
+
+
+    def _on_resolved(self, lookup):
+        host, port = self.server.addr
+        try:
+            self.log.info('connecting server [%s]:[%s]', host, port)
+            # fast open only pays when the request is ready to go 
+            # with the SYN
+            self.server.connect(lookup.wait() if lookup else None, 
+                    parallel=self.connect_parallel, 
+                    health=self.address_health, sockopts=self.sockopts, 
+                    fastopen=self.server.has_buffer(), source=self.egress)
+        except Exception as e:  # TimeoutError, socket.gaierror
+            self.log.exception(e)
+            self.server.closed = True
+            raise ProxyConnectionFailed(host, port, repr(e))
+
+        if not self.server.connecting:
+            self._on_server_connected()
+
+
+    def _finish_connect(self, ready):
+        try:
+            self.server.finish_connect(ready)
+        except Exception as e:
+            self.log.exception(e)
+            self.server.closed = True
+            raise ProxyConnectionFailed(self.server.addr[0], 
+                    self.server.addr[1], repr(e))
+        if not self.server.connecting:
+            self._on_server_connected()
+
+
+    def _on_server_connected(self):
+        self.log.info('server connected [%s]', self.server.addr)
+        self.server_activity = time.time()
+        if not self.server_reused:
+            self.metrics.connect_latency.observe(
+                    self.server_activity - self.server.connect_started)
+            if self.parent:
+                self.parents.success(self.parent)
+            if self.egress:
+                self.egresses.success(self.egress)
+        if self.request.method == b'CONNECT' and not self.parent:
+            # a parent answers the CONNECT itself
+            self.client.queue(PROXY_TUNNEL_ESTABLISHED_RESPONSE_PKT)
+
+
+    def _release_parent(self):
+        if self.parent:
+            self.parents.done(self.parent)
+            self.parent = None
+
+
+    def _release_egress(self):
+        if self.egress:
+            self.egresses.done(self.egress, self.egress_host)
+            self.egress = self.egress_host = None
+
+
+    def _queue_request(self):
+        """Queue request headers for server, body follows as received."""
+        if self.request.method == b'CONNECT':
+            if self.parent:
+                self.server.queue(self.request.build(
+                        del_headers=[b'proxy-authorization'], 
+                        absolute_url=True))
+            return
+
+        self.request_sent = time.time()
+        if not self.upstream_pool:
+            add_headers = [(b'Connection', b'Close')]
+        elif self.request.version != b'HTTP/1.1':
+            add_headers = [(b'Connection', b'keep-alive')]
+        else:
+            add_headers = []
+        if self.cache_entry:
+            if self.cache_entry.etag:
+                add_headers.append((b'If-None-Match', self.cache_entry.etag))
+            if self.cache_entry.last_modified:
+                add_headers.append((b'If-Modified-Since', 
+                        self.cache_entry.last_modified))
+        self._expect_response(self.request.method)
+        self.server.queue(self.request.build(
+            del_headers=[b'proxy-authorization', b'proxy-connection', 
+                    b'connection', b'keep-alive'],
+            add_headers=add_headers,
+            absolute_url=bool(self.parent)
+        ))
+
+
+    def _should_retry(self):
+        """A reused connection closed by origin before any response."""
+        return (self.server_reused and 
+                self._response_state() == HttpParser.states.INITIALIZED and 
+                not (self.response and self.response.buffer) and 
+                self.request.method in IDEMPOTENT_METHODS and 
+                not self.request.expects_body())
+
+
+    def _process_response(self, data):
+        if not self.request.method == b'CONNECT':
+            if self.request_sent:
+                self.metrics.time_to_first_byte.observe(
+                        time.time() - self.request_sent)
+                self.request_sent = None
+            self.response.parse(data)
+            while self.response.is_interim_response():
+                # forwarded as is, only the status line of the final 
+                # response completes the exchange
+                rest = self.response.buffer
+                self._expect_response(self.request.method)
+                # the cache would store the interim head with the body
+                self._abandon_cache()
+                if rest:
+                    self.response.parse(rest)
+        if not (self.cache_key and self._cache_response(data)):
+            self.client.queue(data)
+
+        if self._response_state() != HttpParser.states.COMPLETE:
+            return
+        if self.request.state != HttpParser.states.COMPLETE:
+            # answered before the whole body was sent, the rest of it 
+            # would be read as the next request on this connection
+            self.log.info('response complete before request, close [%s]', 
+                    self.server.addr)
+            self.server.close()
+        elif (self.upstream_pool and self.response.is_keep_alive() and 
+                not self.response.buffer):
+            if self.upstream_pool.release(self.server):
+                self.log.info('released connection [%s]', self.server.addr)
+            self.server = None
+
+    
+class TCPServer(LogObject):
+    def __init__(self, hostname='0.0.0.0', port=8899, backlog=100, log_file=''):
+        LogObject.__init__(self, log_file=log_file)
+        self.hostname = hostname
+        self.port = port
+        self.backlog = backlog
+        self.socket = None
+        self.worker = None  # index when run by a WorkerSupervisor
+        self.accepting = True
+        self.stopped = False    # listening socket closed for good
+        # pauses and resumes the listening socket; of workers sharing one
+        # socket only the first does, a socket shut down twice stays 
+        # broken after listening again
+        self.owns_socket = True
+        self.backoff_until = 0  # accept errors pause accepting until then
+        self.pid_file = ''  # pid written here once listening
+
+
+    def handle(self, client):
+        raise NotImplementedError()
+
+
+    def run(self):
+        try:
+            self.log.info('Starting server on port %d', self.port)
+            self.listen()
+            notify_ready(self.pid_file)
+            self.serve()
+        except Exception as e:
+            self.log.exception(e)
+        finally:
+            self.log.info('closing server socket')
+            if self.socket:
+                self.socket.close()
+
+
+    def listen(self, reuse_port=False):
+        fd = os.environ.pop(LISTEN_FD_ENV, None)
+        if fd and not reuse_port:
+            self.log.info('inherited listening socket [%s]', fd)
+            self.socket = socket.fromfd(int(fd), socket.AF_INET, 
+                    socket.SOCK_STREAM)
+            os.close(int(fd))
+            return
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            if not hasattr(socket, 'SO_REUSEPORT'):
+                raise ProxyError('SO_REUSEPORT not supported')
+            self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.socket.bind((self.hostname, self.port))
+        self.socket.listen(self.backlog)
+
+
+    def serve(self):
+        # wake up once a second to notice stop_accepting
+        self.socket.settimeout(1)
+        while not self.stopped:
+            if not self.accepting:
+                time.sleep(1)
+                self.poll()
+                continue
+            try:
+                conn, addr = self.socket.accept()
+            except socket.timeout:
+                self.poll()
+                continue
+            except socket.error as e:
+                if e.args[0] == errno.EINVAL:
+                    # paused by another process sharing the socket
+                    self.accepting = False
+                    time.sleep(1)
+                elif self.accept_failed(e):
+                    time.sleep(ACCEPT_BACKOFF)
+                self.poll()
+                continue
+            client = Client(conn, addr, self.log_file)
+            self.handle(client)
+            self.poll()
+
+
+    def poll(self):
+        """Called at least once a second by the accept loop."""
+        pass
+
+
+    def accept_failed(self, e):
+        """Returns True if accepting backs off for ACCEPT_BACKOFF seconds
+        after error `e`, False if the next connection is accepted now."""
+        if e.args[0] in ACCEPT_SKIP_ERRNOS:
+            self.log.info('accept failed: %s', e)
+            return False
+        self.log.warning('accept failed, retry in [%d] seconds: %s', 
+                ACCEPT_BACKOFF, e)
+        self.backoff_until = time.time() + ACCEPT_BACKOFF
+        return True
+
+
+    def stop_accepting(self):
+        """Close the listening socket, connections already accepted are
+        still served."""
+        self.accepting = False
+        self.stopped = True
+        if self.socket:
+            self.socket.close()
+
+
+    def pause_accepting(self):
+        """Refuse new connections but keep the socket bound. Shutting a
+        listening socket down stops it listening in every process sharing
+        it, listening again resumes. Processes not owning the socket only
+        stop accepting from it."""
+        self.accepting = False
+        if not self.owns_socket:
+            return
+        try:
+            self.socket.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+
+
+    def resume_accepting(self):
+        if self.owns_socket:
+            self.socket.listen(self.backlog)
+            self.accepting = True
+        else:
+            # accepting again once the owner resumed the socket
+            self.accepting = self.is_listening()
+
+
+    def is_listening(self):
+        if not hasattr(socket, 'SO_ACCEPTCONN'):
+            return True
+        return bool(self.socket.getsockopt(socket.SOL_SOCKET, 
+                socket.SO_ACCEPTCONN))
+
+
+    def accept_ready(self):
+        """Accept all pending connections on a non-blocking socket."""
+        while True:
+            try:
+                conn, addr = self.socket.accept()
+            except socket.error as e:
+                if e.args[0] == errno.EINVAL:
+                    # another process sharing the socket paused it, stop 
+                    # polling it until the next resume attempt
+                    self.accepting = False
+                elif (e.args[0] not in WOULDBLOCK_ERRNOS and 
+                        not self.accept_failed(e)):
+                    continue
+                return
+            client = Client(conn, addr, self.log_file)
+            self.handle(client)
+
+
+class WorkerSupervisor(LogObject):
+    """Fork worker processes running the accept loop of a TCPServer.
+
+    Workers either share the listening socket bound by the parent, or bind
+    their own with SO_REUSEPORT so the kernel balances accepts. Workers
+    that die are restarted.
+    """
+
+    def __init__(self, server, workers, reuse_port=False, log_file=''):
+        LogObject.__init__(self, log_file=log_file)
+        self.server = server
+        self.workers = workers
+        self.reuse_port = reuse_port
+        self.children = {}  # pid -> (index, start time)
+        self.stopping = False
+
+
+    def run(self):
+        if not hasattr(os, 'fork'):
+            raise ProxyError('worker mode requires os.fork')
+        if not self.reuse_port:
+            self.server.listen()
+
+        signal.signal(signal.SIGTERM, self._on_stop)
+        signal.signal(signal.SIGINT, self._on_stop)
+        for name in RESTART_SIGNALS:
+            signal.signal(getattr(signal, name), self._on_restart)
+        for i in range(self.workers):
+            self._spawn(i)
+        notify_ready(self.server.pid_file)
+
+        while self.children:
+            try:
+                pid, status = os.wait()
+            except OSError as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if pid not in self.children:
+                continue
+            index, started = self.children.pop(pid)
+            if self.stopping:
+                continue
+            self.log.warning('worker [%d] pid [%d] exited with [%d]', 
+                    index, pid, status)
+            # avoid a fork loop when workers die right after starting
+            if time.time() - started < 1:
+                time.sleep(1)
+            self._spawn(index)
+        self.log.info('all workers exited')
+
+
+    def _spawn(self, index):
+        pid = os.fork()
+        if pid:
+            self.log.info('started worker [%d] pid [%d]', index, pid)
+            self.children[pid] = (index, time.time())
+            return
+
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        for name in RESTART_SIGNALS:    # restarts are up to the supervisor
+            signal.signal(getattr(signal, name), signal.SIG_IGN)
+        self.server.worker = index
+        self.server.owns_socket = self.reuse_port or index == 0
+        code = 1
+        try:
+            if self.reuse_port:
+                self.server.listen(reuse_port=True)
+            self.server.serve()
+            code = 0
+        except Exception as e:
+            self.log.exception(e)
+        finally:
+            # os._exit skips atexit, write out queued log records first
+            for handler in _log_handlers.values():
+                handler.drain()
+            os._exit(code)
+
+
+    def _on_stop(self, signum, frame):
+        self.log.info('received signal [%d], stopping workers', signum)
+        self._signal_workers(signal.SIGTERM)
+
+
+    def _on_restart(self, signum, frame):
+        """Hand the listening socket to a new supervisor, then let the 
+        workers drain and exit."""
+        self.log.info('received signal [%d], restarting', signum)
+        if self.stopping or not spawn_successor(
+                None if self.reuse_port else self.server.socket, self.log):
+            return
+        if self.server.socket:
+            self.server.socket.close()
+        self._signal_workers(signal.SIGQUIT)
+
+
+    def _signal_workers(self, signum):
+        self.stopping = True
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signum)
+            except OSError:
+                pass
+
+
+class TimerWheel(object):
+    """Hashed timer wheel of `tick` seconds resolution.
+
+    Scheduling and cancelling are O(1), expiring costs one slot per tick.
+    Deadlines more than one revolution away wait in their slot for later 
+    rounds.
+    """
+
+    def __init__(self, tick=1.0, slots=512):
+        self.tick = tick
+        self.slots = [set() for _ in range(slots)]
+        self.current = int(time.time() / tick)  # last tick expired
+
+
+    def schedule(self, deadline, item):
+        """Returns an entry to cancel the timer with."""
+        tick = max(int(math.ceil(deadline / self.tick)), self.current + 1)
+        entry = (tick, item)
+        self.slots[tick % len(self.slots)].add(entry)
+        return entry
+
+
+    def cancel(self, entry):
+        self.slots[entry[0] % len(self.slots)].discard(entry)
+
+
+    def expire(self, now):
+        """Returns items whose deadline has passed."""
+        expired = []
+        now_tick = int(now / self.tick)
+        ticks = min(now_tick - self.current, len(self.slots))
+        for i in range(1, ticks + 1):
+            slot = self.slots[(self.current + i) % len(self.slots)]
+            due = [entry for entry in slot if entry[0] <= now_tick]
+            for entry in due:
+                slot.discard(entry)
+                expired.append(entry[1])
+        self.current = max(self.current, now_tick)
+        return expired
+
+
+class Reactor(LogObject):
+    """Single threaded event loop driving many tunnels.
+
+    Every tunnel keeps its own `_get_waitable_lists`/`_process_events` 
+    logic, the reactor only translates them to selector registrations.
+    """
+
+    def __init__(self, log_file=''):
+        LogObject.__init__(self, log_file=log_file)
+        if selectors is None:
+            raise ProxyError('reactor engine requires python 3')
+        self.selector = selectors.DefaultSelector()
+        self.tunnels = {}   # tunnel -> {fd: (sock, events)}
+        self.timers = TimerWheel()
+        self.throttled = {}     # tunnel -> time its reads resume
+        self.last_sweep = time.time()
+        self.sweepers = []  # called once a second
+        # callbacks from other threads, the socketpair wakes the loop up
+        self.callbacks = deque()
+        self.wakeup_r, self.wakeup_w = socket.socketpair()
+        self.wakeup_w.setblocking(False)
+        self.add_reader(self.wakeup_r, self._on_wakeup)
+
+
+    def add_reader(self, sock, callback):
+        sock.setblocking(False)
+        self.selector.register(sock, selectors.EVENT_READ, callback)
+
+
+    def remove_reader(self, sock):
+        self._unregister(sock.fileno())
+
+
+    def add(self, tunnel):
+        tunnel.reactor = self
+        self.tunnels[tunnel] = {}
+        self._sync(tunnel)
+        self._schedule(tunnel)
+
+
+    def call_soon_threadsafe(self, tunnel, callback, *args):
+        """Run tunnel callback in the loop thread."""
+        self.callbacks.append((tunnel, callback, args))
+        try:
+            self.wakeup_w.send(b'\0')
+        except socket.error:
+            pass    # buffer full, a wakeup is already pending
+
+
+    def _on_wakeup(self):
+        try:
+            self.wakeup_r.recv(4096)
+        except socket.error:
+            pass
+        while self.callbacks:
+            tunnel, callback, args = self.callbacks.popleft()
+            if tunnel not in self.tunnels:
+                continue
+            try:
+                done = tunnel._process_callback(callback, *args)
+            except Exception as e:
+                self.log.exception(e)
+                tunnel.metrics.error(e)
+                done = True
+            if done:
+                self.remove(tunnel)
+            else:
+                self._sync(tunnel)
+                self._schedule(tunnel)
+
+
+    def remove(self, tunnel):
+        for fd in self.tunnels.pop(tunnel, {}):
+            self._unregister(fd)
+        self.throttled.pop(tunnel, None)
+        if tunnel.timer:
+            self.timers.cancel(tunnel.timer)
+        try:
+            tunnel.close()
+        except Exception as e:
+            self.log.exception(e)
+
+
+    def stop(self):
+        self.running = False
+
+
+    def run(self):
+        tick = self.timers.tick
+        self.running = True
+        while self.running:
+            # wake up on tick boundaries when timers expire, earlier when
+            # a throttled tunnel may read again
+            timeout = tick - time.time() % tick
+            if self.throttled:
+                timeout = min(timeout, 
+                        max(0, min(self.throttled.values()) - time.time()))
+            self.run_once(timeout)
+
+
+    def run_once(self, timeout):
+        ready = {}
+        for key, events in self.selector.select(timeout):
+            if not isinstance(key.data, Tunnel):
+                key.data()
+                continue
+            r, w = ready.setdefault(key.data, ([], []))
+            if events & selectors.EVENT_READ:
+                r.append(key.fileobj)
+            if events & selectors.EVENT_WRITE:
+                w.append(key.fileobj)
+
+        for tunnel, (r, w) in ready.items():
+            if tunnel not in self.tunnels:
+                continue
+            self._dispatch(tunnel, r, w)
+
+        now = time.time()
+        for tunnel, resume in list(self.throttled.items()):
+            if resume <= now and tunnel in self.tunnels:
+                self._sync(tunnel)
+
+        for tunnel in self.timers.expire(now):
+            if tunnel not in self.tunnels:
+                continue
+            tunnel.timer = None
+            if tunnel._is_finished():
+                self.remove(tunnel)
+            else:
+                self._schedule(tunnel)
+
+        if now - self.last_sweep >= 1:
+            self.last_sweep = now
+            for sweeper in self.sweepers:
+                sweeper()
+
+
+    def _dispatch(self, tunnel, r, w):
+        try:
+            done = tunnel._process_events(r, w)
+        except Exception as e:
+            self.log.exception(e)
+            tunnel.metrics.error(e)
+            done = True
+        if done:
+            self.remove(tunnel)
+        else:
+            self._sync(tunnel)
+            self._schedule(tunnel)
+
+
+    def _schedule(self, tunnel):
+        """Move tunnel timer earlier if a new timeout started."""
+        deadline = tunnel._next_deadline()
+        if tunnel.timer:
+            if tunnel.timer[0] * self.timers.tick <= deadline:
+                return
+            self.timers.cancel(tunnel.timer)
+        tunnel.timer = self.timers.schedule(deadline, tunnel)
+
+
+    def _sync(self, tunnel):
+        """Make selector registrations match the tunnel's interests."""
+        rlist, wlist, _ = tunnel._get_waitable_lists()
+        if tunnel.throttled_until:
+            self.throttled[tunnel] = tunnel.throttled_until
+        else:
+            self.throttled.pop(tunnel, None)
+        wanted = {}
+        for sock in rlist:
+            wanted[sock] = wanted.get(sock, 0) | selectors.EVENT_READ
+        for sock in wlist:
+            wanted[sock] = wanted.get(sock, 0) | selectors.EVENT_WRITE
+
+        registered = self.tunnels[tunnel]
+        for fd, (sock, events) in list(registered.items()):
+            # socket replaced or closed, its fd may already be reused
+            if sock not in wanted or sock.fileno() != fd:
+                self._unregister(fd)
+                del registered[fd]
+
+        for sock, events in wanted.items():
+            fd = sock.fileno()
+            if fd not in registered:
+                self.selector.register(sock, events, tunnel)
+            elif registered[fd][1] != events:
+                self.selector.modify(sock, events, tunnel)
+            registered[fd] = (sock, events)
+
+
+    def _unregister(self, fd):
+        try:
+            self.selector.unregister(fd)
+        except (KeyError, ValueError):
+            pass
+
+
+class AdminServer(TCPServer):
+    """Serve metrics in Prometheus text format on GET /metrics, and run
+    `actions`, a dict of path -> callable, on POST."""
+
+    def __init__(self, metrics, hostname='127.0.0.1', port=8898, 
+            log_file='', actions=None):
+        TCPServer.__init__(self, hostname, port, 16, log_file)
+        self.metrics = metrics
+        self.actions = actions or {}
+
+
+    def start(self):
+        thread = threading.Thread(target=self._listen_and_serve)
+        thread.daemon = True
+        thread.start()
+
+
+    def _listen_and_serve(self):
+        # after a hot restart the draining process holds the port a while
+        while True:
+            try:
+                self.listen()
+                break
+            except socket.error as e:
+                if e.args[0] != errno.EADDRINUSE:
+                    raise
+                self.log.info('admin port [%d] in use, retrying', self.port)
+                self.socket.close()
+                time.sleep(5)
+        self.serve()
+
+
+    def handle(self, client):
+        conn = client.conn
+        try:
+            conn.settimeout(5)
+            request = HttpParser(HttpParser.types.REQUEST_PARSER)
+            while request.state < HttpParser.states.HEADERS_COMPLETE:
+                data = conn.recv(4096)
+                if not data:
+                    return
+                request.parse(data)
+            path = request.url.path if request.url else None
+            if path == b'/metrics':
+                body = self.metrics.render().encode('utf8')
+                head = [b'HTTP/1.1 200 OK', 
+                        b'Content-Type: text/plain; version=0.0.4']
+            elif request.method == b'POST' and path in self.actions:
+                self.log.info('admin action [%s]', path)
+                self.actions[path]()
+                body = b'OK'
+                head = [b'HTTP/1.1 200 OK']
+            else:
+                body = b'Not Found'
+                head = [b'HTTP/1.1 404 Not Found']
+            head += [b'Content-Length: ' + str(len(body)).encode(), 
+                    b'Connection: close']
+            conn.sendall(CRLF.join(head) + CRLF * 2 + body)
+        except Exception as e:
+            self.log.exception(e)
+        finally:
+            conn.close()
+
+
+class PyProxy(TCPServer):
+    def __init__(self, hostname='0.0.0.0', port=8899, backlog=100,
+                 server_recvbuf_size=8192, client_recvbuf_size=8192, 
+                 log_file='', engine='thread', upstream_max_idle=100, 
+                 upstream_max_per_host=8, upstream_idle_timeout=30, 
+                 keepalive_timeout=15, relay='auto', 
+                 buffer_high_water=BUFFER_HIGH_WATER, dns_workers=4, 
+                 dns_ttl=60, dns_negative_ttl=10, dns_cache_size=1024, 
+                 connect_timeout=10, read_timeout=60, connect_parallel=2, 
+                 admin_hostname='127.0.0.1', admin_port=0, max_tunnels=500, 
+                 max_per_ip=0, accept_queue=1000, accept_timeout=5, 
+                 idle_timeout=30, max_lifetime=0, parents=None, 
+                 parent_strategy='round-robin', parent_check_interval=10, 
+                 cache_size=0, cache_max_entry=1024 * 1024, cache_dir='', 
+                 cache_disk_size=1024 * 1024 * 1024, auth_file='',
+                 auth_max_connections=0, auth_max_bytes=0,
+                 auth_quota_period=86400, rate_limit=0, client_rate_limit=0,
+                 user_rate_limit=0, rate_limit_file='', drain_timeout=60,
+                 pid_file='', tcp_nodelay=True, tcp_keepalive=0, 
+                 tcp_keepalive_interval=10, tcp_keepalive_count=3, 
+                 socket_rcvbuf=0, socket_sndbuf=0, tcp_fastopen=0, 
+                 tcp_fastopen_connect=False, tcp_defer_accept=0, 
+                 egresses=None, egress_strategy='round-robin'):
+        TCPServer.__init__(self, hostname, port, backlog, log_file)
+        assert engine in ENGINES
+        self.client_recvbuf_size = client_recvbuf_size
+        self.server_recvbuf_size = server_recvbuf_size
+        self.engine = engine
+        self.reactor = None
+        self.keepalive_timeout = keepalive_timeout
+        self.relay = relay
+        self.buffer_high_water = buffer_high_water
+        self.resolver = None
+        if dns_workers > 0:
+            self.resolver = Resolver(workers=dns_workers, ttl=dns_ttl, 
+                    negative_ttl=dns_negative_ttl, cache_size=dns_cache_size, 
+                    log_file=log_file)
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.connect_parallel = connect_parallel
+        self.idle_timeout = idle_timeout
+        self.max_lifetime = max_lifetime
+        self.parents = None
+        if parents:
+            self.parents = ParentPool([Parent.parse(p) for p in parents], 
+                    strategy=parent_strategy, 
+                    check_interval=parent_check_interval, log_file=log_file)
+        self.cache = None
+        if cache_size > 0:
+            self.cache = ResponseCache(max_size=cache_size, 
+                    max_entry_size=cache_max_entry, cache_dir=cache_dir, 
+                    disk_size=cache_disk_size, log_file=log_file)
+        self.auth = None
+        if auth_file:
+            self.auth = Authenticator(auth_file,
+                    max_connections=auth_max_connections,
+                    max_bytes=auth_max_bytes, quota_period=auth_quota_period,
+                    log_file=log_file)
+        self.shaper = None
+        if rate_limit or client_rate_limit or user_rate_limit or \
+                rate_limit_file:
+            self.shaper = Shaper(rate=rate_limit, client_rate=client_rate_limit,
+                    user_rate=user_rate_limit, path=rate_limit_file, 
+                    log_file=log_file)
+        self.sockopts = SocketOptions(nodelay=tcp_nodelay, 
+                keepalive=tcp_keepalive, 
+                keepalive_interval=tcp_keepalive_interval, 
+                keepalive_count=tcp_keepalive_count, rcvbuf=socket_rcvbuf, 
+                sndbuf=socket_sndbuf, fastopen=tcp_fastopen, 
+                fastopen_connect=tcp_fastopen_connect, 
+                defer_accept=tcp_defer_accept, log_file=log_file)
+        self.address_health = AddressHealth()
+        self.metrics = Metrics()
+        self.egresses = None
+        if egresses:
+            self.egresses = EgressPool([Egress(e) for e in egresses], 
+                    strategy=egress_strategy, log_file=log_file)
+            self.metrics.egresses = self.egresses.egresses
+        self.admin_hostname = admin_hostname
+        self.admin_port = admin_port
+        max_tunnels = self._budget_tunnels(max_tunnels, relay, 
+                upstream_max_idle)
+        self.admission = Admission(max_tunnels=max_tunnels, 
+                max_per_ip=max_per_ip, queue_size=accept_queue, 
+                queue_timeout=accept_timeout, metrics=self.metrics, 
+                log_file=log_file)
+        self.tunnel_pool = None
+        self.drain_timeout = drain_timeout
+        self.pid_file = pid_file
+        self.restart_requested = False
+        self.successor = None       # new process starting for a restart
+        self.drain_started = None   # time accepting stopped
+        self.paused_until = None    # accepting paused through admin
+        self.listening = False  # listening socket registered with reactor
+        self.upstream_pool = None
+        if upstream_max_idle > 0:
+            self.upstream_pool = UpstreamPool(max_idle=upstream_max_idle, 
+                    max_per_host=upstream_max_per_host, 
+                    idle_timeout=upstream_idle_timeout, log_file=log_file)
+
+
+    def serve(self):
+        if hasattr(signal, 'SIGQUIT'):
+            signal.signal(signal.SIGQUIT, self._on_drain)
+        if self.worker is None:
+            for name in RESTART_SIGNALS:
+                signal.signal(getattr(signal, name), self._on_restart)
+        if self.admin_port:
+            # every worker process has its own metrics and admin port
+            AdminServer(self.metrics, self.admin_hostname, 
+                    self.admin_port + (self.worker or 0), self.log_file, 
+                    actions={b'/pause': self.pause, 
+                             b'/resume': self.resume}).start()
+        if self.parents:
+            self.parents.start_checks()
+
+        if self.engine == 'thread':
+            self.tunnel_pool = WorkerPool('Tunnel', log_file=self.log_file)
+            sweeper = threading.Thread(target=self._sweep_admission, 
+                    name='Admission')
+            sweeper.daemon = True
+            sweeper.start()
+            TCPServer.serve(self)
+            while not self._is_drained():
+                time.sleep(0.5)
+            return
+
+        self.reactor = Reactor(self.log_file)
+        self.reactor.sweepers.append(self._start_queued)
+        self.reactor.sweepers.append(self.poll)
+        self._watch_socket(True)
+        self.reactor.run()
+
+
+    def _on_restart(self, signum, frame):
+        # handled by poll, out of the interrupted code
+        self.restart_requested = True
+
+
+    def _on_drain(self, signum, frame):
+        if self.drain_started is None:
+            self.drain_started = time.time()
+
+
+    def pause(self):
+        """Stop accepting until resume, like before a redial; running
+        tunnels go on. Takes effect on the next poll."""
+        self.paused_until = time.time() + MAX_PAUSE
+
+
+    def resume(self):
+        self.paused_until = None
+
+
+    def poll(self):
+        if self.restart_requested:
+            self.restart_requested = False
+            self.log.info('restart requested')
+            if self.successor is None and not self.drain_started:
+                successor = Successor(self.socket, self.log)
+                if successor.start():
+                    self.successor = successor
+        if self.successor:
+            # tunnels keep running while the new process starts up
+            ready = self.successor.ready()
+            if ready is not None:
+                self.successor = None
+                if ready:
+                    self._on_drain(None, None)
+        if self.paused_until and time.time() > self.paused_until:
+            self.log.warning('paused too long, resume accepting')
+            self.paused_until = None
+
+        if self.drain_started:
+            if not self.stopped:
+                self.log.info('stop accepting, draining [%d] tunnels', 
+                        self.admission.active)
+                self._watch_socket(False)
+                self.stop_accepting()
+        elif self.paused_until and self.accepting:
+            self.log.info('pause accepting, [%d] tunnels running', 
+                    self.admission.active)
+            self.pause_accepting()
+        elif not self.paused_until and not self.accepting:
+            # workers not owning the socket retry every second while 
+            # another one keeps it paused
+            (self.log.info if self.owns_socket else self.log.debug)(
+                    'resume accepting')
+            self.resume_accepting()
+        if not self.stopped:
+            # a socket paused elsewhere makes accept_ready fail at once, 
+            # it is not watched until accepting again, nor while backing
+            # off after accept errors
+            self._watch_socket(self.accepting and 
+                    time.time() >= self.backoff_until)
+        self.metrics.accepting = int(self.accepting)
+
+        if self.reactor and self.drain_started and self._is_drained():
+            for tunnel in list(self.reactor.tunnels):
+                self.reactor.remove(tunnel)
+            self.reactor.stop()
+
+
+    def _budget_tunnels(self, max_tunnels, relay, upstream_max_idle):
+        """Lowers `max_tunnels` to what the open file limit allows."""
+        open_files = get_open_file_limit()
+        if not open_files:
+            return max_tunnels
+        # client and server sockets, and a pipe while splicing
+        per_tunnel = 2
+        if relay == 'auto' and SpliceRelay.is_available():
+            per_tunnel += 2
+        budget = (open_files - RESERVED_FILES - upstream_max_idle) // \
+                per_tunnel
+        if max_tunnels > budget:
+            budget = max(1, budget)
+            self.log.warning('open file limit [%d] allows [%d] tunnels, not'
+                    ' [%d]', open_files, budget, max_tunnels)
+            return budget
+        return max_tunnels
+
+
+    def _watch_socket(self, watch):
+        if self.reactor and watch != self.listening:
+            if watch:
+                self.reactor.add_reader(self.socket, self.accept_ready)
+            else:
+                self.reactor.remove_reader(self.socket)
+            self.listening = watch
+
+
+    def _is_drained(self):
+        if not self.admission.active and not self.admission.pending:
+            self.log.info('all tunnels drained')
+            return True
+        if time.time() - self.drain_started > self.drain_timeout:
+            self.log.warning('drain timeout, closing [%d] tunnels', 
+                    self.admission.active)
+            return True
+        return False
+
+
+    def _sweep_admission(self):
+        while True:
+            time.sleep(1)
+            self._start_queued()
+
+
+    def _start_queued(self):
+        client = self.admission.next()
+        if client:
+            self._start_tunnel(client)
+
+
+    def _on_tunnel_closed(self, tunnel):
+        client = self.admission.release(tunnel.client)
+        if client:
+            self._start_tunnel(client)
+
+
+    def listen(self, reuse_port=False):
+        TCPServer.listen(self, reuse_port)
+        self.sockopts.apply_listen(self.socket)
+
+
+    def accept_ready(self):
+        TCPServer.accept_ready(self)
+        if not self.accepting or time.time() < self.backoff_until:
+            self._watch_socket(False)
+
+
+    def accept_failed(self, e):
+        name = errno.errorcode.get(e.args[0], str(e.args[0]))
+        self.metrics.accept_errors[name] = \
+                self.metrics.accept_errors.get(name, 0) + 1
+        return TCPServer.accept_failed(self, e)
+
+
+    def handle(self, client):
+        self.log.info('handle request from [%s]', client.addr)
+        self.metrics.accepted += 1
+        self.sockopts.apply_accepted(client.conn)
+        if self.admission.admit(client):
+            self._start_tunnel(client)
+
+
+    def _start_tunnel(self, client):
+        tunnel = Tunnel(client,
+                      server_recvbuf_size=self.server_recvbuf_size,
+                      client_recvbuf_size=self.client_recvbuf_size, 
+                      log_file=self.log_file,
+                      upstream_pool=self.upstream_pool,
+                      keepalive_timeout=self.keepalive_timeout,
+                      relay=self.relay,
+                      buffer_high_water=self.buffer_high_water,
+                      resolver=self.resolver,
+                      connect_timeout=self.connect_timeout,
+                      read_timeout=self.read_timeout,
+                      connect_parallel=self.connect_parallel,
+                      address_health=self.address_health,
+                      metrics=self.metrics,
+                      on_close=self._on_tunnel_closed,
+                      idle_timeout=self.idle_timeout,
+                      max_lifetime=self.max_lifetime,
+                      parents=self.parents,
+                      cache=self.cache,
+                      auth=self.auth,
+                      shaper=self.shaper,
+                      sockopts=self.sockopts,
+                      egresses=self.egresses)
+        if self.reactor:
+            self.reactor.add(tunnel)
+        else:
+            self.tunnel_pool.submit(tunnel.run)
+
+
+def set_open_file_limit(limit):
+    if os.name != 'nt':  # resource module not available on Windows OS
+        soft_limit, hard_limit = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft_limit < limit < hard_limit:
             resource.setrlimit(resource.RLIMIT_NOFILE, (limit, hard_limit))
 
 
+def get_open_file_limit():
+    """Soft limit of open files, 0 if unknown or unlimited."""
+    if os.name == 'nt':
+        return 0
+    soft_limit = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+    return 0 if soft_limit == resource.RLIM_INFINITY else soft_limit
+
+
+class Successor(object):
+    """A new process running the same command line on the listening 
+    socket `sock`, or binding its own if None, started for a hot restart.
+
+    `start` does not wait for it, `ready` tells once it listens or failed
+    to within `timeout` seconds.
+    """
+
+    def __init__(self, sock, log, timeout=30):
+        self.sock = sock
+        self.log = log
+        self.timeout = timeout
+        self.child = None
+        self.ready_r = None
+        self.deadline = None
+
+
+    def start(self):
+        if not PY3:
+            self.log.error('hot restart requires python 3')
+            return False
+        ready_r, ready_w = os.pipe()
+        env = dict(os.environ)
+        env[READY_FD_ENV] = str(ready_w)
+        fds = [ready_w]
+        if self.sock:
+            env[LISTEN_FD_ENV] = str(self.sock.fileno())
+            fds.append(self.sock.fileno())
+        try:
+            self.child = subprocess.Popen([sys.executable] + sys.argv, 
+                    env=env, pass_fds=fds)
+        except OSError as e:
+            self.log.exception(e)
+            os.close(ready_r)
+            return False
+        finally:
+            os.close(ready_w)
+        self.ready_r = ready_r
+        self.deadline = time.time() + self.timeout
+        return True
+
+
+    def ready(self, wait=0):
+        """True once the new process listens, False if it died or missed
+        the deadline, None while still starting. Waits up to `wait` 
+        seconds."""
+        wait = max(0, min(wait, self.deadline - time.time()))
+        # pipe closes without data if the new process dies first
+        if select.select([self.ready_r], [], [], wait)[0]:
+            ready = os.read(self.ready_r, 1)
+        elif time.time() >= self.deadline:
+            ready = False
+        else:
+            return None
+        os.close(self.ready_r)
+        if not ready:
+            self.log.error('new process [%d] did not start listening', 
+                    self.child.pid)
+            if self.child.poll() is None:
+                self.child.kill()
+            self.child.wait()
+            return False
+        self.log.info('new process [%d] listening', self.child.pid)
+        return True
+
+
+def spawn_successor(sock, log, timeout=30):
+    """Start a Successor and wait for it. Returns True once it listens, 
+    the caller then stops accepting and drains.
+    """
+    successor = Successor(sock, log, timeout)
+    return successor.start() and successor.ready(timeout)
+
+
+def notify_ready(pid_file=''):
+    """Write the pid file, and tell the process that spawned us for a hot
+    restart that we listen."""
+    if pid_file:
+        with open(pid_file, 'w') as f:
+            f.write(str(os.getpid()))
+    fd = os.environ.pop(READY_FD_ENV, None)
+    if fd:
+        os.write(int(fd), b'1')
+        os.close(int(fd))
+
+
 def is_addr_used(host, port):
     sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     result = sock.connect_ex((host, port))
@@ -630,25 +4474,204 @@ def main():
 
     parser.add_argument('--hostname', default='0.0.0.0')
     parser.add_argument('--port', default='8899', type=int)
-    parser.add_argument('--backlog', default='100', type=int)
+    parser.add_argument('--backlog', default='1024', type=int)
     parser.add_argument('--server-recvbuf-size', default='8192', type=int)
     parser.add_argument('--client-recvbuf-size', default='8192', type=int)
     parser.add_argument('--open-file-limit', default='1024', type=int)
     parser.add_argument('--log-file', default='')
+    parser.add_argument('--log-level', default='info', 
+            choices=('debug', 'info', 'warning', 'error'),
+            help='debug also logs every received chunk and socket wakeup')
+    parser.add_argument('--engine', default='thread', choices=ENGINES,
+            help='thread: one thread per tunnel; '
+                 'reactor: one selectors event loop for all tunnels')
+    parser.add_argument('--workers', default='1', type=int,
+            help='number of forked worker processes')
+    parser.add_argument('--reuse-port', action='store_true',
+            help='workers bind their own socket with SO_REUSEPORT instead '
+                 'of sharing the parent one')
+    parser.add_argument('--upstream-max-idle', default='100', type=int,
+            help='idle keep-alive origin connections kept, 0 disables reuse')
+    parser.add_argument('--upstream-max-per-host', default='8', type=int)
+    parser.add_argument('--upstream-idle-timeout', default='30', type=int)
+    parser.add_argument('--keepalive-timeout', default='15', type=int,
+            help='idle seconds between requests on a client connection, '
+                 '0 disables client keep-alive')
+    parser.add_argument('--relay', default='auto', choices=RELAYS,
+            help='established CONNECT tunnels: auto splices in kernel when '
+                 'os.splice is available, copy uses recv_into, off parses '
+                 'and queues like plain http')
+    parser.add_argument('--buffer-high-water', default=BUFFER_HIGH_WATER, 
+            type=int, help='bytes queued for a peer before reading from '
+                           'the other peer pauses')
+    parser.add_argument('--dns-workers', default='4', type=int,
+            help='resolver threads, 0 resolves inline without cache')
+    parser.add_argument('--dns-ttl', default='60', type=int)
+    parser.add_argument('--dns-negative-ttl', default='10', type=int)
+    parser.add_argument('--dns-cache-size', default='1024', type=int)
+    parser.add_argument('--connect-timeout', default='10', type=int,
+            help='seconds to connect upstream, 0 waits for the OS')
+    parser.add_argument('--read-timeout', default='60', type=int,
+            help='seconds to wait for upstream response data, 0 disables')
+    parser.add_argument('--connect-parallel', default='2', type=int,
+            help='upstream addresses tried at once, alternating IPv6/IPv4')
+    parser.add_argument('--admin-hostname', default='127.0.0.1',
+            help='interface of the metrics endpoint')
+    parser.add_argument('--admin-port', default='0', type=int,
+            help='serve /metrics on this port, 0 disables, worker N '
+            'listens on port + N')
+    parser.add_argument('--max-tunnels', default='500', type=int,
+            help='client connections served at once')
+    parser.add_argument('--max-per-ip', default='0', type=int,
+            help='client connections per client ip, 0 means no limit')
+    parser.add_argument('--accept-queue', default='1000', type=int,
+            help='connections waiting for a free tunnel, the rest get 503')
+    parser.add_argument('--accept-timeout', default='5', type=float,
+            help='seconds a connection may wait for a free tunnel')
+    parser.add_argument('--idle-timeout', default='30', type=int,
+            help='seconds without activity before a tunnel is closed')
+    parser.add_argument('--max-lifetime', default='0', type=int,
+            help='seconds a tunnel may live at most, 0 means no limit')
+    parser.add_argument('--parent', action='append', default=[],
+            help='host:port[:weight] of a parent proxy to forward all '
+            'requests to, repeat for a pool')
+    parser.add_argument('--parent-strategy', default='round-robin', 
+            choices=PARENT_STRATEGIES)
+    parser.add_argument('--parent-check-interval', default='10', type=int,
+            help='seconds between parent health checks, 0 disables')
+    parser.add_argument('--cache-size', default='0', type=int,
+            help='MB of memory caching plain HTTP GET responses, 0 disables')
+    parser.add_argument('--cache-max-entry', default='1024', type=int,
+            help='KB of the largest response cached')
+    parser.add_argument('--cache-dir', default='',
+            help='directory of a disk tier for entries evicted from memory')
+    parser.add_argument('--cache-disk-size', default='1024', type=int,
+            help='MB of the disk tier')
+    parser.add_argument('--auth-file', default='',
+            help='require Basic proxy auth, lines of '
+            'user:password[:max_connections[:max_mb]], reloaded on change')
+    parser.add_argument('--auth-max-connections', default='0', type=int,
+            help='default client connections per user, 0 means no limit')
+    parser.add_argument('--auth-max-mb', default='0', type=int,
+            help='default MB per user per quota period, 0 means no limit')
+    parser.add_argument('--auth-quota-period', default='86400', type=int,
+            help='seconds after which byte quotas start over')
+    parser.add_argument('--rate-limit', default='0', type=int,
+            help='KB/s relayed by all tunnels together, 0 means no limit')
+    parser.add_argument('--client-rate-limit', default='0', type=int,
+            help='KB/s relayed per client ip, 0 means no limit')
+    parser.add_argument('--user-rate-limit', default='0', type=int,
+            help='KB/s relayed per authenticated user, 0 means no limit')
+    parser.add_argument('--rate-limit-file', default='',
+            help='rate limits that override the flags, reloaded on change, '
+            'lines of "global|client|user [ip|user] KB/s"')
+    parser.add_argument('--drain-timeout', default='60', type=int,
+            help='seconds tunnels may finish after SIGQUIT or a SIGHUP/'
+            'SIGUSR2 hot restart before they are closed')
+    parser.add_argument('--pid-file', default='',
+            help='write the pid here once listening, for kill -HUP')
+    parser.add_argument('--tcp-nodelay', default='1', type=int,
+            help='disable Nagle on client and upstream sockets, 0 keeps it')
+    parser.add_argument('--tcp-keepalive', default='0', type=int,
+            help='idle seconds before keepalive probes find dead peers, '
+            '0 disables')
+    parser.add_argument('--tcp-keepalive-interval', default='10', type=int,
+            help='seconds between keepalive probes')
+    parser.add_argument('--tcp-keepalive-count', default='3', type=int,
+            help='unanswered keepalive probes before the peer is dead')
+    parser.add_argument('--socket-rcvbuf', default='0', type=int,
+            help='SO_RCVBUF bytes, 0 keeps kernel autotuning')
+    parser.add_argument('--socket-sndbuf', default='0', type=int,
+            help='SO_SNDBUF bytes, 0 keeps kernel autotuning')
+    parser.add_argument('--tcp-fastopen', default='0', type=int,
+            help='TCP Fast Open queue length of the listening socket, 0 '
+            'disables (net.ipv4.tcp_fastopen must allow it)')
+    parser.add_argument('--tcp-fastopen-connect', action='store_true',
+            help='send plain http requests to origins with the SYN, the '
+            'connect then succeeds before the handshake and a refused '
+            'connection closes the client instead of answering 502')
+    parser.add_argument('--tcp-defer-accept', default='0', type=int,
+            help='seconds the kernel holds accepted connections until the '
+            'client sends data, 0 disables')
+    parser.add_argument('--egress', action='append', default=[],
+            help='local address, or interface like ppp0 (root), upstream '
+            'connections are made from; repeat to spread them across '
+            'several')
+    parser.add_argument('--egress-strategy', default='round-robin', 
+            choices=EGRESS_STRATEGIES,
+            help='sticky keeps the egress of a client address, least-used '
+            'picks the fewest connections to the destination host')
     args = parser.parse_args()
 
-    if is_addr_used(args.hostname, args.port):
+    # a hot restart successor shares the port with the running process
+    if READY_FD_ENV not in os.environ and \
+            is_addr_used(args.hostname, args.port):
         print('server already run. exit ..')
         return
 
     set_open_file_limit(int(args.open_file_limit))
+    LogObject.default_level = getattr(logging, args.log_level.upper())
     proxy = PyProxy(hostname=args.hostname,
             port=args.port,
             backlog=args.backlog,
             server_recvbuf_size=args.server_recvbuf_size,
             client_recvbuf_size=args.client_recvbuf_size, 
-            log_file=args.log_file)
-    proxy.run()
+            log_file=args.log_file,
+            engine=args.engine,
+            upstream_max_idle=args.upstream_max_idle,
+            upstream_max_per_host=args.upstream_max_per_host,
+            upstream_idle_timeout=args.upstream_idle_timeout,
+            keepalive_timeout=args.keepalive_timeout,
+            relay=args.relay,
+            buffer_high_water=args.buffer_high_water,
+            dns_workers=args.dns_workers,
+            dns_ttl=args.dns_ttl,
+            dns_negative_ttl=args.dns_negative_ttl,
+            dns_cache_size=args.dns_cache_size,
+            connect_timeout=args.connect_timeout,
+            read_timeout=args.read_timeout,
+            connect_parallel=args.connect_parallel,
+            admin_hostname=args.admin_hostname,
+            admin_port=args.admin_port,
+            max_tunnels=args.max_tunnels,
+            max_per_ip=args.max_per_ip,
+            accept_queue=args.accept_queue,
+            accept_timeout=args.accept_timeout,
+            idle_timeout=args.idle_timeout,
+            max_lifetime=args.max_lifetime,
+            parents=args.parent,
+            parent_strategy=args.parent_strategy,
+            parent_check_interval=args.parent_check_interval,
+            cache_size=args.cache_size * 1024 * 1024,
+            cache_max_entry=args.cache_max_entry * 1024,
+            cache_dir=args.cache_dir,
+            cache_disk_size=args.cache_disk_size * 1024 * 1024,
+            auth_file=args.auth_file,
+            auth_max_connections=args.auth_max_connections,
+            auth_max_bytes=args.auth_max_mb * 1024 * 1024,
+            auth_quota_period=args.auth_quota_period,
+            rate_limit=args.rate_limit * 1024,
+            client_rate_limit=args.client_rate_limit * 1024,
+            user_rate_limit=args.user_rate_limit * 1024,
+            rate_limit_file=args.rate_limit_file,
+            drain_timeout=args.drain_timeout,
+            pid_file=args.pid_file,
+            tcp_nodelay=bool(args.tcp_nodelay),
+            tcp_keepalive=args.tcp_keepalive,
+            tcp_keepalive_interval=args.tcp_keepalive_interval,
+            tcp_keepalive_count=args.tcp_keepalive_count,
+            socket_rcvbuf=args.socket_rcvbuf,
+            socket_sndbuf=args.socket_sndbuf,
+            tcp_fastopen=args.tcp_fastopen,
+            tcp_fastopen_connect=args.tcp_fastopen_connect,
+            tcp_defer_accept=args.tcp_defer_accept,
+            egresses=args.egress,
+            egress_strategy=args.egress_strategy)
+    if args.workers > 1:
+        WorkerSupervisor(proxy, args.workers, 
+                reuse_port=args.reuse_port, log_file=args.log_file).run()
+    else:
+        proxy.run()
 
 
 if __name__ == '__main__':
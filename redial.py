@@ -0,0 +1,152 @@
+# coding: utf8
+""" redial pppoe for a new ip without cutting tunnels off mid-transfer
+
+1. pause pyproxy accepting through its admin endpoint, so new clients
+   fail over to other proxies right away
+2. wait for running tunnels to finish, up to --drain-timeout seconds
+3. run the redial command (bohao.sh)
+4. wait for the new address, reported by netlink
+5. resume pyproxy and push the new ip to the admin at once
+
+pyproxy must run with --admin-port. Try without touching the network:
+    python redial.py --redial-command 'sleep 1' --ip-timeout 2 \
+            --admin http://127.0.0.1:8888/_add_proxy --log-file ''
+"""
+import time
+import subprocess
+import argparse
+import requests
+from heartbeat import (log, setup_log, acquire_lock, AddressWatcher,
+        Heartbeat, CWD, ADMIN_HOST, PROXY_PORT, METRICS_PORT)
+
+
+LOG_PATH = '{}/log/redial.log'.format(CWD)
+LOCK_PATH = '{}/.redial'.format(CWD)
+REDIAL_COMMAND = 'sh {}/bohao.sh'.format(CWD)
+
+
+class ProxyControl(object):
+    """Pause, resume and watch every pyproxy worker through its admin
+    endpoint, worker N listens on port + N."""
+
+    def __init__(self, port=METRICS_PORT, workers=1):
+        self.session = requests.Session()
+        self.urls = ['http://127.0.0.1:{}'.format(port + i)
+                for i in range(workers)]
+
+
+    def post(self, path):
+        ok = True
+        for url in self.urls:
+            try:
+                self.session.post(url + path, timeout=2).raise_for_status()
+            except Exception as e:
+                log.warning('[%s%s] failed: %s', url, path, e)
+                ok = False
+        return ok
+
+
+    def status(self):
+        """Returns (accepting, active tunnels) summed over workers."""
+        accepting, active = 0, 0
+        for url in self.urls:
+            try:
+                r = self.session.get(url + '/metrics', timeout=2)
+                r.raise_for_status()
+            except Exception as e:
+                log.warning('[%s/metrics] failed: %s', url, e)
+                continue
+            for line in r.text.splitlines():
+                if line.startswith('pyproxy_accepting '):
+                    accepting += int(float(line.split()[-1]))
+                elif line.startswith('pyproxy_active_tunnels '):
+                    active += int(float(line.split()[-1]))
+        return accepting, active
+
+
+    def resume(self, timeout=5):
+        """Resume and wait until every worker accepts again."""
+        deadline = time.time() + timeout
+        if not self.post('/resume'):
+            return False
+        while self.status()[0] < len(self.urls):
+            if time.time() > deadline:
+                return False
+            time.sleep(0.1)
+        return True
+
+
+    def drain(self, timeout):
+        """Pause and wait until no tunnel runs, returns tunnels left."""
+        deadline = time.time() + timeout
+        if not self.post('/pause'):
+            return 0    # no proxy to wait for
+        while True:
+            accepting, active = self.status()
+            if not accepting and not active:
+                return 0
+            if time.time() > deadline:
+                return active
+            time.sleep(0.2)
+
+
+def wait_new_ip(watcher, old_ip, timeout):
+    deadline = time.time() + timeout
+    while not (watcher.ip and watcher.ip != old_ip):
+        left = deadline - time.time()
+        if left <= 0:
+            return None
+        watcher.wait(min(left, 1))
+    return watcher.ip
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--redial-command', default=REDIAL_COMMAND)
+    parser.add_argument('--drain-timeout', default='30', type=float,
+            help='seconds running tunnels may finish before the redial')
+    parser.add_argument('--ip-timeout', default='60', type=float,
+            help='seconds to wait for the new address')
+    parser.add_argument('--admin', default=ADMIN_HOST,
+            help='url the new ip is pushed to')
+    parser.add_argument('--proxy-port', default=PROXY_PORT, type=int)
+    parser.add_argument('--proxy-admin-port', default=METRICS_PORT,
+            type=int, help='pyproxy --admin-port')
+    parser.add_argument('--proxy-workers', default='1', type=int,
+            help='pyproxy --workers')
+    parser.add_argument('--log-file', default=LOG_PATH)
+    args = parser.parse_args()
+
+    setup_log(args.log_file)
+    lock = acquire_lock(LOCK_PATH)
+    if lock is None:
+        log.info('redial already running, exit..')
+        return
+
+    watcher = AddressWatcher()
+    proxy = ProxyControl(args.proxy_admin_port, args.proxy_workers)
+    old_ip = watcher.ip
+    start = time.time()
+    try:
+        left = proxy.drain(args.drain_timeout)
+        log.info('drained in [%.1f]s, [%d] tunnels left',
+                time.time() - start, left)
+        code = subprocess.call(args.redial_command, shell=True)
+        log.info('redial exited with [%d] after [%.1f]s', code,
+                time.time() - start)
+        new_ip = wait_new_ip(watcher, old_ip, args.ip_timeout)
+        if new_ip is None:
+            log.warning('ip still [%s] after [%ds]', watcher.ip,
+                    args.ip_timeout)
+    finally:
+        # never leave the proxy paused
+        proxy.resume()
+    log.info('ip [%s] -> [%s], proxy paused for [%.1f]s', old_ip,
+            watcher.ip, time.time() - start)
+    if watcher.ip:
+        Heartbeat(admin=args.admin, proxy_port=args.proxy_port,
+                metrics_port=0, watcher=watcher).send()
+
+
+if __name__ == '__main__':
+    main()